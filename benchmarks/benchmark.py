@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""
+Benchmarks of traffic_info's render and delivery pipeline.
+
+External services are replaced by local stand-ins: a fake webdriver serving
+canned PNG screenshots and an in-process SMTP sink, so the results only
+depend on traffic_info's code and can be compared between commits:
+
+    python benchmarks/benchmark.py -o baseline.json
+    python benchmarks/benchmark.py --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+# pylint: disable=wrong-import-position
+from standins import FakeWebDriver, SMTPSink, TileServer  # noqa: E402
+
+from traffic_info.congestion import decode, score_image  # noqa: E402
+from traffic_info.core import (  # noqa: E402
+    Capture,
+    DIR,
+    Location,
+    MapScreenshot,
+    SMTPServer,
+    Viewport,
+    build_email,
+    send_email,
+    send_emails,
+)
+from traffic_info.delivery import Delivery  # noqa: E402
+from traffic_info.history import HistoryStore  # noqa: E402
+from traffic_info.imaging import ImageProcessor  # noqa: E402
+from traffic_info.outbox import Outbox  # noqa: E402
+from traffic_info.pool import ScreenshotPool  # noqa: E402
+from traffic_info.route import sample_route  # noqa: E402
+from traffic_info.server import MapServer  # noqa: E402
+from traffic_info.tiles import TileRenderer  # noqa: E402
+from traffic_info.utils import render_template  # noqa: E402
+
+Results = Dict[str, Any]
+
+LOCATION = Location(43.6037834, 1.4402123, 16)
+# A 200 points route crossing the map
+ROUTE = [
+    (43.6007834 + 0.00003 * index, 1.4352123 + 0.00005 * index) for index in range(200)
+]
+WIDTH = 1280
+HEIGHT = 720
+
+
+def measure(function: Callable[[], Any], iterations: int) -> Dict[str, float]:
+    """
+    Time a function.
+
+    Args:
+        function: The function to time, called once before measuring.
+        iterations: Number of measured calls.
+
+    Returns:
+        The timings statistics in milliseconds.
+
+    """
+    function()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "iterations": iterations,
+        "min": timings[0],
+        "median": statistics.median(timings),
+        "mean": statistics.fmean(timings),
+        "p95": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+    }
+
+
+def run_benchmarks(iterations: int) -> Results:
+    """
+    Run all the benchmarks.
+
+    Args:
+        iterations: Number of measured calls of each benchmark.
+
+    Returns:
+        The benchmarks' timings and the sizes of the produced email.
+
+    """
+    timings = {}
+    sizes = {}
+    templates = os.path.join(DIR, "templates")
+    map_context = {
+        "key": "API_KEY",
+        "latitude": LOCATION.latitude,
+        "longitude": LOCATION.longitude,
+        "zoom": LOCATION.zoom,
+    }
+    email_context = {"url": "https://maps.google.com", "width": WIDTH}
+    email_context.update({"height": HEIGHT, "map_cid": "map@localhost"})
+    timings["render_template.map"] = measure(
+        lambda: render_template(os.path.join(templates, "map.j2"), map_context),
+        iterations,
+    )
+    timings["render_template.email"] = measure(
+        lambda: render_template(os.path.join(templates, "email.j2"), email_context),
+        iterations,
+    )
+
+    def setup():
+        location = Location(LOCATION.latitude, LOCATION.longitude, LOCATION.zoom)
+        return location, MapScreenshot("chromedriver", width=WIDTH, height=HEIGHT)
+
+    timings["setup"] = measure(setup, iterations)
+
+    with mock.patch("selenium.webdriver.Chrome", FakeWebDriver):
+        for mode, in_memory in (("file", False), ("in_memory", True)):
+            screenshot = MapScreenshot(
+                "chromedriver", width=WIDTH, height=HEIGHT, in_memory=in_memory
+            )
+            timings[f"take.{mode}"] = measure(
+                lambda screenshot=screenshot: screenshot.take(LOCATION), iterations
+            )
+            with screenshot:
+                timings[f"take.{mode}.session"] = measure(
+                    lambda screenshot=screenshot: screenshot.take(LOCATION),
+                    iterations,
+                )
+
+        screenshot = MapScreenshot("chromedriver", width=WIDTH, height=HEIGHT)
+        screenshot.take(LOCATION)
+        capture = Capture(LOCATION, screenshot.path, WIDTH, HEIGHT)
+        sizes["screenshot"] = os.path.getsize(screenshot.path)
+
+    # A week of maps of a location every 15 minutes, half of them unchanged
+    with tempfile.TemporaryDirectory() as history_dir:
+        history = HistoryStore(history_dir)
+        png = FakeWebDriver.png
+        week = time.time() - 7 * 86400
+        for index in range(7 * 96):
+            data = png if index % 2 else png + index.to_bytes(4, "big")
+            history.add(LOCATION, data, WIDTH, HEIGHT, timestamp=week + index * 900)
+        timings["history.add"] = measure(
+            lambda: history.add(LOCATION, png, WIDTH, HEIGHT), iterations
+        )
+        timings["history.weekday"] = measure(
+            lambda: history.read_many(
+                [snapshot.digest for snapshot in history.snapshots(LOCATION, weekday=0)]
+            ),
+            iterations,
+        )
+        history.close()
+
+    try:
+        import numpy  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        print(
+            "numpy and Pillow are not installed, skipping take.tiles and congestion",
+            file=sys.stderr,
+        )
+    else:
+        with TileServer() as tile_server:
+            url_templates = [
+                tile_server.url_template("base"),
+                tile_server.url_template("traffic"),
+            ]
+            with TileRenderer(url_templates) as renderer:
+                tile_screenshot = MapScreenshot(
+                    None, width=WIDTH, height=HEIGHT, in_memory=True, renderer=renderer
+                )
+                timings["take.tiles"] = measure(
+                    lambda: tile_screenshot.take(LOCATION), iterations
+                )
+                sizes["screenshot.tiles"] = len(tile_screenshot.data)
+        png = FakeWebDriver.png
+        timings["congestion.score"] = measure(lambda: score_image(png), iterations)
+        pixels = decode(png)
+        timings["route.sample"] = measure(
+            lambda: sample_route(pixels, LOCATION, ROUTE), iterations
+        )
+        processors = {
+            "png": ImageProcessor(),
+            "png_palette": ImageProcessor(colors=64),
+            "jpeg": ImageProcessor("jpeg"),
+            "webp": ImageProcessor("webp"),
+        }
+        for name, processor in processors.items():
+            timings[f"image.{name}"] = measure(
+                lambda processor=processor: processor.process(png, WIDTH, HEIGHT),
+                iterations,
+            )
+            sizes[f"image.{name}"] = len(processor.process(png, WIDTH, HEIGHT))
+
+    def make_email():
+        return build_email("from@example.com", "to@example.com", LOCATION, capture)
+
+    timings["build_email"] = measure(make_email, iterations)
+    email = make_email()
+    sizes["email"] = len(email.as_bytes())
+
+    with SMTPSink() as sink:
+        with SMTPServer("127.0.0.1", sink.port) as smtp_server:
+            timings["smtp.send_message"] = measure(
+                lambda: smtp_server.send_message(email), iterations
+            )
+        timings["smtp.connect_send"] = measure(
+            lambda: SMTPServer("127.0.0.1", sink.port).send_message(email),
+            iterations,
+        )
+
+        # One map sent to 50 recipients
+        recipients = [f"user{index}@example.com" for index in range(50)]
+        with SMTPServer("127.0.0.1", sink.port) as smtp_server:
+            timings["fan_out.send_email"] = measure(
+                lambda: [
+                    send_email(
+                        "from@example.com", recipient, LOCATION, capture, smtp_server
+                    )
+                    for recipient in recipients
+                ],
+                iterations,
+            )
+            timings["fan_out.send_emails"] = measure(
+                lambda: send_emails(
+                    "from@example.com", recipients, LOCATION, capture, smtp_server
+                ),
+                iterations,
+            )
+            timings["fan_out.bcc"] = measure(
+                lambda: send_emails(
+                    "from@example.com",
+                    recipients,
+                    LOCATION,
+                    capture,
+                    smtp_server,
+                    bcc=True,
+                ),
+                iterations,
+            )
+
+    # A whole job, the map takes 50 ms to load and the SMTP greeting 50 ms
+    viewports = [Viewport(LOCATION, WIDTH, HEIGHT)]
+    FakeWebDriver.load_delay = 0.05
+    with SMTPSink(greeting_delay=0.05) as sink, mock.patch(
+        "selenium.webdriver.Chrome", FakeWebDriver
+    ), ThreadPoolExecutor(max_workers=1) as executor:
+        screenshot = MapScreenshot(
+            "chromedriver", width=WIDTH, height=HEIGHT, in_memory=True
+        )
+
+        def sequential():
+            smtp_server = SMTPServer("127.0.0.1", sink.port)
+            captures = screenshot.take_viewports(viewports)
+            send_email(
+                "from@example.com", "to@example.com", LOCATION, captures, smtp_server
+            )
+            smtp_server.close()
+
+        def overlapped():
+            smtp_server = SMTPServer("127.0.0.1", sink.port)
+            with Delivery("from@example.com", smtp_server) as delivery:
+                captures = executor.submit(screenshot.take_viewports, viewports)
+                delivery.submit("to@example.com", LOCATION, viewports, captures)
+            smtp_server.close()
+
+        timings["job.sequential"] = measure(sequential, iterations)
+        timings["job.overlapped"] = measure(overlapped, iterations)
+
+        # The email is queued, an OutboxSender would send it in background
+        with tempfile.TemporaryDirectory() as outbox_dir:
+            outbox = Outbox(outbox_dir)
+
+            def queued():
+                captures = screenshot.take_viewports(viewports)
+                send_email(
+                    "from@example.com", "to@example.com", LOCATION, captures, outbox
+                )
+
+            timings["job.outbox"] = measure(queued, iterations)
+
+        # 32 concurrent requests for 4 maps, served by 2 warm browsers
+        with ScreenshotPool(
+            2, webdriver_path="chromedriver", in_memory=True
+        ) as pool, MapServer(pool, ("127.0.0.1", 0), max_age=0) as server:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            port = server.server_address[1]
+            urls = [
+                f"http://127.0.0.1:{port}/map?lat={LOCATION.latitude + index % 4}"
+                f"&lng={LOCATION.longitude}&w=640&h=480"
+                for index in range(32)
+            ]
+
+            def fetch(url):
+                with urllib.request.urlopen(url) as response:
+                    return response.read()
+
+            pool.prepare(LOCATION)
+            with ThreadPoolExecutor(max_workers=32) as clients:
+                timings["serve.burst"] = measure(
+                    lambda: list(clients.map(fetch, urls)), iterations
+                )
+            server.max_age = 60
+            timings["serve.cached"] = measure(lambda: fetch(urls[0]), iterations)
+            server.shutdown()
+    FakeWebDriver.load_delay = 0
+    return {"timings": timings, "sizes": sizes}
+
+
+def get_commit() -> str:
+    """Get the current git commit, None outside of a git repository."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            check=True,
+            cwd=HERE,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Results, baseline: Results, threshold: float) -> int:
+    """
+    Compare results with a baseline and print the differences.
+
+    Args:
+        results: The current results.
+        baseline: The baseline results.
+        threshold: Relative increase considered as a regression.
+
+    Returns:
+        The number of regressions.
+
+    """
+    regressions = 0
+    rows = [
+        (f"{name} (median ms)", stats["median"], baseline["timings"].get(name))
+        for name, stats in results["timings"].items()
+    ] + [
+        (f"{name} size (bytes)", size, baseline["sizes"].get(name))
+        for name, size in results["sizes"].items()
+    ]
+    for name, value, reference in rows:
+        if isinstance(reference, dict):
+            reference = reference["median"]
+        if reference is None:
+            print(f"{name:40} {value:12.3f}  (new)")
+            continue
+        change = (value - reference) / reference if reference else 0
+        regression = change > threshold
+        regressions += regression
+        flag = "  REGRESSION" if regression else ""
+        print(f"{name:40} {value:12.3f} {reference:12.3f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main() -> None:
+    """Run the benchmarks from command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "-n", "--iterations", type=int, default=50, help="Measured calls."
+    )
+    parser.add_argument("-o", "--output", help="Save the results to this file.")
+    parser.add_argument("--compare", help="Baseline results to compare with.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative increase reported as a regression, default 0.2.",
+    )
+    options = parser.parse_args()
+
+    results = run_benchmarks(options.iterations)
+    results.update(
+        {
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        }
+    )
+    if options.output:
+        with open(options.output, mode="w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+    if options.compare:
+        with open(options.compare, mode="r", encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        sys.exit(1 if compare(results, baseline, options.threshold) else 0)
+    if not options.output:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""Local stand-ins for traffic_info's external services."""
+import functools
+import http.server
+import random
+import re
+import socketserver
+import struct
+import threading
+import time
+import zlib
+
+# Colors found on a Google Maps screenshot: background, roads and traffic
+PALETTE = [
+    (232, 234, 237),
+    (255, 255, 255),
+    (170, 218, 255),
+    (99, 214, 104),
+    (255, 151, 77),
+    (242, 60, 50),
+    (129, 31, 31),
+]
+
+
+@functools.lru_cache(maxsize=16)
+def make_png(width: int, height: int, seed: int = 0) -> bytes:
+    """
+    Make a PNG image looking like a map screenshot.
+
+    Args:
+        width: Image's width.
+        height: Image's height.
+        seed: Random seed, the same seed gives the same image.
+
+    Returns:
+        The PNG image.
+
+    """
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(height):
+        row = bytearray(b"\x00")
+        while len(row) < width * 3 + 1:
+            row += bytes(rng.choice(PALETTE)) * rng.randint(1, 40)
+        rows.append(bytes(row[: width * 3 + 1]))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        crc = zlib.crc32(kind + data)
+        return b"".join(
+            [struct.pack(">I", len(data)), kind, data, struct.pack(">I", crc)]
+        )
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", header),
+            chunk(b"IDAT", zlib.compress(b"".join(rows), 6)),
+            chunk(b"IEND", b""),
+        ]
+    )
+
+
+class FakeWebDriver:
+    """
+    FakeWebDriver class, a stand-in for selenium's Chrome webdriver.
+
+    The map is always ready and screenshots are canned PNG images, set
+    load_delay to simulate the time to load the map page.
+    """
+
+    png: bytes = None
+    load_delay: float = 0
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize a FakeWebDriver object, arguments are ignored."""
+        self.width: int = 800
+        self.height: int = 600
+        self.url: str = None
+
+    def set_window_size(self, width: int, height: int) -> None:
+        """Set the window's size."""
+        self.width = width
+        self.height = height
+
+    def get(self, url: str) -> None:
+        """Load a page."""
+        time.sleep(self.load_delay)
+        self.url = url
+
+    def execute_script(self, script: str, *args) -> bool:
+        """Run a script, the map is always ready and can always be moved."""
+        return True
+
+    def get_log(self, log_type: str) -> list:
+        """Get the new log entries, nothing is logged."""
+        return []
+
+    def execute_cdp_cmd(self, cmd: str, cmd_args: dict) -> dict:
+        """Run a Chrome DevTools Protocol command."""
+        return {}
+
+    def get_screenshot_as_png(self) -> bytes:
+        """Get the canned screenshot."""
+        if FakeWebDriver.png is None:
+            FakeWebDriver.png = make_png(self.width, self.height)
+        return FakeWebDriver.png
+
+    def save_screenshot(self, path: str) -> bool:
+        """Save the canned screenshot."""
+        with open(path, "wb") as screenshot_file:
+            screenshot_file.write(self.get_screenshot_as_png())
+        return True
+
+    def quit(self) -> None:
+        """Quit the browser."""
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP session accepting every message."""
+
+    def reply(self, line: str) -> None:
+        """Send a reply line."""
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self) -> None:
+        """Handle a SMTP session."""
+        time.sleep(self.server.greeting_delay)
+        self.reply("220 localhost SMTP sink")
+        message = None
+        for raw_line in self.rfile:
+            if message is not None:
+                if raw_line in (b".\r\n", b".\n"):
+                    self.server.record(b"".join(message))
+                    message = None
+                    self.reply("250 OK")
+                else:
+                    message.append(raw_line)
+                continue
+            command = raw_line.split(b" ", 1)[0].strip().upper()
+            if command == b"EHLO":
+                self.reply("250-localhost")
+                self.reply("250 8BITMIME")
+            elif command == b"DATA":
+                message = []
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    SMTPSink class, an in-process SMTP server discarding messages.
+
+    Use it as a context manager, the server listens on a random local port.
+
+    Args:
+        greeting_delay: Seconds to wait before greeting a new connection, to
+        simulate a remote server's handshake, default 0.
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, greeting_delay: float = 0) -> None:
+        """Initialize a SMTPSink object on a random local port."""
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.greeting_delay: float = greeting_delay
+        self.messages: int = 0
+        self.bytes: int = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        """The port the server listens on."""
+        return self.server_address[1]
+
+    def record(self, message: bytes) -> None:
+        """Count a received message."""
+        with self._lock:
+            self.messages += 1
+            self.bytes += len(message)
+
+    def __enter__(self) -> "SMTPSink":
+        """Start serving in a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
+
+
+class _TileHandler(http.server.BaseHTTPRequestHandler):
+    """Serve canned tiles for /LAYER/Z/X/Y.png paths."""
+
+    protocol_version = "HTTP/1.1"
+    _path = re.compile(r"^/(\w+)/(\d+)/(\d+)/(\d+)\.png$")
+
+    def do_GET(self) -> None:  # noqa: N802
+        """Send a tile, base tiles are opaque, other layers are missing."""
+        match = self._path.match(self.path)
+        if match is None or match.group(1) != "base":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        x, y = int(match.group(3)), int(match.group(4))
+        body = make_png(self.server.tile_size, self.server.tile_size, (x + y) % 8)
+        self.server.record()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        """Do not log requests."""
+
+
+class TileServer(http.server.ThreadingHTTPServer):
+    """
+    TileServer class, an in-process XYZ tile server.
+
+    Use it as a context manager, the server listens on a random local port
+    and serves canned tiles at url_template("base"), other layers are empty.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, tile_size: int = 256) -> None:
+        """Initialize a TileServer object on a random local port."""
+        super().__init__(("127.0.0.1", 0), _TileHandler)
+        self.tile_size: int = tile_size
+        self.requests: int = 0
+        self._lock = threading.Lock()
+
+    def url_template(self, layer: str) -> str:
+        """Get the XYZ URL template of a layer."""
+        return (
+            f"http://127.0.0.1:{self.server_address[1]}/{layer}/{{z}}/{{x}}/{{y}}.png"
+        )
+
+    def record(self) -> None:
+        """Count a served tile."""
+        with self._lock:
+            self.requests += 1
+
+    def __enter__(self) -> "TileServer":
+        """Start serving in a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
@@ -26,7 +26,9 @@ AUTHOR = "Nicolas Rouanet"
 REQUIRES_PYTHON = ">=3.10.0"
 VERSION = None
 
-REQUIRED = ["configargparse", "jinja2", "selenium", "workalendar"]
+REQUIRED = ["configargparse", "jinja2", "selenium>=4", "workalendar"]
+
+IMAGING_REQUIRED = ["numpy", "Pillow"]
 
 TESTS_REQUIRED = [
     "bandit",
@@ -38,6 +40,7 @@ TESTS_REQUIRED = [
     "flake8-import-order",
     "pep8-naming",
     "pylint",
+    "pytest",
 ]
 
 DEV_REQUIRED = [
@@ -79,7 +82,13 @@ setup(
     install_requires=REQUIRED,
     include_package_data=True,
     scripts=["bin/traffic-info", "bin/install_chromedriver.sh"],
-    extras_require={"tests": TESTS_REQUIRED, "dev": DEV_REQUIRED},
+    extras_require={
+        "tests": TESTS_REQUIRED,
+        "dev": DEV_REQUIRED,
+        "congestion": IMAGING_REQUIRED,
+        "images": IMAGING_REQUIRED,
+        "tiles": IMAGING_REQUIRED,
+    },
     cmdclass=CMDCLASS,
     command_options={
         "build_sphinx": {
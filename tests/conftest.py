@@ -0,0 +1,17 @@
+"""Fixtures shared by the tests."""
+import os
+import sys
+
+import pytest
+
+# The local stand-ins of the external services live with the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "benchmarks"))
+
+
+@pytest.fixture
+def tile_server():
+    """Serve canned XYZ tiles on a random local port."""
+    from standins import TileServer  # pylint: disable=import-outside-toplevel
+
+    with TileServer() as server:
+        yield server
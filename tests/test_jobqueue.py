@@ -0,0 +1,125 @@
+"""Tests of the jobs sharing between hosts."""
+import multiprocessing
+import os
+import signal
+import time
+
+from traffic_info.jobqueue import JobQueue
+
+WINDOW = "2024-01-08T07:30:00"
+
+
+def _send(log_path: str, job: str, worker: str) -> None:
+    """Record a job's email as sent."""
+    fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, f"{job} {worker}\n".encode())
+    finally:
+        os.close(fd)
+
+
+def _sent(log_path: str) -> list:
+    """Get the jobs' emails sent, as (job, worker) pairs."""
+    try:
+        with open(log_path, encoding="utf-8") as log:
+            return [tuple(line.split()) for line in log]
+    except FileNotFoundError:
+        return []
+
+
+def _worker(db_path: str, log_path: str, worker: str, jobs: list) -> None:
+    """Process the window's jobs, as a host would."""
+
+    def run(job, confirm):
+        time.sleep(0.05)
+        if not confirm():
+            return False
+        _send(log_path, job, worker)
+        return True
+
+    JobQueue(db_path, lease_time=5, poll_interval=0.1, worker=worker).process(
+        WINDOW, jobs, run, time.time() + 30
+    )
+
+
+def _slow_worker(db_path: str, log_path: str, marker_path: str, job: str) -> None:
+    """Claim the job, and send its email after a while."""
+
+    def run(claimed, confirm):
+        with open(marker_path, "w", encoding="utf-8"):
+            pass
+        time.sleep(0.5)
+        if not confirm():
+            return False
+        _send(log_path, claimed, "slow")
+        return True
+
+    queue = JobQueue(db_path, lease_time=1, poll_interval=0.1, worker="slow")
+    done = queue.process(WINDOW, [job], run, time.time() + 30)
+    os._exit(len(done))  # pylint: disable=protected-access
+
+
+def test_process_runs_each_job_once(tmp_path):
+    """Several workers processing a window run each job once."""
+    db_path, log_path = str(tmp_path / "queue.sqlite"), str(tmp_path / "sent.log")
+    jobs = [f"job{index}" for index in range(20)]
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_worker, args=(db_path, log_path, f"w{index}", jobs))
+        for index in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    sent = _sent(log_path)
+    assert sorted(job for job, _ in sent) == sorted(jobs)
+
+
+def test_complete_requires_lease(tmp_path):
+    """A worker whose job was taken over can't mark it as done."""
+    db_path = str(tmp_path / "queue.sqlite")
+    first = JobQueue(db_path, lease_time=0.1, worker="first")
+    second = JobQueue(db_path, lease_time=0.1, worker="second")
+    assert first.claim(WINDOW, "job")
+    time.sleep(0.2)
+    assert second.claim(WINDOW, "job")
+
+    assert not first.renew(WINDOW, "job")
+    assert not first.complete(WINDOW, "job")
+    assert second.pending(WINDOW, ["job"]) == ["job"]
+    assert second.complete(WINDOW, "job")
+    assert second.pending(WINDOW, ["job"]) == []
+
+
+def test_lost_lease_suppresses_send(tmp_path):
+    """A stalled worker doesn't send the email of a job taken over."""
+    db_path, log_path = str(tmp_path / "queue.sqlite"), str(tmp_path / "sent.log")
+    marker_path = str(tmp_path / "claimed")
+    context = multiprocessing.get_context("fork")
+    slow = context.Process(
+        target=_slow_worker, args=(db_path, log_path, marker_path, "job")
+    )
+    slow.start()
+    try:
+        while not os.path.exists(marker_path):
+            time.sleep(0.01)
+        # The host stalls, e.g. swapping, until its lease expires
+        os.kill(slow.pid, signal.SIGSTOP)
+        time.sleep(1.5)
+
+        def run(job, confirm):
+            assert confirm()
+            _send(log_path, job, "fast")
+            return True
+
+        fast = JobQueue(db_path, lease_time=1, poll_interval=0.1, worker="fast")
+        assert fast.process(WINDOW, ["job"], run) == ["job"]
+    finally:
+        os.kill(slow.pid, signal.SIGCONT)
+        slow.join(10)
+
+    assert slow.exitcode == 0
+    assert _sent(log_path) == [("job", "fast")]
@@ -0,0 +1,85 @@
+"""Tests of the browserless map rendering."""
+import io
+import socket
+
+import pytest
+
+from traffic_info import Location
+from traffic_info.exceptions import TileFetchError
+from traffic_info.tiles import TileRenderer, project
+
+numpy = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+
+def _pixels(data: bytes) -> numpy.ndarray:
+    """Decode a PNG image to a RGB array."""
+    with Image.open(io.BytesIO(data)) as image:
+        return numpy.asarray(image.convert("RGB"))
+
+
+def test_project():
+    """The world map's center and edges are projected on its pixels."""
+    assert project(0, 0, 0) == pytest.approx((128, 128))
+    assert project(0, -180, 1) == pytest.approx((0, 256))
+    assert project(90, 180, 1) == pytest.approx((512, 0), abs=1e-6)
+
+
+def test_tiles():
+    """The tiles covering a viewport are listed row by row."""
+    renderer = TileRenderer([])
+
+    assert renderer.tiles(Location(0, 0, 1), 512, 512) == (
+        [(0, 0, 1), (1, 0, 1), (0, 1, 1), (1, 1, 1)],
+        2,
+        (0, 0),
+    )
+    tiles, columns, offset = renderer.tiles(Location(0, 0, 2), 300, 200)
+    # The viewport's top left corner is at (362, 412) on the world map
+    assert tiles == [(1, 1, 2), (2, 1, 2), (1, 2, 2), (2, 2, 2)]
+    assert (columns, offset) == (2, (106, 156))
+
+
+def test_render(tile_server):
+    """A map is assembled from its tiles, the missing layers are skipped."""
+    from standins import make_png  # pylint: disable=import-outside-toplevel
+
+    with TileRenderer(
+        [tile_server.url_template("base"), tile_server.url_template("traffic")]
+    ) as renderer:
+        data = renderer.render(Location(0, 0, 1), 512, 512)
+
+    expected = numpy.vstack(
+        [
+            numpy.hstack([_pixels(make_png(256, 256, (x + y) % 8)) for x in range(2)])
+            for y in range(2)
+        ]
+    )
+    assert numpy.array_equal(_pixels(data), expected)
+    assert tile_server.requests == 4
+
+
+def test_render_outside_map(tile_server):
+    """The areas beyond the map's poles are filled with the background."""
+    background = (1, 2, 3)
+    with TileRenderer(
+        [tile_server.url_template("base")], background=background
+    ) as renderer:
+        pixels = _pixels(renderer.render(Location(85, 0, 0), 256, 512))
+
+    assert pixels.shape == (512, 256, 3)
+    assert (pixels[:100] == background).all()
+    assert not (pixels[300:] == background).all()
+
+
+def test_render_unreachable():
+    """A tile server which can't be reached fails the rendering."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    url_template = f"http://127.0.0.1:{port}/base/{{z}}/{{x}}/{{y}}.png"
+
+    with TileRenderer([url_template], timeout=1) as renderer, pytest.raises(
+        TileFetchError
+    ):
+        renderer.render(Location(0, 0, 1), 256, 256)
@@ -1,19 +1,66 @@
-"""traffic_info module."""
+"""
+traffic_info module.
+
+Heavy dependencies (ConfigArgParse, Selenium, Jinja2 and workalendar) are
+imported on the code paths which need them, so a run on a holiday exits fast.
+"""
+
+import argparse
+import contextlib
 import datetime
+import functools
 import logging
 import os
+import signal
 import sys
-
-import configargparse
-
-from selenium.common.exceptions import WebDriverException
-
-from workalendar.registry import registry
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Tuple
 
 from .__version__ import __version__
-from .core import Location, MapScreenshot, SMTPServer, send_email
-from .exceptions import NotExecutableError, WebdriverNotFoundError
-from .utils import get_chromedriver_path
+from .cache import ScreenshotCache
+from .congestion import Congestion, CongestionGate
+from .core import (
+    Capture,
+    DEFAULT_HEIGHT,
+    DEFAULT_WIDTH,
+    Location,
+    MapScreenshot,
+    Recipient,
+    SMTPServer,
+    Viewport,
+    build_email,
+    send_email,
+    send_emails,
+)
+from .daemon import CronSchedule, Daemon, Job
+from .delivery import Delivery
+from .exceptions import (
+    DeadlineExceededError,
+    InvalidCountryCodeError,
+    JobTimeoutError,
+    NotExecutableError,
+    TileFetchError,
+    WebdriverNotFoundError,
+)
+from .history import HistoryStore
+from .holidays import HolidayIndex
+from .imaging import FORMATS, ImageProcessor
+from .jobqueue import JobQueue
+from .metrics import Metrics, metrics
+from .outbox import Outbox, OutboxSender
+from .pool import ScreenshotPool
+from .profiling import ImportProfiler
+from .tiles import TileRenderer
+from .utils import (
+    deadline,
+    get_chromedriver_path,
+    set_template_bytecode_cache,
+)
+
+# Seconds between two writes of the metrics file by the serve command
+_SERVE_METRICS_INTERVAL = 60
 
 
 def check_webdriver_path(webdriver: str = None) -> str:
@@ -38,9 +85,148 @@ def check_webdriver_path(webdriver: str = None) -> str:
     return webdriver
 
 
-def parse_args() -> configargparse.Namespace:
+def point_type(value: str) -> Tuple[float, float]:
+    """
+    Parse a route point given as LATITUDE,LONGITUDE.
+
+    Args:
+        value: The point string.
+
+    Returns:
+        The parsed point.
+
+    """
+    parts = value.split(",")
+    try:
+        if len(parts) == 2:
+            return float(parts[0]), float(parts[1])
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(
+        f"invalid route point '{value}', expected LATITUDE,LONGITUDE"
+    )
+
+
+def view_type(value: str) -> Tuple[int, int, int]:
+    """
+    Parse an additional view given as ZOOM[:WIDTHxHEIGHT].
+
+    Args:
+        value: The view string.
+
+    Returns:
+        The parsed zoom, width and height, width and height are None if not
+        specified.
+
+    """
+    zoom, _, size = value.partition(":")
+    try:
+        if not size:
+            return int(zoom), None, None
+        width, height = size.lower().split("x")
+        return int(zoom), int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid view '{value}', expected ZOOM[:WIDTHxHEIGHT]"
+        ) from None
+
+
+def crop_type(value: str) -> Tuple[int, int, int, int]:
+    """
+    Parse crop margins given as LEFT,TOP,RIGHT,BOTTOM.
+
+    Args:
+        value: The margins string.
+
+    Returns:
+        The parsed left, top, right and bottom margins.
+
+    """
+    try:
+        left, top, right, bottom = (int(margin) for margin in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid crop '{value}', expected LEFT,TOP,RIGHT,BOTTOM"
+        ) from None
+    return left, top, right, bottom
+
+
+def location_type(value: str) -> Location:
+    """
+    Parse a location given as LATITUDE,LONGITUDE[,ZOOM][;ROUTE].
+
+    ROUTE is a semicolon-separated list of LATITUDE,LONGITUDE points.
+
+    Args:
+        value: The location string.
+
+    Returns:
+        The parsed location.
+
+    """
+    location, *route = value.split(";")
+    parts = location.split(",")
+    try:
+        if len(parts) == 2:
+            result = Location(float(parts[0]), float(parts[1]))
+        elif len(parts) == 3:
+            result = Location(float(parts[0]), float(parts[1]), int(parts[2]))
+        else:
+            raise ValueError(location)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid location '{value}', expected LATITUDE,LONGITUDE[,ZOOM][;ROUTE]"
+        ) from None
+    if route:
+        result.route = [point_type(point.strip()) for point in route]
+    return result
+
+
+def job_type(value: str) -> Job:
+    """
+    Parse a daemon job given as CRON|LATITUDE,LONGITUDE[,ZOOM]|EMAIL_TO[|COUNTRY_CODES].
+
+    COUNTRY_CODES is a comma-separated list of country codes to skip holidays.
+
+    Args:
+        value: The job string.
+
+    Returns:
+        The parsed job.
+
+    """
+    parts = value.split("|")
+    if len(parts) not in (3, 4):
+        raise argparse.ArgumentTypeError(
+            f"invalid job '{value}', "
+            "expected CRON|LATITUDE,LONGITUDE[,ZOOM]|EMAIL_TO[|COUNTRY_CODES]"
+        )
+    try:
+        schedule = CronSchedule(parts[0])
+        # e.g. "0 0 31 2 *" is valid but never fires
+        schedule.next_fire(datetime.datetime.now())
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc)) from exc
+    country_codes = None
+    if len(parts) == 4:
+        country_codes = [code.strip() for code in parts[3].split(",") if code.strip()]
+    return Job(
+        schedule, location_type(parts[1].strip()), parts[2].strip(), country_codes
+    )
+
+
+def parse_args() -> argparse.Namespace:
     """Parse command-line arguments."""
+    import configargparse  # pylint: disable=import-outside-toplevel
+
     parser = configargparse.ArgParser()
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["send", "serve"],
+        default="send",
+        help="Send the maps by email, the default, or serve them over HTTP.",
+    )
     parser.add_argument(
         "-c", "--config-file", is_config_file=True, help="Config file path."
     )
@@ -49,23 +235,52 @@ def parse_args() -> configargparse.Namespace:
     parser.add_argument(
         "-l",
         "--latitude",
-        required=True,
         type=float,
         help="Latitude of the center point of the map.",
     )
     parser.add_argument(
         "-L",
         "--longitude",
-        required=True,
         type=float,
         help="Longitude of the center point of the map.",
     )
     parser.add_argument("-z", "--zoom", type=int, help="Google Maps zoom level.")
     parser.add_argument(
-        "-f", "--email_from", required=True, help="Email sender’s address."
+        "--locations",
+        nargs="+",
+        type=location_type,
+        default=[],
+        metavar="LATITUDE,LONGITUDE[,ZOOM][;ROUTE]",
+        help="Additional maps to send, rendered in the same browser session. "
+        "ROUTE is a list of LATITUDE,LONGITUDE points separated by semicolons.",
+    )
+    parser.add_argument(
+        "--views",
+        nargs="+",
+        type=view_type,
+        default=[],
+        metavar="ZOOM[:WIDTHxHEIGHT]",
+        help="Additional maps of each location at other zoom levels or sizes, "
+        "captured from the same page, e.g. '12 16:640x480'.",
+    )
+    parser.add_argument(
+        "--route",
+        nargs="+",
+        type=point_type,
+        metavar="LATITUDE,LONGITUDE",
+        help="Route points, its traffic conditions are summarized in the email.",
     )
+    parser.add_argument("-f", "--email_from", help="Email sender’s address.")
     parser.add_argument(
-        "-t", "--email_to", required=True, help="Email recipient’s address."
+        "-t",
+        "--email_to",
+        nargs="+",
+        help="Email recipients’ addresses, the maps are encoded once for all.",
+    )
+    parser.add_argument(
+        "--bcc",
+        action="store_true",
+        help="Send a single email to all the recipients without listing them.",
     )
     parser.add_argument(
         "-s",
@@ -82,76 +297,697 @@ def parse_args() -> configargparse.Namespace:
     parser.add_argument(
         "-w", "--smtp_password", type=str, help="SMTP server’s password."
     )
+    parser.add_argument(
+        "--smtp_connect_timeout",
+        type=float,
+        default=30,
+        help="Maximum time in seconds to wait for the SMTP server while connecting.",
+    )
+    parser.add_argument(
+        "--smtp_send_timeout",
+        type=float,
+        default=60,
+        help="Maximum time in seconds to wait for the SMTP server while sending.",
+    )
+    parser.add_argument(
+        "--outbox_dir",
+        help="Queue the emails in this directory and send them in background, "
+        "the emails which could not be sent are retried on the next runs.",
+    )
+    parser.add_argument(
+        "--smtp_connections",
+        type=int,
+        default=2,
+        help="Maximum number of connections to the SMTP server to send the "
+        "outbox's emails.",
+    )
+    parser.add_argument(
+        "--max_attempts",
+        type=int,
+        default=10,
+        help="Maximum number of attempts to send an outbox's email before it is "
+        "moved to the dead letters.",
+    )
     parser.add_argument(
         "-W", "--screenshot_width", type=int, help="Screenshot’s width."
     )
     parser.add_argument(
         "-H", "--screenshot_height", type=int, help="Screenshot’s height."
     )
+    parser.add_argument(
+        "--device_scale_factor",
+        type=float,
+        help="Browser’s device pixel ratio, e.g. 2 for retina screenshots.",
+    )
+    parser.add_argument(
+        "--image_format",
+        choices=list(FORMATS),
+        help="Screenshots’ format, PNG images are losslessly optimized.",
+    )
+    parser.add_argument(
+        "--image_quality", type=int, help="JPEG and WebP quality from 1 to 100."
+    )
+    parser.add_argument(
+        "--image_colors",
+        type=int,
+        help="Reduce PNG screenshots to a palette of this many colors.",
+    )
+    parser.add_argument(
+        "--image_crop",
+        type=crop_type,
+        metavar="LEFT,TOP,RIGHT,BOTTOM",
+        help="Pixels removed from each edge of the screenshots.",
+    )
+    parser.add_argument(
+        "--image_scale",
+        type=float,
+        help="Screenshots’ pixels per CSS pixel, e.g. 1 to downscale retina ones.",
+    )
+    parser.add_argument(
+        "--in_memory",
+        action="store_true",
+        help="Keep the screenshots in memory instead of temporary files.",
+    )
+    parser.add_argument(
+        "--ready_timeout",
+        type=float,
+        help="Maximum time in seconds to wait for the map to be drawn.",
+    )
+    parser.add_argument(
+        "--driver_timeout",
+        type=float,
+        help="Maximum time in seconds to start the browser, it is killed beyond.",
+    )
+    parser.add_argument(
+        "--page_load_timeout",
+        type=float,
+        help="Maximum time in seconds to load the map, the browser is killed beyond.",
+    )
+    parser.add_argument(
+        "--screenshot_timeout",
+        type=float,
+        help="Maximum time in seconds to take the screenshot, the browser is "
+        "killed beyond.",
+    )
+    parser.add_argument(
+        "--job_timeout",
+        type=float,
+        help="Maximum time in seconds of a run or of a daemon's job, the browsers "
+        "are killed beyond.",
+    )
+    parser.add_argument(
+        "--max_browsers",
+        type=int,
+        help="Maximum number of browsers taking screenshots at the same time.",
+    )
+    parser.add_argument(
+        "--browser_memory",
+        type=int,
+        help="Estimated memory used by one browser in MiB, limits --max_browsers.",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        help="Directory to keep the browser profiles and their cache between runs.",
+    )
+    parser.add_argument(
+        "--profile_size",
+        type=int,
+        default=200,
+        help="Maximum size of a browser profile in MiB.",
+    )
+    parser.add_argument(
+        "--blocked_urls",
+        nargs="+",
+        metavar="URL_PATTERN",
+        help="URL patterns the browser must not load, e.g. '*.woff2'.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory to cache screenshots, shared by all recipients and runs.",
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=float,
+        default=300,
+        help="Number of seconds a cached screenshot can be reused.",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=100,
+        help="Maximum size of the screenshots cache in MiB.",
+    )
+    parser.add_argument(
+        "--history_dir",
+        help="Directory to record every captured map, for trend analysis.",
+    )
+    parser.add_argument(
+        "--history_days",
+        type=float,
+        help="Number of days the recorded maps are kept, forever by default.",
+    )
+    parser.add_argument(
+        "--tile_urls",
+        nargs="+",
+        metavar="URL_TEMPLATE",
+        help="Render the maps from these XYZ tile layers instead of a browser, "
+        "e.g. 'https://tile.example.com/{z}/{x}/{y}.png'.",
+    )
+    parser.add_argument(
+        "--tile_connections",
+        type=int,
+        default=8,
+        help="Maximum number of concurrent tile requests.",
+    )
+    parser.add_argument(
+        "--congestion_file",
+        help="Score the traffic and store the scores in this file, emails are "
+        "only sent when the traffic changed.",
+    )
+    parser.add_argument(
+        "--congestion_threshold",
+        type=float,
+        default=5,
+        help="Minimum change of the congestion score (0-100) to send the map.",
+    )
+    parser.add_argument(
+        "--unchanged",
+        choices=["skip", "text"],
+        default="skip",
+        help="Skip the email or send it without the map when the traffic did "
+        "not change.",
+    )
+    parser.add_argument(
+        "--template_cache_dir",
+        help="Directory to store the compiled templates between runs.",
+    )
     parser.add_argument(
         "-C",
         "--country_code",
         type=str,
-        help="Country code(ISO 3166-1/ISO 3166-2) to avoid notifications on holidays.",
+        nargs="+",
+        help="Country codes(ISO 3166-1/ISO 3166-2) to avoid notifications on holidays.",
+    )
+    parser.add_argument(
+        "--holidays_cache_dir",
+        help="Directory to store the holidays tables, default ~/.cache/traffic_info.",
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="Report the time spent importing each module since the command "
+        "started.",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        help="Write the phases' timings to this Prometheus textfile collector file, "
+        "every minute with the serve command.",
+    )
+    parser.add_argument(
+        "--log_metrics",
+        action="store_true",
+        help="Log the phases' timings as JSON lines.",
+    )
+    parser.add_argument(
+        "-D",
+        "--daemon",
+        action="store_true",
+        help="Run as a daemon and send the emails of the jobs on schedule.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        nargs="+",
+        type=job_type,
+        default=[],
+        metavar="CRON|LATITUDE,LONGITUDE[,ZOOM]|EMAIL_TO",
+        help="Daemon's jobs, e.g. "
+        "'45 16 * * 1-5|43.6037834,1.4402123|user@example.com'.",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        default=60,
+        help="Seconds to start the browser and SMTP connection before a daemon's job.",
+    )
+    parser.add_argument(
+        "--max_lateness",
+        type=float,
+        default=300,
+        help="Seconds after which a daemon's job missed, e.g. while the host was "
+        "suspended, is dropped instead of being run late.",
+    )
+    parser.add_argument(
+        "--job_queue",
+        help="Share the jobs with the other hosts using this SQLite database on "
+        "shared storage, each job is run by one host.",
+    )
+    parser.add_argument(
+        "--lease_time",
+        type=float,
+        default=120,
+        help="Seconds after which a job claimed by a host which stopped "
+        "answering is run by another one.",
+    )
+    parser.add_argument(
+        "--queue_window",
+        type=float,
+        default=300,
+        help="Runs of the hosts started in the same period of this number of "
+        "seconds, e.g. from 07:30:00 to 07:34:59 by default, share their jobs, "
+        "without the daemon mode.",
+    )
+
+    parser.add_argument(
+        "--http_host",
+        default="127.0.0.1",
+        help="Address the serve command listens on.",
+    )
+    parser.add_argument(
+        "--http_port",
+        type=int,
+        default=8080,
+        help="Port the serve command listens on.",
+    )
+    parser.add_argument(
+        "--max_age",
+        type=float,
+        default=60,
+        help="Seconds a map is served before it is captured again.",
+    )
+
+    options = parser.parse_args()
+    if options.command == "serve":
+        return options
+    if options.email_from is None:
+        parser.error("the following arguments are required: -f/--email_from")
+    if options.daemon:
+        if not options.jobs:
+            parser.error("the daemon mode requires jobs")
+    else:
+        if not options.locations and (
+            options.latitude is None or options.longitude is None
+        ):
+            parser.error(
+                "the latitude and longitude or a list of locations are required"
+            )
+        if options.email_to is None:
+            parser.error("the following arguments are required: -t/--email_to")
+    return options
+
+
+def run(profiler: ImportProfiler = None) -> None:
+    """
+    Run traffic info from command line.
+
+    Args:
+        profiler: The started profiler of --startup-profile, e.g. installed by
+        the traffic-info command before importing the package.
+
+    """
+    with contextlib.ExitStack() as stack:
+        if profiler is not None:
+            stack.push(profiler)
+        elif "--startup-profile" in sys.argv[1:]:
+            # The import hook slows down every import, it is only installed on
+            # demand and before parsing the arguments to measure configargparse
+            profiler = stack.enter_context(ImportProfiler())
+        options = parse_args()
+        if profiler is None and options.startup_profile:
+            # Set in a configuration file, only the next imports are measured
+            profiler = stack.enter_context(ImportProfiler())
+        if profiler is not None:
+            stack.callback(lambda: print(profiler.report(), file=sys.stderr))
+        _run(options)
+
+
+def _sent(future: Future, location: Location) -> bool:
+    """Wait for a location's email, log the failure, False if it failed."""
+    # pylint: disable=import-outside-toplevel
+    from selenium.common.exceptions import WebDriverException
+
+    try:
+        future.result()
+    except JobTimeoutError:
+        raise
+    except (DeadlineExceededError, TileFetchError, WebDriverException) as exc:
+        logging.getLogger(__name__).error(
+            "Unable to send the map of %s(%s)", location, exc.msg
+        )
+        return False
+    return True
 
 
-def run() -> None:
-    """Run traffic info from command line."""
+def _run_shared(
+    queue: JobQueue,
+    window: float,
+    jobs: Dict[str, List[Viewport]],
+    submit: Callable[[List[Viewport], Callable[[], bool]], Future],
+    workers: int,
+) -> int:
+    """Run the jobs of this run's window not run by the other hosts, count failures."""
+    # The hosts' runs started in the same window share its jobs
+    now = time.time()
+    window_start = datetime.datetime.fromtimestamp(now // window * window)
+
+    failures = []
+
+    def run_job(key: str, confirm: Callable[[], bool]) -> bool:
+        future = submit(jobs[key], confirm)
+        if not _sent(future, jobs[key][0].location):
+            # The job is released, another host may run it
+            failures.append(key)
+            return False
+        return future.result()
+
+    # Each thread claims one job at a time, so the faster hosts run more jobs
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                queue.process,
+                window_start.isoformat(),
+                list(jobs),
+                run_job,
+                now + window,
+            )
+            for _ in range(workers)
+        ]
+        for future in as_completed(futures):
+            future.result()
+    return len(failures)
+
+
+def _write_metrics(path: str) -> None:
+    """Write the metrics for Prometheus, log the failure."""
+    try:
+        metrics.write_textfile(path)
+    except OSError as exc:
+        logging.getLogger(__name__).error("Unable to write metrics(%s)", exc)
+
+
+def _serve(
+    options: argparse.Namespace,
+    locations: List[Location],
+    pool_params: Dict[str, Any],
+    screenshot_params: Dict[str, Any],
+) -> None:
+    """Serve the maps over HTTP until the process is stopped."""
+    # pylint: disable=import-outside-toplevel
+    from selenium.common.exceptions import WebDriverException
+
+    from .server import MapServer
+
+    logger = logging.getLogger(__name__)
+    screenshot_params["in_memory"] = True
+    # The clients choose the locations, one value per location would grow
+    # without bound
+    metrics.dropped_labels.add("location")
+    with ScreenshotPool(**pool_params, **screenshot_params) as pool:
+        try:
+            # The browsers are started with the first location's map loaded
+            pool.prepare(locations[0] if locations else None)
+        except (DeadlineExceededError, TileFetchError, WebDriverException) as exc:
+            logger.error(exc.msg)
+            sys.exit(1)
+        with MapServer(
+            pool, (options.http_host, options.http_port), options.max_age
+        ) as server:
+            # shutdown() waits for serve_forever() so it runs in another thread
+            def stop(*_):
+                threading.Thread(target=server.shutdown).start()
+
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+            logger.info(
+                "Serving the maps on http://%s:%s/map", *server.server_address[:2]
+            )
+            stopped = threading.Event()
+
+            def export_metrics():
+                while not stopped.wait(_SERVE_METRICS_INTERVAL):
+                    _write_metrics(options.metrics_file)
+
+            exporter = None
+            if options.metrics_file:
+                exporter = threading.Thread(
+                    target=export_metrics, name="metrics", daemon=True
+                )
+                exporter.start()
+            try:
+                server.serve_forever()
+            finally:
+                if exporter is not None:
+                    stopped.set()
+                    exporter.join()
+                    _write_metrics(options.metrics_file)
+    if "renderer" in screenshot_params:
+        screenshot_params["renderer"].close()
+
+
+def _run(options: argparse.Namespace) -> None:
+    """Run traffic info with the given options."""
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
 
-    options = parse_args()
+    if options.metrics_file or options.log_metrics:
+        metrics.enabled = True
+    if options.log_metrics:
+        metrics_logger = logging.getLogger("traffic_info.metrics")
+        metrics_logger.setLevel(logging.INFO)
+        metrics_logger.addHandler(logging.StreamHandler())
+
+    holidays = HolidayIndex(options.holidays_cache_dir)
     if options.country_code:
-        calendar_class = registry.get(options.country_code.upper())
-        if not calendar_class:
-            logger.error("Invalid country code")
+        try:
+            holiday = holidays.any_holiday(options.country_code, datetime.date.today())
+        except InvalidCountryCodeError as exc:
+            logger.error(exc.msg)
             sys.exit(1)
-        calendar = calendar_class()
-        if calendar.is_holiday(datetime.datetime.now()):
+        if holiday and not options.daemon and options.command == "send":
             # Enjoy your holiday! :)
             sys.exit()
 
-    location_keys = ["latitude", "longitude", "zoom"]
-    screenshot_keys = ["api_key", "webdriver_path", "width", "height"]
+    if options.template_cache_dir:
+        set_template_bytecode_cache(options.template_cache_dir)
+
+    locations = list(options.locations)
+    if options.latitude is not None and options.longitude is not None:
+        location_params = {
+            k: v
+            for k, v in vars(options).items()
+            if v is not None and k in ["latitude", "longitude", "zoom", "route"]
+        }
+        locations.insert(0, Location(**location_params))
 
-    location_params = {
-        k: v for k, v in vars(options).items() if v is not None and k in location_keys
-    }
     screenshot_params = {
-        k: v for k, v in vars(options).items() if v is not None and k in screenshot_keys
+        "api_key": options.api_key,
+        "width": options.screenshot_width,
+        "height": options.screenshot_height,
+        "in_memory": options.in_memory,
+        "ready_timeout": options.ready_timeout,
+        "profile_dir": options.profile_dir,
+        "profile_size": options.profile_size,
+        "blocked_urls": options.blocked_urls,
+        "device_scale_factor": options.device_scale_factor,
+        "driver_timeout": options.driver_timeout,
+        "page_load_timeout": options.page_load_timeout,
+        "screenshot_timeout": options.screenshot_timeout,
     }
-    try:
-        screenshot_params["webdriver_path"] = check_webdriver_path(
-            options.webdriver_path
+    screenshot_params = {k: v for k, v in screenshot_params.items() if v is not None}
+    image_params = {
+        "image_format": options.image_format,
+        "quality": options.image_quality,
+        "colors": options.image_colors,
+        "crop": options.image_crop,
+        "scale": options.image_scale,
+    }
+    image_params = {k: v for k, v in image_params.items() if v is not None}
+    if image_params:
+        try:
+            screenshot_params["processor"] = ImageProcessor(**image_params)
+        except ValueError as exc:
+            logger.error(exc)
+            sys.exit(1)
+    if options.cache_dir:
+        screenshot_params["cache"] = ScreenshotCache(
+            options.cache_dir, options.cache_ttl, options.cache_size
+        )
+    if options.history_dir:
+        history = HistoryStore(options.history_dir, options.history_days)
+        # The maps older than the retention are removed before recording
+        history.prune()
+        screenshot_params["history"] = history
+    if options.tile_urls:
+        screenshot_params["webdriver_path"] = None
+        screenshot_params["renderer"] = TileRenderer(
+            options.tile_urls, max_connections=options.tile_connections
+        )
+    else:
+        try:
+            screenshot_params["webdriver_path"] = check_webdriver_path(
+                options.webdriver_path
+            )
+        except (NotExecutableError, WebdriverNotFoundError) as exc:
+            logger.error(exc.msg)
+            sys.exit(1)
+
+    pool_params = {
+        "max_workers": options.max_browsers,
+        "browser_memory": options.browser_memory,
+    }
+    pool_params = {k: v for k, v in pool_params.items() if v is not None}
+    if options.command == "serve":
+        _serve(options, locations, pool_params, screenshot_params)
+        return
+
+    gate = None
+    if options.congestion_file:
+        gate = CongestionGate(
+            options.congestion_file, options.congestion_threshold, options.unchanged
         )
-    except (NotExecutableError, WebdriverNotFoundError) as exc:
-        logger.error(exc.msg)
-        sys.exit(1)
 
-    location = Location(**location_params)
-    screenshot = MapScreenshot(**screenshot_params)
-    try:
-        screenshot.take(location)
-    except WebDriverException as exc:
-        logger.error(exc.msg)
-        sys.exit(1)
     smtp_server = SMTPServer(
         options.smtp_server,
         options.smtp_port,
         options.smtp_use_ssl,
         options.smtp_login,
         options.smtp_password,
+        connect_timeout=options.smtp_connect_timeout,
+        send_timeout=options.smtp_send_timeout,
     )
-    send_email(
-        options.email_from,
-        options.email_to,
-        location,
-        screenshot,
-        smtp_server,
-    )
+    sender = None
+    if options.outbox_dir:
+        outbox = Outbox(options.outbox_dir, options.max_attempts)
+        sender = OutboxSender(outbox, smtp_server, options.smtp_connections)
+        # The jobs queue the emails, the sender's threads send them
+        sender.start()
+        smtp_server = outbox
+    queue = None
+    if options.job_queue:
+        queue = JobQueue(options.job_queue, options.lease_time)
+    if options.daemon:
+        daemon = Daemon(
+            options.jobs,
+            options.email_from,
+            smtp_server,
+            screenshot_params,
+            options.warmup,
+            options.country_code,
+            holidays,
+            options.metrics_file,
+            gate,
+            queue,
+            options.job_timeout,
+            options.max_lateness,
+        )
+        signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+        signal.signal(signal.SIGINT, lambda *_: daemon.stop())
+        daemon.run()
+        if sender is not None:
+            sender.close()
+        return
+
+    # pylint: disable=import-outside-toplevel
+    from selenium.common.exceptions import WebDriverException
+
+    # Each location's additional views are captured from the same page
+    width = options.screenshot_width or DEFAULT_WIDTH
+    height = options.screenshot_height or DEFAULT_HEIGHT
+    viewports = []
+    for location in locations:
+        group = [Viewport(location, width, height)]
+        for zoom, view_width, view_height in options.views:
+            view = Location(location.latitude, location.longitude, zoom)
+            group.append(Viewport(view, view_width or width, view_height or height))
+        viewports.append(group)
+    failures = 0
+    try:
+        # The SMTP connection and the emails are prepared during the captures
+        email_to = options.email_to
+        if len(email_to) == 1 and not options.bcc:
+            email_to = email_to[0]
+        with Delivery(
+            options.email_from,
+            smtp_server,
+            gate=gate,
+            bcc=options.bcc,
+            processor=screenshot_params.get("processor"),
+        ) as delivery:
+            with ScreenshotPool(**pool_params, **screenshot_params) as pool, deadline(
+                options.job_timeout,
+                lambda: pool.kill(
+                    functools.partial(JobTimeoutError, options.job_timeout)
+                ),
+            ):
+
+                def submit(
+                    group: List[Viewport], confirm: Callable[[], bool] = None
+                ) -> Future:
+                    return delivery.submit(
+                        email_to,
+                        group[0].location,
+                        group,
+                        pool.submit_viewports(group),
+                        confirm,
+                    )
+
+                if queue is None:
+                    futures = {submit(group): group[0].location for group in viewports}
+                    for future in as_completed(futures):
+                        if not _sent(future, futures[future]):
+                            failures += 1
+                else:
+                    jobs = {
+                        f"{group[0].location}|{','.join(options.email_to)}": group
+                        for group in viewports
+                    }
+                    failures = _run_shared(
+                        queue, options.queue_window, jobs, submit, pool.workers
+                    )
+    except (DeadlineExceededError, TileFetchError, WebDriverException) as exc:
+        logger.error(exc.msg)
+        sys.exit(1)
+    finally:
+        smtp_server.close()
+        if sender is not None:
+            sender.close()
+        if "renderer" in screenshot_params:
+            screenshot_params["renderer"].close()
+        if options.metrics_file:
+            _write_metrics(options.metrics_file)
+    if failures:
+        logger.error("%s location(s) not sent", failures)
+        sys.exit(1)
 
 
-__all__ = ["__version__", "Location", "MapScreenshot", "run", "send_email"]
+__all__ = [
+    "__version__",
+    "build_email",
+    "Capture",
+    "Congestion",
+    "CongestionGate",
+    "CronSchedule",
+    "Daemon",
+    "Delivery",
+    "HistoryStore",
+    "HolidayIndex",
+    "ImageProcessor",
+    "Job",
+    "JobQueue",
+    "Location",
+    "MapScreenshot",
+    "Metrics",
+    "metrics",
+    "Outbox",
+    "OutboxSender",
+    "Recipient",
+    "ScreenshotCache",
+    "ScreenshotPool",
+    "SMTPServer",
+    "TileRenderer",
+    "Viewport",
+    "run",
+    "send_email",
+    "send_emails",
+]
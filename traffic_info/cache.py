@@ -0,0 +1,186 @@
+"""Screenshots cache for traffic_info package."""
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Any, Iterator
+
+# Seconds after which a temporary file is left over by a writer which died
+_STALE_TMP_AGE = 3600
+
+
+def _is_file(path: str, file_descriptor: int) -> bool:
+    """Check whether a path still refers to an open file."""
+    try:
+        return os.stat(path).st_ino == os.fstat(file_descriptor).st_ino
+    except FileNotFoundError:
+        return False
+
+
+class ScreenshotCache:
+    """
+    ScreenshotCache class, an on-disk cache of screenshots.
+
+    Screenshots are stored by a hash of the location and the viewport, they
+    are fresh for ttl seconds and the least recently used ones are removed
+    when the cache grows bigger than max_size.
+
+    Args:
+        directory: The cache's directory, created if needed.
+        ttl: Number of seconds a screenshot stays fresh, default 300.
+        max_size: Maximum size of the cache in MiB, default 100.
+
+    """
+
+    def __init__(self, directory: str, ttl: float = 300, max_size: int = 100) -> None:
+        """Initialize a ScreenshotCache object with the given options."""
+        self.directory: str = directory
+        self.ttl: float = ttl
+        self.max_size: int = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*params: Any) -> str:
+        """
+        Get the cache key of a screenshot.
+
+        Args:
+            params: The screenshot's parameters, e.g. its location and size.
+
+        Returns:
+            The cache key.
+
+        """
+        return hashlib.sha256(json.dumps(params).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        """Get the path of a cached screenshot."""
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _lock_path(self, key: str) -> str:
+        """Get the path of a cache key's lock file."""
+        return os.path.join(self.directory, f"{key}.lock")
+
+    @contextlib.contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        """
+        Lock a cache key.
+
+        Threads and processes rendering the same screenshot wait for the one
+        holding the lock, then find the screenshot in the cache.
+
+        Args:
+            key: The cache key.
+
+        """
+        lock_path = self._lock_path(key)
+        while True:
+            with open(lock_path, "a", encoding="utf-8") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    # The lock file is removed by evict() once unused, the
+                    # lock is taken again on the new one
+                    if _is_file(lock_path, lock_file.fileno()):
+                        yield
+                        return
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _remove_lock(self, key: str) -> None:
+        """Remove a cache key's lock file, unless it is in use."""
+        lock_path = self._lock_path(key)
+        try:
+            file_descriptor = os.open(lock_path, os.O_WRONLY)
+        except FileNotFoundError:
+            return
+        try:
+            fcntl.flock(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(lock_path)
+        except BlockingIOError:
+            pass
+        finally:
+            os.close(file_descriptor)
+
+    def get(self, key: str) -> bytes:
+        """
+        Get a fresh cached screenshot.
+
+        Args:
+            key: The cache key.
+
+        Returns:
+            The screenshot if a fresh one was found, None otherwise.
+
+        """
+        path = self._path(key)
+        try:
+            modified = os.path.getmtime(path)
+            if time.time() - modified > self.ttl:
+                return None
+            with open(path, "rb") as screenshot_file:
+                data = screenshot_file.read()
+            # The access time is used to evict the least recently used entries
+            os.utime(path, (time.time(), modified))
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """
+        Store a screenshot in the cache.
+
+        Args:
+            key: The cache key.
+            data: The screenshot.
+
+        """
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(file_descriptor, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used screenshots above max_size.
+
+        The lock files of the keys not cached and the temporary files left
+        over by the writers which died are removed too.
+
+        """
+        entries = []
+        locks = set()
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            key, extension = os.path.splitext(entry.name)
+            if extension == ".lock":
+                locks.add(key)
+                continue
+            if extension not in (".png", ".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Removed by another process meanwhile
+                continue
+            if extension == ".png":
+                entries.append((stat.st_atime, stat.st_size, key))
+            elif now - stat.st_mtime > _STALE_TMP_AGE:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(entry.path)
+        total = sum(size for _, size, _ in entries)
+        max_bytes = self.max_size * 1024 * 1024
+        cached = {key for _, _, key in entries}
+        for _, size, key in sorted(entries):
+            if total <= max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(key))
+            cached.discard(key)
+            total -= size
+        for key in locks - cached:
+            self._remove_lock(key)
@@ -0,0 +1,375 @@
+"""Congestion scoring for traffic_info package."""
+from __future__ import annotations
+
+import contextlib
+import datetime
+import fcntl
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Sequence, TYPE_CHECKING, Tuple
+
+if TYPE_CHECKING:
+    import numpy
+
+    from .core import Location
+
+# Colors of Google Maps' traffic layer, from fluid to jammed
+TRAFFIC_COLORS: Dict[str, Tuple[int, int, int]] = {
+    "green": (99, 214, 104),
+    "orange": (255, 151, 77),
+    "red": (242, 60, 50),
+    "dark_red": (129, 31, 31),
+}
+LEVELS: List[str] = list(TRAFFIC_COLORS)
+
+_lookup_tables: Dict[int, numpy.ndarray] = {}
+_lookup_lock = threading.Lock()
+
+
+def _lookup_table(tolerance: int) -> numpy.ndarray:
+    """
+    Get the table classifying colors quantized to 5 bits per channel.
+
+    The table is indexed by the quantized red, green and blue values packed
+    in 15 bits. Each entry is 0 for colors which are not traffic colors,
+    otherwise the index of the nearest traffic level plus 1.
+    """
+    # pylint: disable=import-outside-toplevel
+    import numpy
+
+    with _lookup_lock:
+        table = _lookup_tables.get(tolerance)
+        if table is None:
+            centers = numpy.arange(32) * 8 + 4
+            grid = numpy.stack(
+                numpy.meshgrid(centers, centers, centers, indexing="ij"), axis=-1
+            )
+            colors = numpy.array(list(TRAFFIC_COLORS.values()))
+            distances = ((grid[..., None, :] - colors) ** 2).sum(axis=-1)
+            table = (distances.argmin(axis=-1) + 1).astype(numpy.uint8)
+            table[distances.min(axis=-1) > tolerance**2] = 0
+            table = table.ravel()
+            _lookup_tables[tolerance] = table
+    return table
+
+
+def classify(pixels: numpy.ndarray, tolerance: int = 40) -> numpy.ndarray:
+    """
+    Classify pixels by traffic level.
+
+    Args:
+        pixels: RGB pixels, an array of any shape ending with 3 channels.
+        tolerance: Maximum distance to a traffic color, default 40.
+
+    Returns:
+        An array of the pixels' shape without the channels, 0 for pixels
+        which are not traffic colors, the traffic level's index in LEVELS
+        plus 1 otherwise.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    import numpy
+
+    quantized = (pixels[..., :3] >> 3).astype(numpy.uint16)
+    index = quantized[..., 0] << 10
+    index |= quantized[..., 1] << 5
+    index |= quantized[..., 2]
+    return _lookup_table(tolerance)[index]
+
+
+def decode(image: bytes) -> numpy.ndarray:
+    """
+    Decode an image to an array of RGB pixels.
+
+    Args:
+        image: The image, e.g. a PNG screenshot.
+
+    Returns:
+        The pixels as a height x width x 3 array.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    import numpy
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image)) as decoded:
+        return numpy.asarray(decoded.convert("RGB"))
+
+
+@dataclass
+class Congestion:
+    """
+    Congestion class, the traffic conditions on a map.
+
+    Attributes:
+        score: From 0 when all the traffic is fluid to 100 when it is all
+        jammed.
+        levels: Share of the traffic pixels at each level.
+
+    """
+
+    score: float
+    levels: Dict[str, float]
+
+    @classmethod
+    def from_classes(cls, classes: numpy.ndarray) -> "Congestion":
+        """
+        Compute the congestion of classified pixels.
+
+        Args:
+            classes: Pixels classified by classify().
+
+        Returns:
+            The congestion.
+
+        """
+        # pylint: disable=import-outside-toplevel
+        import numpy
+
+        return cls.from_counts(
+            numpy.bincount(classes.ravel(), minlength=len(LEVELS) + 1)[1:]
+        )
+
+    @classmethod
+    def from_counts(cls, counts: numpy.ndarray) -> "Congestion":
+        """
+        Compute the congestion from the number of pixels at each level.
+
+        Args:
+            counts: The number of pixels at each level of LEVELS.
+
+        Returns:
+            The congestion.
+
+        """
+        # pylint: disable=import-outside-toplevel
+        import numpy
+
+        total = int(counts.sum())
+        if not total:
+            return cls(0.0, dict.fromkeys(LEVELS, 0.0))
+        weights = numpy.linspace(0, 100, len(LEVELS))
+        return cls(
+            float(counts @ weights / total),
+            {level: int(count) / total for level, count in zip(LEVELS, counts)},
+        )
+
+
+def score_image(image: bytes, tolerance: int = 40) -> Congestion:
+    """
+    Compute the congestion on a map screenshot.
+
+    Args:
+        image: The screenshot.
+        tolerance: Maximum distance to a traffic color, default 40.
+
+    Returns:
+        The congestion.
+
+    """
+    return Congestion.from_classes(classify(decode(image), tolerance))
+
+
+def score_images(
+    images: Iterable[bytes], tolerance: int = 40, max_workers: int = None
+) -> List[Congestion]:
+    """
+    Compute the congestion on a batch of map screenshots.
+
+    Decoding and classification release the GIL, so the screenshots are
+    scored in parallel threads.
+
+    Args:
+        images: The screenshots.
+        tolerance: Maximum distance to a traffic color, default 40.
+        max_workers: Maximum number of threads, see ThreadPoolExecutor.
+
+    Returns:
+        The congestion of each screenshot, in the same order.
+
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda image: score_image(image, tolerance), images))
+
+
+class CongestionGate:
+    """
+    CongestionGate class, send emails only when the traffic changed.
+
+    The score of the last full email sent to each recipient for each
+    location is stored in a JSON file, a new email is full only if its score
+    differs by at least threshold, otherwise it is skipped or sent as text
+    only. Several processes can share the scores file.
+
+    Args:
+        path: The scores file, created if needed.
+        threshold: Minimum score change to send a full email, default 5.
+        unchanged: What to do with unchanged traffic, "skip" the email or
+        send it as "text" only without the map, default "skip".
+        tolerance: Maximum distance to a traffic color, default 40.
+
+    """
+
+    def __init__(
+        self,
+        path: str,
+        threshold: float = 5,
+        unchanged: str = "skip",
+        tolerance: int = 40,
+    ) -> None:
+        """Initialize a CongestionGate object with the given options."""
+        if unchanged not in ("skip", "text"):
+            raise ValueError(f"Invalid unchanged action: {unchanged}")
+        self.path: str = path
+        self.threshold: float = threshold
+        self.unchanged: str = unchanged
+        self.tolerance: int = tolerance
+        self._scores: Dict[str, Dict[str, float]] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict[str, float]]:
+        """Load the stored scores, once."""
+        if self._scores is None:
+            self._scores = self._read()
+        return self._scores
+
+    def _read(self) -> Dict[str, Dict[str, float]]:
+        """Read the scores file."""
+        try:
+            with open(self.path, mode="r", encoding="utf-8") as scores_file:
+                return json.load(scores_file)
+        except (OSError, ValueError):
+            return {}
+
+    @contextlib.contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """Lock the scores file, for the processes sharing it."""
+        with open(f"{self.path}.lock", "a", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _key(location: Location, email_to: str) -> str:
+        """Get the key of a location's score for a recipient."""
+        return str(location) if email_to is None else f"{location}|{email_to}"
+
+    def last_score(self, location: Location, email_to: str = None) -> float:
+        """
+        Get the score of a location's last full email.
+
+        Args:
+            location: The location.
+            email_to: The email's recipient.
+
+        Returns:
+            The score, None if no full email was sent yet.
+
+        """
+        with self._lock:
+            entry = self._load().get(self._key(location, email_to))
+        return None if entry is None else entry["score"]
+
+    def check(
+        self, location: Location, image: bytes, email_to: str = None
+    ) -> Tuple[Congestion, str]:
+        """
+        Score a screenshot and decide what to send.
+
+        Args:
+            location: The screenshot's location.
+            image: The screenshot.
+            email_to: The email's recipient.
+
+        Returns:
+            The congestion and the action: "send" a full email, "text" only
+            or "skip" the email.
+
+        """
+        congestion = score_image(image, self.tolerance)
+        return congestion, self.decide(location, congestion, email_to)
+
+    def decide(
+        self, location: Location, congestion: Congestion, email_to: str = None
+    ) -> str:
+        """
+        Decide what to send for an already scored screenshot.
+
+        Args:
+            location: The screenshot's location.
+            congestion: The screenshot's congestion, see score_image().
+            email_to: The email's recipient.
+
+        Returns:
+            The action: "send" a full email, "text" only or "skip" the email.
+
+        """
+        last_score = self.last_score(location, email_to)
+        if last_score is None:
+            return "send"
+        if abs(congestion.score - last_score) < self.threshold:
+            logging.getLogger(__name__).info(
+                "Traffic unchanged at %s (%.1f, last %.1f)",
+                location,
+                congestion.score,
+                last_score,
+            )
+            return self.unchanged
+        return "send"
+
+    def update(
+        self,
+        location: Location,
+        congestion: Congestion,
+        email_to: str | Sequence[str] = None,
+    ) -> None:
+        """
+        Store the score of a location's full email.
+
+        Args:
+            location: The location.
+            congestion: The congestion sent.
+            email_to: The email's recipient, or its recipients, the scores
+            file is written once for all of them.
+
+        """
+        recipients = (
+            [email_to] if email_to is None or isinstance(email_to, str) else email_to
+        )
+        entry = {
+            "score": congestion.score,
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+        updates = {self._key(location, recipient): entry for recipient in recipients}
+        with self._lock:
+            self._load().update(updates)
+            try:
+                self._scores = self._save(updates)
+            except OSError as exc:
+                logging.getLogger(__name__).warning(
+                    "Unable to save congestion scores(%s)", exc
+                )
+
+    def _save(
+        self, updates: Dict[str, Dict[str, float]]
+    ) -> Dict[str, Dict[str, float]]:
+        """Merge scores in the scores file, return all the stored scores."""
+        # The scores written by the other processes since the file was loaded
+        # are kept, the file is locked so none is lost meanwhile
+        with self._file_lock():
+            scores = self._read()
+            scores.update(updates)
+            directory = os.path.dirname(os.path.abspath(self.path))
+            file_descriptor, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(file_descriptor, mode="w", encoding="utf-8") as tmp_file:
+                json.dump(scores, tmp_file)
+            os.replace(tmp_path, self.path)
+        return scores
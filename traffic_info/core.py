@@ -1,26 +1,74 @@
 """Trafficinfo module."""
+from __future__ import annotations
+
+import base64
+import contextlib
+import copy
+import fcntl
+import io
+import json
 import logging
 import os.path
 import shutil
 import smtplib
 import tempfile
+import threading
 import time
+import uuid
+import weakref
 from dataclasses import dataclass
+from email.generator import BytesGenerator
 from email.headerregistry import Address
-from email.message import EmailMessage
-from email.utils import make_msgid
-from typing import Any, Dict
+from email.message import EmailMessage, MIMEPart
+from email.policy import Policy
+from email.utils import getaddresses, make_msgid
+from typing import (
+    Any,
+    Dict,
+    IO,
+    Iterable,
+    Iterator,
+    List,
+    Sequence,
+    TYPE_CHECKING,
+    Tuple,
+    Type,
+)
+
+from .cache import ScreenshotCache
+from .exceptions import (
+    DeadlineExceededError,
+    DriverStartTimeoutError,
+    PageLoadTimeoutError,
+    ReadyTimeoutError,
+    SMTPConnectTimeoutError,
+    SMTPSendTimeoutError,
+    ScreenshotTimeoutError,
+)
+from .metrics import metrics
+from .utils import deadline, kill_process_tree, render_template
 
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
+if TYPE_CHECKING:
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
 
-from .utils import render_template
+    from .congestion import Congestion, CongestionGate
+    from .history import HistoryStore
+    from .imaging import ImageProcessor
+    from .outbox import Outbox
+    from .route import RouteSegment
+    from .tiles import TileRenderer
 
 DIR = os.path.dirname(os.path.abspath(__file__))
 CHROMEDRIVER_PATH = f"{DIR}/bin/chromedriver"
+DEFAULT_WIDTH = 1280
+DEFAULT_HEIGHT = 720
 
 Context = Dict[str, Any]
 
+# The maps' MIME parts shared by several emails and their serialized form
+_shared_parts: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
 
 @dataclass
 class Location:
@@ -31,16 +79,97 @@ class Location:
         latitude: Latitude of the center point of the map to make the screenshot.
         longitude: Longitude of the center point of the map.
         zoom: Google Maps zoom level, default 16.
+        route: The points of a route shown on the map as (latitude, longitude),
+        its traffic conditions are summarized in the email.
 
     """
 
     latitude: float
     longitude: float
-    zoom: int
+    zoom: int = 16
+    route: List[Tuple[float, float]] = None
+
+    def __str__(self) -> str:
+        """Return the location as LATITUDE,LONGITUDE,ZOOM."""
+        return f"{self.latitude},{self.longitude},{self.zoom}"
+
+
+@dataclass
+class Capture:
+    """
+    Capture class, a screenshot of a location.
+
+    Args:
+        location: The map's location.
+        path: The screenshot's full path.
+        width: Screenshot's width.
+        height: Screenshot's height.
+        data: The screenshot itself when it is kept in memory.
+        image_format: The screenshot's format, "png", "jpeg" or "webp",
+        default "png".
+        origin: The pixel coordinates of the location on the screenshot, its
+        center if not specified, e.g. when it was cropped.
+
+    """
+
+    location: Location
+    path: str
+    width: int
+    height: int
+    data: bytes = None
+    image_format: str = "png"
+    origin: Tuple[float, float] = None
+
+
+@dataclass
+class Recipient:
+    """
+    Recipient class, an email's recipient and its personalization.
+
+    Args:
+        address: The recipient's address.
+        headers: Headers added to the recipient's email, or replacing the
+        default ones, e.g. List-Unsubscribe or Subject.
+        variables: Additional variables of the recipient's email template.
+
+    """
+
+    address: str
+    headers: Dict[str, str] = None
+    variables: Context = None
+
+
+def _timed_out(exception: BaseException) -> bool:
+    """Check if an SMTP error is a timeout, smtplib reports some as disconnections."""
+    return isinstance(exception, TimeoutError) or isinstance(
+        exception.__context__, TimeoutError
+    )
 
 
 class SMTPServer:
-    """SMTPServer class."""
+    """
+    SMTPServer class.
+
+    The connection is opened on first use and reused for the next messages,
+    use it as a context manager to close it when done. It is thread-safe,
+    messages sent from several threads are sent one at a time.
+
+    Args:
+        server: SMTP server's address, default localhost.
+        port: SMTP server's port, default 25.
+        use_ssl: Use SMTPS, default False.
+        login: SMTP server's login.
+        password: SMTP server's password.
+        max_messages: Maximum number of messages sent on one connection,
+        default 100.
+        check_interval: Check that the connection is still alive with a NOOP
+        when it was idle for more than this number of seconds, default 10.
+        connect_timeout: Maximum time in seconds to wait for the server while
+        connecting and logging in, default 30.
+        send_timeout: Maximum time in seconds to wait for the server while
+        sending a message, default 60.
+
+    """
 
     def __init__(
         self,
@@ -49,6 +178,10 @@ class SMTPServer:
         use_ssl: bool = False,
         login: str = None,
         password: str = None,
+        max_messages: int = 100,
+        check_interval: float = 10,
+        connect_timeout: float = 30,
+        send_timeout: float = 60,
     ) -> None:
         """Initialize a SMTPServer object with the given options."""
         self.server = server
@@ -56,151 +189,1417 @@ class SMTPServer:
         self.use_ssl = use_ssl
         self.login = login
         self.password = password
+        self.max_messages = max_messages
+        self.check_interval = check_interval
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
         self._smtp = None
+        self._sent: int = 0
+        self._last_used: float = 0
+        self._lock = threading.RLock()
 
     def __del__(self) -> None:
         """Cleanup stmp object."""
-        if self._smtp is not None:
-            self._smtp.quit()
+        self.close()
+
+    def __copy__(self) -> "SMTPServer":
+        """Copy the server's options, the copy opens its own connection."""
+        return SMTPServer(
+            self.server,
+            self.port,
+            self.use_ssl,
+            self.login,
+            self.password,
+            self.max_messages,
+            self.check_interval,
+            self.connect_timeout,
+            self.send_timeout,
+        )
+
+    def __enter__(self) -> "SMTPServer":
+        """Open the SMTP connection."""
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Close the SMTP connection."""
+        self.close()
+
+    def is_connected(self) -> bool:
+        """
+        Check if the SMTP connection is alive.
+
+        Returns:
+            True if the server answered to a NOOP, False otherwise.
+
+        """
+        if self._smtp is None:
+            return False
+        try:
+            code, _ = self._smtp.noop()
+        except (OSError, smtplib.SMTPException):
+            return False
+        return code == 250
 
     def connect(self) -> None:
-        """Start SMTP connection."""
-        if self.use_ssl:
-            self._smtp = smtplib.SMTP_SSL(self.server, self.port)
-        else:
-            self._smtp = smtplib.SMTP(self.server, self.port)
-        if self.login is not None and self.password is not None:
-            self._smtp.login(self.login, self.password)
+        """Start SMTP connection, keep the current one if it is still usable."""
+        with self._lock:
+            if self._smtp is not None:
+                idle = time.monotonic() - self._last_used
+                if self._sent < self.max_messages and (
+                    idle < self.check_interval or self.is_connected()
+                ):
+                    return
+                self.close()
+            with metrics.phase("smtp_connect"):
+                try:
+                    if self.use_ssl:
+                        self._smtp = smtplib.SMTP_SSL(
+                            self.server, self.port, timeout=self.connect_timeout
+                        )
+                    else:
+                        self._smtp = smtplib.SMTP(
+                            self.server, self.port, timeout=self.connect_timeout
+                        )
+                    if self.login is not None and self.password is not None:
+                        self._smtp.login(self.login, self.password)
+                except (TimeoutError, smtplib.SMTPServerDisconnected) as exc:
+                    self._abort()
+                    if not _timed_out(exc):
+                        raise
+                    raise SMTPConnectTimeoutError(self.connect_timeout) from exc
+                except BaseException:
+                    # A session which could not log in must not be reused
+                    self._abort()
+                    raise
+                self._smtp.sock.settimeout(self.send_timeout)
+            self._sent = 0
+            self._last_used = time.monotonic()
+
+    def close(self) -> None:
+        """Close SMTP connection."""
+        with self._lock:
+            if self._smtp is None:
+                return
+            try:
+                self._smtp.quit()
+            except (OSError, smtplib.SMTPException):
+                self._smtp.close()
+            self._smtp = None
+
+    def _abort(self) -> None:
+        """Drop a connection in an unknown state without waiting for QUIT."""
+        if self._smtp is not None:
+            self._smtp.close()
+            self._smtp = None
+
+    def send_message(self, email: EmailMessage, to_addrs: Sequence[str] = None) -> None:
+        """
+        Send email message, reconnect once if the connection was lost.
+
+        Args:
+            email: The email message to send.
+            to_addrs: The envelope's recipients, the email's To, Cc and Bcc
+            addresses if not specified.
+
+        """
+        self.sendmail(*envelope(email, to_addrs))
+
+    def sendmail(
+        self,
+        from_addr: str,
+        to_addrs: Sequence[str],
+        message: bytes,
+        mail_options: Sequence[str] = (),
+    ) -> Dict[str, Tuple[int, bytes]]:
+        """
+        Send a serialized email, reconnect once if the connection was lost.
+
+        Args:
+            from_addr: The envelope's sender.
+            to_addrs: The envelope's recipients.
+            message: The email message, see envelope().
+            mail_options: The MAIL command's options.
 
-    def send_message(self, email: EmailMessage) -> None:
-        """Send email message."""
-        self._smtp.send_message(email)
+        Returns:
+            The refused recipients' errors, when some of them were accepted.
+
+        """
+        with self._lock:
+            self.connect()
+            with metrics.phase("smtp_send"):
+                try:
+                    refused = self._sendmail(from_addr, to_addrs, message, mail_options)
+                except smtplib.SMTPServerDisconnected:
+                    self.close()
+                    self.connect()
+                    refused = self._sendmail(from_addr, to_addrs, message, mail_options)
+            self._sent += 1
+            self._last_used = time.monotonic()
+        return refused
+
+    def _sendmail(
+        self,
+        from_addr: str,
+        to_addrs: Sequence[str],
+        message: bytes,
+        mail_options: Sequence[str],
+    ) -> Dict[str, Tuple[int, bytes]]:
+        """Send on the current connection, a stalled server is not retried."""
+        try:
+            return self._smtp.sendmail(from_addr, to_addrs, message, mail_options)
+        except (TimeoutError, smtplib.SMTPServerDisconnected) as exc:
+            if not _timed_out(exc):
+                raise
+            # The message may have been accepted, sending it again could
+            # duplicate it
+            self._abort()
+            raise SMTPSendTimeoutError(self.send_timeout) from exc
+
+    def send_messages(self, emails: Iterable[EmailMessage]) -> List[EmailMessage]:
+        """
+        Send several email messages over the same authenticated connection.
+
+        Args:
+            emails: The email messages to send.
+
+        Returns:
+            The email messages which could not be sent.
+
+        """
+        logger = logging.getLogger(__name__)
+        failed = []
+        for email in emails:
+            try:
+                self.send_message(email)
+            except (OSError, smtplib.SMTPException) as exception:
+                logger.error("Unable to send email to %s(%s)", email["To"], exception)
+                failed.append(email)
+        return failed
+
+
+@dataclass
+class Viewport:
+    """
+    Viewport class, a map to capture from an already loaded page.
+
+    Args:
+        location: The location of the map's center point and its zoom.
+        width: The map's width, the MapScreenshot's width if not specified.
+        height: The map's height, the MapScreenshot's height if not specified.
+
+    """
+
+    location: Location
+    width: int = None
+    height: int = None
 
 
 class MapScreenshot:
     """
     MapScreenshot class.
 
+    Use it as a context manager to keep a single browser session open while
+    taking several screenshots.
+
     Args:
-        webdriver_path: The path to the webdriver to use.
+        webdriver_path: The path to the webdriver to use, unused with a
+        renderer.
         api_key: Google Maps Javascript API key to take screenshots.
-        width: Screenshot's width, default 1280.
-        height: Screenshot's height, default 720.
+        width: Screenshot's width, default DEFAULT_WIDTH.
+        height: Screenshot's height, default DEFAULT_HEIGHT.
         output_dir: The path to save the screenshot,
         if not specified a temporary directory will be created.
+        in_memory: Keep the screenshot in memory in the data attribute instead
+        of saving it, the map page is loaded from a data URL so no temporary
+        files are written, default False.
+        ready_timeout: Maximum time in seconds to wait for the map's readiness
+        signal, default 15. Set to 0 to always use the fixed delay.
+        fallback_delay: Fixed delay in seconds used when the page does not
+        provide a readiness signal, default 5.
+        cache: Reuse fresh screenshots of the same location, size, device
+        scale factor and renderer from this cache instead of starting the
+        browser.
+        renderer: Render the maps with this backend instead of the browser,
+        e.g. a TileRenderer.
+        profile_dir: Keep the browser profiles and their disk cache in this
+        directory between runs, so the Google Maps scripts, fonts and sprites
+        are downloaded once. Each running browser locks its own profile.
+        profile_size: Maximum size of a profile in MiB, a bigger profile is
+        reset, default 200.
+        blocked_urls: URL patterns the browser must not load, "*" is a
+        wildcard, e.g. "*.woff2".
+        processor: Crop, resize and compress the screenshots, see
+        ImageProcessor. Cached screenshots are processed when reused.
+        device_scale_factor: The browser's device pixel ratio, e.g. 2 for
+        screenshots twice as big for retina screens, default 1.
+        history: Record each captured screenshot, before processing, in this
+        history.
+        driver_timeout: Maximum time in seconds to start or quit the browser,
+        default 60.
+        page_load_timeout: Maximum time in seconds to load or move the map,
+        default 60.
+        screenshot_timeout: Maximum time in seconds to take the screenshot,
+        and to wait for the readiness beyond ready_timeout and fallback_delay,
+        default 30.
+
+    A browser which misses a deadline is killed along with its driver, and
+    the phase's DeadlineExceededError is raised, e.g. PageLoadTimeoutError.
+    A deadline of None or 0 disables it.
 
     """
 
     _template_dir: str = os.path.join(DIR, "templates")
+    _ready_script: str = (
+        "return window.trafficInfoReady === undefined"
+        ' ? "missing" : window.trafficInfoReady;'
+    )
 
     def __init__(
         self,
         webdriver_path: str,
         api_key: str = None,
-        width: int = 1280,
-        height: int = 720,
+        width: int = DEFAULT_WIDTH,
+        height: int = DEFAULT_HEIGHT,
         output_dir: str = None,
+        in_memory: bool = False,
+        ready_timeout: float = 15,
+        fallback_delay: float = 5,
+        cache: ScreenshotCache = None,
+        renderer: TileRenderer = None,
+        profile_dir: str = None,
+        profile_size: int = 200,
+        blocked_urls: List[str] = None,
+        processor: ImageProcessor = None,
+        device_scale_factor: float = 1,
+        history: HistoryStore = None,
+        driver_timeout: float = 60,
+        page_load_timeout: float = 60,
+        screenshot_timeout: float = 30,
     ) -> None:
         """Initialize a MapScreenshot object with the given options."""
-        self._tmpdir: str = tempfile.mkdtemp()
+        self._tmpdir: str = None
         self.webdriver_path: str = webdriver_path
         self.api_key: str = api_key
         self.width: int = width
         self.height: int = height
-        self.output_dir = output_dir if output_dir is not None else self._tmpdir
+        self.output_dir: str = output_dir
+        self.in_memory: bool = in_memory
+        self.ready_timeout: float = ready_timeout
+        self.fallback_delay: float = fallback_delay
+        self.cache: ScreenshotCache = cache
+        self.renderer: TileRenderer = renderer
+        self.profile_dir: str = profile_dir
+        self.profile_size: int = profile_size
+        self.blocked_urls: List[str] = blocked_urls or []
+        self.processor: ImageProcessor = processor
+        self.device_scale_factor: float = device_scale_factor
+        self.history: HistoryStore = history
+        self.driver_timeout: float = driver_timeout
+        self.page_load_timeout: float = page_load_timeout
+        self.screenshot_timeout: float = screenshot_timeout
         self.path: str = None
+        self.data: bytes = None
+        self.wait_time: float = None
+        self.load_time: float = None
+        self.network_bytes: int = None
+        self._driver: webdriver.Chrome = None
+        self._service: Service = None
+        self._expired: DeadlineExceededError = None
+        self._page_loaded: bool = False
+        self._window_size: Tuple[int, int] = None
+        self._profile_lock: IO = None
 
-    def take(self, location: Location) -> str:
+    @property
+    def image_size(self) -> Tuple[int, int]:
+        """The screenshots' width and height once processed."""
+        if self.processor is None:
+            return self.width, self.height
+        return self.processor.size(self.width, self.height)
+
+    @property
+    def image_format(self) -> str:
+        """The screenshots' format, "png", "jpeg" or "webp"."""
+        return "png" if self.processor is None else self.processor.image_format
+
+    @property
+    def origin(self) -> Tuple[float, float]:
+        """The pixel coordinates of the location on processed screenshots."""
+        if self.processor is None:
+            return None
+        return self.processor.origin(self.width, self.height)
+
+    @property
+    def _ready_deadline(self) -> float:
+        """Time the readiness wait may take before the browser is killed."""
+        if not self.screenshot_timeout:
+            return None
+        # A script call stuck beyond ready_timeout is given screenshot_timeout
+        return (self.ready_timeout or 0) + self.fallback_delay + self.screenshot_timeout
+
+    def _wait_ready(self, driver: webdriver.Chrome) -> float:
         """
-        Take a screenshot using chrome webdriver.
+        Wait for the map to be fully drawn.
+
+        The map template sets window.trafficInfoReady once the tiles and the
+        traffic layer are painted. If the page does not provide this signal
+        or if ready_timeout is 0, wait for fallback_delay seconds instead.
 
         Args:
-            location: The location of the map's center point.
+            driver: The webdriver displaying the map.
+
+        Returns:
+            The time spent waiting, in seconds.
+
+        """
+        # pylint: disable=import-outside-toplevel
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        logger = logging.getLogger(__name__)
+        start = time.monotonic()
+        if not self.ready_timeout:
+            time.sleep(self.fallback_delay)
+            return time.monotonic() - start
+
+        try:
+            state = WebDriverWait(driver, self.ready_timeout, poll_frequency=0.1).until(
+                lambda d: d.execute_script(self._ready_script)
+            )
+        except TimeoutException:
+            logger.warning(
+                "Map not ready after %ss, taking the screenshot anyway",
+                self.ready_timeout,
+            )
+        else:
+            if state == "missing":
+                logger.warning(
+                    "No readiness signal in the map page, waiting %ss",
+                    self.fallback_delay,
+                )
+                time.sleep(self.fallback_delay)
+        wait_time = time.monotonic() - start
+        logger.info("Map ready after %.2fs", wait_time)
+        return wait_time
+
+    def __enter__(self) -> "MapScreenshot":
+        """Start a browser session, see start()."""
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Close the browser session."""
+        self.stop()
+
+    def start(self) -> None:
+        """
+        Start a persistent browser session.
+
+        While the session is open, take() reuses the same browser and the same
+        loaded map page, only moving the map to each new location.
+        With a renderer, no browser is started.
+        """
+        if self._driver is not None or self.renderer is not None:
+            return
+        # pylint: disable=import-outside-toplevel
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.chrome.service import Service
+
+        options = Options()
+        options.add_argument("--headless=new")
+        if self.device_scale_factor != 1:
+            options.add_argument(
+                f"--force-device-scale-factor={self.device_scale_factor}"
+            )
+        if self.profile_dir is not None:
+            profile = self._lock_profile()
+            options.add_argument(f"--user-data-dir={profile}")
+            options.add_argument(f"--disk-cache-dir={os.path.join(profile, 'cache')}")
+            options.add_argument(f"--disk-cache-size={self.profile_size * 1024**2}")
+        # The network events are logged to count the bytes downloaded
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        options.add_experimental_option(
+            "perfLoggingPrefs", {"enableNetwork": True, "enablePage": False}
+        )
+        # The service is kept to kill the driver if the browser hangs starting
+        self._service = Service(self.webdriver_path)
+        with metrics.phase("driver_start"), self._deadline(
+            self.driver_timeout, DriverStartTimeoutError
+        ):
+            self._driver = webdriver.Chrome(service=self._service, options=options)
+            self._driver.set_window_size(self.width, self.height)
+            self._window_size = (self.width, self.height)
+            if self.blocked_urls:
+                self._driver.execute_cdp_cmd("Network.enable", {})
+                self._driver.execute_cdp_cmd(
+                    "Network.setBlockedURLs", {"urls": self.blocked_urls}
+                )
+
+    def _lock_profile(self) -> str:
+        """
+        Lock the first profile not used by another browser.
 
         Returns:
-            The screenshot's full path.
+            The profile's directory, reset if it grew bigger than profile_size.
+
+        """
+        os.makedirs(self.profile_dir, exist_ok=True)
+        index = 0
+        while True:
+            profile = os.path.join(self.profile_dir, f"profile-{index}")
+            # pylint: disable=consider-using-with
+            lock_file = open(f"{profile}.lock", "a", encoding="utf-8")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                index += 1
+                continue
+            self._profile_lock = lock_file
+            break
+
+        size = 0
+        for root, _, files in os.walk(profile):
+            for name in files:
+                with contextlib.suppress(OSError):
+                    size += os.path.getsize(os.path.join(root, name))
+        if size > self.profile_size * 1024**2:
+            logging.getLogger(__name__).info(
+                "Resetting browser profile %s (%s MiB)", profile, size // 1024**2
+            )
+            shutil.rmtree(profile, ignore_errors=True)
+        return profile
+
+    def stop(self) -> None:
+        """Close the browser session, kill the browser if it does not quit."""
+        if self._driver is None and self._service is None:
+            return
+        with deadline(self.driver_timeout, self.kill):
+            if self._driver is not None:
+                self._driver.quit()
+            else:
+                # The browser did not start, only its driver is stopped
+                self._service.stop()
+        self._driver = None
+        self._service = None
+        self._expired = None
+        self._page_loaded = False
+        self._window_size = None
+        if self._profile_lock is not None:
+            fcntl.flock(self._profile_lock, fcntl.LOCK_UN)
+            self._profile_lock.close()
+            self._profile_lock = None
 
+    def kill(self, error: DeadlineExceededError = None) -> None:
         """
+        Kill the browser and its driver at once, e.g. when they are hung.
+
+        The browser's current call fails, then the session is closed. It can
+        be called from any thread.
+
+        Args:
+            error: The error raised instead of the current call's error.
+
+        """
+        if error is not None:
+            self._expired = error
+        process = getattr(self._service, "process", None)
+        if process is not None:
+            kill_process_tree(process.pid)
+
+    @contextlib.contextmanager
+    def _deadline(
+        self, timeout: float, error: Type[DeadlineExceededError]
+    ) -> Iterator[None]:
+        """Kill the browser if the phase does not finish in time, raise error."""
+        failure = None
+        try:
+            with deadline(timeout, lambda: self.kill(error(timeout))):
+                yield
+        except Exception as exc:  # pylint: disable=broad-except
+            if self._expired is None:
+                raise
+            failure = exc
+        if self._expired is not None:
+            expired = self._expired
+            self.stop()
+            raise expired from failure
+
+    @contextlib.contextmanager
+    def _session(self) -> Iterator[webdriver.Chrome]:
+        """Reuse the running browser session or open one for a single use."""
+        if self._driver is not None:
+            yield self._driver
+            return
+        self.start()
+        try:
+            yield self._driver
+        finally:
+            self.stop()
+
+    def prepare(self, location: Location) -> None:
+        """
+        Start the browser session and load the map page ahead of time.
+
+        The next screenshot of this location can then be taken right away.
+
+        Args:
+            location: The location of the map's center point.
+
+        """
+        if self.renderer is not None:
+            self.renderer.start()
+            return
+        self.start()
+        if not self._page_loaded:
+            self._load(self._driver, location)
+
+    def _load(self, driver: webdriver.Chrome, location: Location) -> None:
+        """Render the map template for the given location and load it."""
         context: Context = {
             "key": self.api_key,
             "latitude": location.latitude,
             "longitude": location.longitude,
             "zoom": location.zoom,
         }
-        map_html = os.path.join(self._tmpdir, "map.html")
-        render_template(os.path.join(self._template_dir, "map.j2"), context, map_html)
+        template = os.path.join(self._template_dir, "map.j2")
+        if self.in_memory:
+            html = render_template(template, context).encode("utf-8")
+            data_url = base64.b64encode(html).decode("ascii")
+            url = f"data:text/html;charset=utf-8;base64,{data_url}"
+        else:
+            map_html = os.path.join(self._get_tmpdir(), "map.html")
+            render_template(template, context, map_html)
+            url = f"file://{map_html}"
+        with metrics.phase("page_load", location=str(location)), self._deadline(
+            self.page_load_timeout, PageLoadTimeoutError
+        ):
+            driver.get(url)
+        self._page_loaded = True
 
-        options = Options()
-        options.headless = True
-        driver = webdriver.Chrome(
-            executable_path=self.webdriver_path, chrome_options=options
-        )
-        driver.set_window_size(self.width, self.height)
-        driver.get(f"file://{map_html}")
-        time.sleep(5)
-        self.path = os.path.join(self.output_dir, "map.png")
-        driver.save_screenshot(self.path)
-        driver.quit()
+    def _move(self, driver: webdriver.Chrome, location: Location) -> None:
+        """Move the already loaded map, reload the page if it can't be moved."""
+        with metrics.phase("page_move", location=str(location)), self._deadline(
+            self.page_load_timeout, PageLoadTimeoutError
+        ):
+            moved = driver.execute_script(
+                "if (window.trafficInfoMove === undefined) { return false; }"
+                "window.trafficInfoMove(arguments[0], arguments[1], arguments[2]);"
+                "return true;",
+                location.latitude,
+                location.longitude,
+                location.zoom,
+            )
+        if not moved:
+            self._load(driver, location)
+
+    def take(self, location: Location, filename: str = "map.png") -> str:
+        """
+        Take a screenshot using chrome webdriver.
+
+        Inside a browser session the map page is loaded once and then moved
+        to each location, otherwise a browser is started for this screenshot.
+        With a cache, a fresh screenshot of the same location, size, device
+        scale factor and renderer is reused without using the browser at all,
+        and it is not recorded again in the history.
+
+        Args:
+            location: The location of the map's center point.
+            filename: The screenshot's file name in output_dir, its extension
+            is replaced by the processor's format.
+
+        Returns:
+            The screenshot's full path, None in memory mode.
+
+        """
+        with metrics.phase("take", location=str(location)):
+            captured = True
+            if self.cache is None:
+                data = self._capture(location)
+            else:
+                # The browser's and the renderers' maps look different, e.g.
+                # from other tile servers
+                key = self.cache.key(
+                    location.latitude,
+                    location.longitude,
+                    location.zoom,
+                    self.width,
+                    self.height,
+                    self.device_scale_factor,
+                    (
+                        "browser"
+                        if self.renderer is None
+                        else [
+                            type(self.renderer).__name__,
+                            self.renderer.url_templates,
+                            self.renderer.tile_size,
+                        ]
+                    ),
+                )
+                with self.cache.lock(key):
+                    data = self.cache.get(key)
+                    if data is None:
+                        data = self._capture(location)
+                        self.cache.put(key, data)
+                    else:
+                        self.wait_time = 0
+                        captured = False
+
+            if captured and self.history is not None:
+                with metrics.phase("history", location=str(location)):
+                    self.history.add(location, data, self.width, self.height)
+            if self.processor is not None:
+                with metrics.phase("process_image", location=str(location)):
+                    data = self.processor.process(data, self.width, self.height)
+                metrics.record("image_bytes", len(data), location=str(location))
+                filename = os.path.splitext(filename)[0] + self.processor.extension
+            if self.in_memory:
+                self.data = data
+                self.path = None
+            else:
+                self.data = None
+                self.path = os.path.join(
+                    self.output_dir or self._get_tmpdir(), filename
+                )
+                with open(self.path, "wb") as screenshot_file:
+                    screenshot_file.write(data)
         return self.path
 
+    def _capture(self, location: Location) -> bytes:
+        """Take the screenshot with the browser or the renderer."""
+        if self.renderer is not None:
+            with metrics.phase("render", location=str(location)):
+                data = self.renderer.render(location, self.width, self.height)
+            self.wait_time = 0
+            metrics.record("screenshot_bytes", len(data), location=str(location))
+            return data
+        with self._session() as driver:
+            start = time.monotonic()
+            if self._window_size != (self.width, self.height):
+                with self._deadline(self.page_load_timeout, PageLoadTimeoutError):
+                    driver.set_window_size(self.width, self.height)
+                self._window_size = (self.width, self.height)
+            if self._page_loaded:
+                self._move(driver, location)
+            else:
+                self._load(driver, location)
+            with metrics.phase("wait_ready", location=str(location)), self._deadline(
+                self._ready_deadline, ReadyTimeoutError
+            ):
+                self.wait_time = self._wait_ready(driver)
+            self.load_time = time.monotonic() - start
+            with metrics.phase("screenshot", location=str(location)), self._deadline(
+                self.screenshot_timeout, ScreenshotTimeoutError
+            ):
+                self.network_bytes = self._network_usage(driver)
+                data = driver.get_screenshot_as_png()
+        logging.getLogger(__name__).info(
+            "Map loaded in %.2fs, %s bytes downloaded",
+            self.load_time,
+            self.network_bytes,
+        )
+        metrics.record("load_time_seconds", self.load_time, location=str(location))
+        metrics.record("network_bytes", self.network_bytes, location=str(location))
+        metrics.record("screenshot_bytes", len(data), location=str(location))
+        return data
+
+    def _network_usage(self, driver: webdriver.Chrome) -> int:
+        """
+        Get the bytes downloaded by the page since the last call.
+
+        The encoded length of each response is read from the browser's
+        network events, so the cross-origin resources are counted, unlike in
+        the page's Resource Timing. Resources served by the browser's cache
+        are not counted.
+        """
+        transferred = 0
+        for entry in driver.get_log("performance"):
+            event = json.loads(entry["message"])["message"]
+            if event["method"] == "Network.loadingFinished":
+                transferred += event["params"]["encodedDataLength"]
+        return int(transferred)
+
+    def take_many(self, locations: Iterable[Location]) -> List[str]:
+        """
+        Take a screenshot of each location in a single browser session.
+
+        Args:
+            locations: The locations of the maps' center points.
+
+        Returns:
+            The screenshots' full paths, in the same order as locations,
+            or the screenshots themselves in memory mode.
+
+        """
+        screenshots = []
+        with self._session():
+            for index, location in enumerate(locations):
+                path = self.take(location, f"map_{index}.png")
+                screenshots.append(self.data if self.in_memory else path)
+        return screenshots
+
+    def take_viewports(
+        self, viewports: Iterable[Viewport], prefix: str = "map"
+    ) -> List[Capture]:
+        """
+        Capture several viewports from a single page load.
+
+        The map page is loaded once, then re-centered, zoomed and resized for
+        each viewport.
+
+        Args:
+            viewports: The maps to capture.
+            prefix: The screenshots' file names prefix in output_dir.
+
+        Returns:
+            The captures, in the same order as viewports.
+
+        """
+        width, height = self.width, self.height
+        captures = []
+        try:
+            with self._session():
+                for index, viewport in enumerate(viewports):
+                    self.width = viewport.width or width
+                    self.height = viewport.height or height
+                    path = self.take(viewport.location, f"{prefix}_{index}.png")
+                    captures.append(
+                        Capture(
+                            viewport.location,
+                            path,
+                            *self.image_size,
+                            self.data,
+                            self.image_format,
+                            self.origin,
+                        )
+                    )
+        finally:
+            self.width, self.height = width, height
+        return captures
+
+    def _get_tmpdir(self) -> str:
+        """Get the temporary directory, create it if needed."""
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp()
+        return self._tmpdir
+
     def __del__(self) -> None:
-        """Cleanup temporary files."""
-        if os.path.isdir(self._tmpdir):
+        """Cleanup the browser and temporary files."""
+        if getattr(self, "_driver", None) is not None:
+            self.stop()
+        if self._tmpdir is not None and os.path.isdir(self._tmpdir):
             shutil.rmtree(self._tmpdir)
 
 
-def send_email(
+def build_email(
     email_from: str,
     email_to: str,
     location: Location,
-    screenshot: MapScreenshot,
-    smtp_server: SMTPServer,
+    screenshot: MapScreenshot | Capture | Sequence[Capture],
     template: str = None,
-) -> None:
+    congestion: Congestion = None,
+    include_map: bool = True,
+    route: List[RouteSegment] = None,
+) -> EmailMessage:
     """
-    Send the traffic info email.
+    Build the traffic info email.
+
+    Args:
+        email_from: Email sender's address.
+        email_to: Email recipient's address.
+        location: The map's location.
+        screenshot: The map's screenshot, a MapScreenshot or one of its
+        captures, or several captures of the location, e.g. at different
+        zoom levels.
+        template: The path to the email's Jinja2 template,
+        templates/email.j2 if not specified.
+        congestion: The map's congestion, shown in the email if specified.
+        include_map: Embed the map, default True. Without the map, the email
+        only tells the traffic is about the same as last time.
+        route: The traffic conditions along the location's route, shown in
+        the email if specified.
+
+    Returns:
+        The email message with the maps embedded.
+
+    """
+    email, cids = render_email(
+        email_from,
+        email_to,
+        location,
+        screenshot,
+        template,
+        congestion,
+        include_map,
+        route,
+    )
+    if include_map:
+        attach_maps(email, encode_maps(screenshot, cids))
+    return email
+
+
+def render_email(
+    email_from: str,
+    email_to: str,
+    location: Location,
+    screenshot: MapScreenshot | Capture | Sequence[Capture | Viewport],
+    template: str = None,
+    congestion: Congestion = None,
+    include_map: bool = True,
+    route: List[RouteSegment] = None,
+    cids: List[str] = None,
+    variables: Context = None,
+) -> Tuple[EmailMessage, List[str]]:
+    """
+    Render the traffic info email without the maps' images.
+
+    Only the maps' locations and sizes are needed, so the email can be
+    rendered while its maps are still being captured.
 
     Args:
         email_from: Email sender's address.
         email_to: Email recipient's address.
         location: The map's location.
-        screenshot: The map's screenshot.
+        screenshot: The map's screenshot or the viewports of the maps to
+        capture, their width and height must be specified.
         template: The path to the email's Jinja2 template,
         templates/email.j2 if not specified.
+        congestion: The map's congestion, shown in the email if specified.
+        include_map: Embed the map, default True.
+        route: The traffic conditions along the location's route, shown in
+        the email if specified.
+        cids: The Content-ID of each map, new ones are generated if not
+        specified. Emails rendered with the same Content-IDs can share the
+        maps' images, see encode_maps().
+        variables: Additional template variables, e.g. the recipient's name.
+
+    Returns:
+        The email message and the Content-ID of each map.
 
     """
     if template is None:
         template = os.path.join(DIR, "templates", "email.j2")
-    logger = logging.getLogger(__name__)
-    map_cid = make_msgid()
+    screenshots = _as_list(screenshot)
+    if not include_map:
+        cids = []
+    elif cids is None:
+        cids = [make_msgid() for _ in screenshots]
+    sizes = [_image_size(capture) for capture in screenshots]
+    maps = [
+        {
+            "url": _maps_url(getattr(capture, "location", location)),
+            "width": width,
+            "height": height,
+            "map_cid": cid[1:-1],
+        }
+        for capture, (width, height), cid in zip(screenshots, sizes, cids)
+    ]
     context: Context = {
-        "url": f"https://www.google.fr/maps/@{location.latitude},"
-        f"{location.longitude},{location.zoom}z/data=!5m1!1e1",
-        "width": screenshot.width,
-        "height": screenshot.height,
-        "map_cid": map_cid[1:-1],
+        "url": _maps_url(location),
+        "width": sizes[0][0],
+        "height": sizes[0][1],
+        "map_cid": maps[0]["map_cid"] if maps else None,
+        "maps": maps,
+        "congestion": congestion,
+        "route": route,
+        **(variables or {}),
     }
     content = f"""
     Today's traffic conditions.
     {context["url"]}
     Have a safe trip back home!
     """
+    if congestion is not None:
+        content += f"    Congestion score: {congestion.score:.0f}/100\n"
+    if not include_map:
+        content += "    The traffic is about the same as last time.\n"
+    for index, segment in enumerate(route or [], start=1):
+        content += (
+            f"    Segment {index} ({segment.distance / 1000:.1f} km): "
+            f"{segment.condition.replace('_', ' ')}\n"
+        )
     html = render_template(template, context)
     email = EmailMessage()
     email["Subject"] = "Traffic info"
     email["From"] = Address("Traffic info", addr_spec=email_from)
     email["To"] = email_to
     email.set_content(content)
+    email.make_alternative(boundary=_boundary())
     email.add_alternative(html, subtype="html")
+    return email, cids
+
+
+def encode_maps(
+    screenshot: MapScreenshot | Capture | Sequence[Capture], cids: List[str]
+) -> List[MIMEPart]:
+    """
+    Encode the maps' images as inline MIME parts.
+
+    The parts are not modified when attached, so they can be shared by all
+    the emails rendered with the same Content-IDs.
+
+    Args:
+        screenshot: The maps' screenshot or captures, in the same order as
+        when the email was rendered.
+        cids: The Content-ID of each map returned by render_email().
+
+    Returns:
+        The maps' MIME parts.
+
+    """
+    parts = []
+    for capture, cid in zip(_as_list(screenshot), cids):
+        part = MIMEPart()
+        part.set_content(
+            _read_image(capture),
+            "image",
+            capture.image_format,
+            cid=cid,
+            disposition="inline",
+        )
+        _shared_parts[part] = {}
+        parts.append(part)
+    return parts
+
+
+class _SharedPartsGenerator(BytesGenerator):
+    """BytesGenerator serializing each shared map part only once."""
+
+    def _write(self, msg: MIMEPart) -> None:
+        """Write a part, reuse its serialized form if it is shared."""
+        serialized = _shared_parts.get(msg)
+        if serialized is None:
+            super()._write(msg)
+            return
+        data = serialized.get(self._NL)
+        if data is None:
+            output = self._fp
+            self._fp = self._new_buffer()
+            try:
+                super()._write(msg)
+                data = serialized[self._NL] = self._fp.getvalue()
+            finally:
+                self._fp = output
+        self._fp.write(data)
+
+
+def _boundary() -> str:
+    """
+    Make a random MIME boundary.
+
+    It is too unlikely to be found in the emails' parts for the generator to
+    scan them for it, which is slow with several maps.
+    """
+    return f"==============={uuid.uuid4().hex}=="
+
+
+def _flatten(email: EmailMessage, policy: Policy = None) -> bytes:
+    """Serialize an email for SMTP without its Bcc header."""
+    email = copy.copy(email)
+    del email["Bcc"]
+    with io.BytesIO() as output:
+        _SharedPartsGenerator(output, policy=policy).flatten(email, linesep="\r\n")
+        return output.getvalue()
+
+
+def envelope(
+    email: EmailMessage, to_addrs: Sequence[str] = None
+) -> Tuple[str, List[str], bytes, Tuple[str, ...]]:
+    """
+    Get an email's SMTP envelope and serialize it.
+
+    Args:
+        email: The email message.
+        to_addrs: The envelope's recipients, the email's To, Cc and Bcc
+        addresses if not specified.
+
+    Returns:
+        The envelope's sender and recipients, the serialized email and the
+        MAIL command's options, SMTPUTF8 for internationalized addresses.
+
+    """
+    from_addr = getaddresses([email["Sender"] or email["From"]])[0][1]
+    if to_addrs is None:
+        fields = [email[field] for field in ("To", "Cc", "Bcc") if field in email]
+        to_addrs = [address for _, address in getaddresses(fields)]
+    if "".join([from_addr, *to_addrs]).isascii():
+        return from_addr, list(to_addrs), _flatten(email), ()
+    # Like smtplib, internationalized addresses are sent as UTF-8 headers
+    policy = email.policy.clone(utf8=True)
+    options = ("SMTPUTF8", "BODY=8BITMIME")
+    return from_addr, list(to_addrs), _flatten(email, policy), options
+
+
+def attach_maps(email: EmailMessage, parts: Sequence[MIMEPart]) -> None:
+    """
+    Embed the maps in an email rendered by render_email().
+
+    Args:
+        email: The email message.
+        parts: The maps' MIME parts, see encode_maps().
+
+    """
+    html = email.get_payload()[1]
+    if html.get_content_type() != "multipart/related":
+        html.make_related(boundary=_boundary())
+    for part in parts:
+        html.attach(part)
+
+
+def _maps_url(location: Location) -> str:
+    """Get the Google Maps URL of a location with the traffic layer."""
+    return (
+        f"https://www.google.fr/maps/@{location.latitude},"
+        f"{location.longitude},{location.zoom}z/data=!5m1!1e1"
+    )
+
+
+def _as_list(
+    screenshot: MapScreenshot | Capture | Sequence[Capture],
+) -> List[MapScreenshot | Capture]:
+    """Get the list of screenshots of an email."""
+    if isinstance(screenshot, (list, tuple)):
+        return list(screenshot)
+    return [screenshot]
+
+
+def _image_size(
+    screenshot: MapScreenshot | Capture | Viewport,
+) -> Tuple[int, int]:
+    """Get the width and height of a screenshot as shown in the email."""
+    return getattr(screenshot, "image_size", (screenshot.width, screenshot.height))
+
+
+def _read_image(screenshot: MapScreenshot | Capture) -> bytes:
+    """Get a screenshot's image from memory or from its file."""
+    if screenshot.data is not None:
+        return screenshot.data
     with open(screenshot.path, "rb") as img:
-        email.get_payload()[1].add_related(img.read(), "image", "png", cid=map_cid)
+        return img.read()
+
+
+def send_email(
+    email_from: str,
+    email_to: str,
+    location: Location,
+    screenshot: MapScreenshot | Capture | Sequence[Capture],
+    smtp_server: SMTPServer | Outbox,
+    template: str = None,
+    gate: CongestionGate = None,
+    prepared: Tuple[EmailMessage, List[str]] = None,
+) -> None:
+    """
+    Send the traffic info email.
+
+    Args:
+        email_from: Email sender's address.
+        email_to: Email recipient's address.
+        location: The map's location.
+        screenshot: The map's screenshot, a MapScreenshot or one of its
+        captures, or several captures of the location.
+        smtp_server: The SMTP server used to send the email, or an Outbox to
+        queue it.
+        template: The path to the email's Jinja2 template,
+        templates/email.j2 if not specified.
+        gate: Skip the map when the congestion did not change since the last
+        email, see CongestionGate.
+        prepared: The email and its maps' Content-IDs rendered ahead by
+        render_email(), ignored with a gate or a route as the email depends
+        on the map.
+
+    """
+    with metrics.phase("send_email", location=str(location)):
+        _send_email(
+            email_from,
+            email_to,
+            location,
+            screenshot,
+            smtp_server,
+            template,
+            gate,
+            prepared,
+        )
+
+
+def _send_email(
+    email_from: str,
+    email_to: str,
+    location: Location,
+    screenshot: MapScreenshot | Capture | Sequence[Capture],
+    smtp_server: SMTPServer | Outbox,
+    template: str = None,
+    gate: CongestionGate = None,
+    prepared: Tuple[EmailMessage, List[str]] = None,
+) -> None:
+    """Build and send the traffic info email, see send_email()."""
+    logger = logging.getLogger(__name__)
+    # The congestion and the route are computed on the first map
+    first = _as_list(screenshot)[0]
+    congestion = None
+    action = "send"
+    if gate is not None:
+        with metrics.phase("congestion", location=str(location)):
+            congestion, action = gate.check(location, _read_image(first), email_to)
+        metrics.record("congestion_score", congestion.score, location=str(location))
+        if action == "skip":
+            logger.info("Email to %s skipped, the traffic did not change", email_to)
+            return
+    route = _sample_route(location, first) if location.route else None
+    with metrics.phase("build_email", location=str(location)):
+        if prepared is not None and gate is None and route is None:
+            email, cids = prepared
+            attach_maps(email, encode_maps(screenshot, cids))
+        else:
+            email = build_email(
+                email_from,
+                email_to,
+                location,
+                screenshot,
+                template,
+                congestion,
+                include_map=action == "send",
+                route=route,
+            )
+    # The email is serialized once, for its size and to send it
+    serialized = envelope(email)
+    metrics.record("email_bytes", len(serialized[2]), location=str(location))
 
     try:
         smtp_server.connect()
-    except (ConnectionRefusedError, smtplib.SMTPAuthenticationError) as exception:
+    except (OSError, smtplib.SMTPException) as exception:
         logger.error("Unable to connect to SMTP server(%s)", exception)
+        return
 
     try:
-        smtp_server.send_message(email)
-    except smtplib.SMTPException as exception:
+        smtp_server.sendmail(*serialized)
+    except (OSError, smtplib.SMTPException) as exception:
         logger.error("Unable to send email(%s)", exception)
+        return
+    if gate is not None and action == "send":
+        gate.update(location, congestion, email_to)
+
+
+def _sample_route(
+    location: Location, screenshot: MapScreenshot | Capture
+) -> List[RouteSegment]:
+    """Sample the traffic conditions along a location's route on its map."""
+    # pylint: disable=import-outside-toplevel
+    from .congestion import decode
+    from .route import sample_route
+
+    with metrics.phase("route", location=str(location)):
+        pixels = decode(_read_image(screenshot))
+        # Screenshots may be cropped or have more pixels than the page
+        scale = pixels.shape[1] / _image_size(screenshot)[0]
+        return sample_route(
+            pixels,
+            location,
+            location.route,
+            origin=screenshot.origin,
+            scale=scale,
+        )
+
+
+def send_emails(
+    email_from: str,
+    recipients: Sequence[str | Recipient],
+    location: Location,
+    screenshot: MapScreenshot | Capture | Sequence[Capture],
+    smtp_server: SMTPServer | Outbox,
+    template: str = None,
+    gate: CongestionGate = None,
+    bcc: bool = False,
+    max_bcc: int = 100,
+) -> List[str]:
+    """
+    Send the traffic info email to several recipients.
+
+    The maps' images are encoded once and shared by all the emails, the
+    congestion and the route are computed once too. Each recipient gets
+    their own email with their own headers and template variables, or with
+    bcc a single email is sent to all of them over one envelope.
+
+    Args:
+        email_from: Email sender's address.
+        recipients: The recipients' addresses or Recipient objects.
+        location: The map's location.
+        screenshot: The map's screenshot, a MapScreenshot or one of its
+        captures, or several captures of the location.
+        smtp_server: The SMTP server used to send the emails, or an Outbox
+        to queue them.
+        template: The path to the email's Jinja2 template,
+        templates/email.j2 if not specified.
+        gate: Skip the map when the congestion did not change since the last
+        email to each recipient, see CongestionGate.
+        bcc: Send a single email to all the recipients, they are not listed
+        in its headers. The recipients' headers and variables are ignored,
+        default False.
+        max_bcc: Maximum number of recipients of a single email, it is sent
+        several times to more recipients, default 100.
+
+    Returns:
+        The addresses of the recipients the email could not be sent to.
+
+    """
+    with metrics.phase("send_emails", location=str(location)):
+        return _send_emails(
+            email_from,
+            [
+                recipient if isinstance(recipient, Recipient) else Recipient(recipient)
+                for recipient in recipients
+            ],
+            location,
+            screenshot,
+            smtp_server,
+            template,
+            gate,
+            bcc,
+            max_bcc,
+        )
+
+
+def _send_emails(
+    email_from: str,
+    recipients: List[Recipient],
+    location: Location,
+    screenshot: MapScreenshot | Capture | Sequence[Capture],
+    smtp_server: SMTPServer | Outbox,
+    template: str = None,
+    gate: CongestionGate = None,
+    bcc: bool = False,
+    max_bcc: int = 100,
+) -> List[str]:
+    """Build and send the traffic info emails, see send_emails()."""
+    logger = logging.getLogger(__name__)
+    first = _as_list(screenshot)[0]
+    congestion = None
+    actions = {recipient.address: "send" for recipient in recipients}
+    if gate is not None:
+        # pylint: disable=import-outside-toplevel
+        from .congestion import score_image
+
+        with metrics.phase("congestion", location=str(location)):
+            congestion = score_image(_read_image(first), gate.tolerance)
+        metrics.record("congestion_score", congestion.score, location=str(location))
+        for address in actions:
+            actions[address] = gate.decide(location, congestion, address)
+    skipped = [address for address, action in actions.items() if action == "skip"]
+    if skipped:
+        logger.info(
+            "Email to %s recipient(s) skipped, the traffic did not change",
+            len(skipped),
+        )
+    route = _sample_route(location, first) if location.route else None
+    cids = [make_msgid() for _ in _as_list(screenshot)]
+    parts = []
+    if "send" in actions.values():
+        with metrics.phase("encode_maps", location=str(location)):
+            parts = encode_maps(screenshot, cids)
+
+    try:
+        smtp_server.connect()
+    except (OSError, smtplib.SMTPException) as exception:
+        logger.error("Unable to connect to SMTP server(%s)", exception)
+        return [address for address, action in actions.items() if action != "skip"]
+
+    failed = []
+    sent = []
+    emails = _fan_out(
+        email_from,
+        recipients,
+        actions,
+        location,
+        screenshot,
+        template,
+        congestion,
+        route,
+        cids,
+        parts,
+        bcc,
+        max_bcc,
+    )
+    for index, (email, addresses) in enumerate(emails):
+        serialized = envelope(email, addresses)
+        if index == 0:
+            metrics.record("email_bytes", len(serialized[2]), location=str(location))
+        try:
+            smtp_server.sendmail(*serialized)
+        except (OSError, smtplib.SMTPException) as exception:
+            logger.error(
+                "Unable to send email to %s recipient(s)(%s)", len(addresses), exception
+            )
+            failed.extend(addresses)
+            continue
+        sent.extend(address for address in addresses if actions[address] == "send")
+    if gate is not None and sent:
+        gate.update(location, congestion, sent)
+    return failed
+
+
+def _fan_out(
+    email_from: str,
+    recipients: List[Recipient],
+    actions: Dict[str, str],
+    location: Location,
+    screenshot: MapScreenshot | Capture | Sequence[Capture],
+    template: str,
+    congestion: Congestion,
+    route: List[RouteSegment],
+    cids: List[str],
+    parts: List[MIMEPart],
+    bcc: bool,
+    max_bcc: int,
+) -> Iterator[Tuple[EmailMessage, List[str]]]:
+    """Build the emails sharing the maps' parts and their envelope recipients."""
+    if bcc:
+        for action in ("send", "text"):
+            addresses = [
+                recipient.address
+                for recipient in recipients
+                if actions[recipient.address] == action
+            ]
+            if not addresses:
+                continue
+            email, _ = render_email(
+                email_from,
+                "undisclosed-recipients:;",
+                location,
+                screenshot,
+                template,
+                congestion,
+                action == "send",
+                route,
+                cids,
+            )
+            if action == "send":
+                attach_maps(email, parts)
+            for start in range(0, len(addresses), max_bcc):
+                end = start + max_bcc
+                yield email, addresses[start:end]
+        return
+
+    for recipient in recipients:
+        action = actions[recipient.address]
+        if action == "skip":
+            continue
+        email, _ = render_email(
+            email_from,
+            recipient.address,
+            location,
+            screenshot,
+            template,
+            congestion,
+            action == "send",
+            route,
+            cids,
+            recipient.variables,
+        )
+        for name, value in (recipient.headers or {}).items():
+            if name in email:
+                email.replace_header(name, value)
+            else:
+                email[name] = value
+        if action == "send":
+            attach_maps(email, parts)
+        yield email, [recipient.address]
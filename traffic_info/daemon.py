@@ -0,0 +1,375 @@
+"""Daemon mode for traffic_info package."""
+import datetime
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+from .congestion import CongestionGate
+from .core import Location, MapScreenshot, SMTPServer, send_email
+from .exceptions import (
+    DeadlineExceededError,
+    InvalidCountryCodeError,
+    JobTimeoutError,
+    TileFetchError,
+)
+from .holidays import HolidayIndex
+from .jobqueue import JobQueue
+from .metrics import metrics
+from .utils import deadline
+
+
+class CronSchedule:
+    """
+    CronSchedule class, a cron-like schedule.
+
+    Args:
+        expression: A cron expression with five fields: minute, hour,
+        day of month, month and day of week (0 or 7 is Sunday).
+        Fields accept "*", lists, ranges and steps, e.g. "45 16 * * 1-5".
+
+    """
+
+    _fields = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+    _max_days: int = 366 * 5
+
+    def __init__(self, expression: str) -> None:
+        """Initialize a CronSchedule object from a cron expression."""
+        fields = expression.split()
+        if len(fields) != len(self._fields):
+            raise ValueError(f"invalid cron expression '{expression}'")
+        self.expression: str = expression
+        values = [
+            self._parse_field(field, *bounds)
+            for field, bounds in zip(fields, self._fields)
+        ]
+        self.minutes: List[int] = sorted(values[0])
+        self.hours: List[int] = sorted(values[1])
+        self.days: Set[int] = values[2]
+        self.months: Set[int] = values[3]
+        self.weekdays: Set[int] = {day % 7 for day in values[4]}
+        # Like cron, if both days fields are restricted, either one matches
+        self._any_day: bool = fields[2] == "*"
+        self._any_weekday: bool = fields[4] == "*"
+
+    def __repr__(self) -> str:
+        """Return the cron expression."""
+        return f"CronSchedule({self.expression!r})"
+
+    @staticmethod
+    def _parse_field(field: str, minimum: int, maximum: int) -> Set[int]:
+        """Parse one field of a cron expression."""
+        values = set()
+        for part in field.split(","):
+            value_range, _, step = part.partition("/")
+            if value_range == "*":
+                start, end = minimum, maximum
+            elif "-" in value_range:
+                start, end = map(int, value_range.split("-", 1))
+            else:
+                start = end = int(value_range)
+            if not minimum <= start <= end <= maximum:
+                raise ValueError(f"invalid cron field '{field}'")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, day: datetime.date) -> bool:
+        """Check if the schedule fires on this day."""
+        if day.month not in self.months:
+            return False
+        day_match = day.day in self.days
+        weekday_match = day.isoweekday() % 7 in self.weekdays
+        if self._any_day:
+            return weekday_match
+        if self._any_weekday:
+            return day_match
+        return day_match or weekday_match
+
+    def next_fire(self, after: datetime.datetime) -> datetime.datetime:
+        """
+        Get the next fire time of the schedule.
+
+        Args:
+            after: The fire time will be strictly after this time.
+
+        Returns:
+            The next fire time.
+
+        """
+        start = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        day = start.date()
+        for _ in range(self._max_days):
+            if self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        fire_time = datetime.datetime.combine(
+                            day, datetime.time(hour, minute)
+                        )
+                        if fire_time >= start:
+                            return fire_time
+            day += datetime.timedelta(days=1)
+        raise ValueError(f"cron expression '{self.expression}' never fires")
+
+
+@dataclass
+class Job:
+    """
+    Job class, an email sent on schedule.
+
+    Args:
+        schedule: When to send the email.
+        location: The map's location.
+        email_to: Email recipient's address.
+        country_codes: Country codes(ISO 3166-1/ISO 3166-2) to skip holidays,
+        the daemon's country codes if not specified.
+
+    """
+
+    schedule: CronSchedule
+    location: Location
+    email_to: str
+    country_codes: List[str] = None
+
+    @property
+    def key(self) -> str:
+        """The job as CRON|LATITUDE,LONGITUDE,ZOOM|EMAIL_TO."""
+        return f"{self.schedule.expression}|{self.location}|{self.email_to}"
+
+
+class Daemon:
+    """
+    Daemon class, send the jobs' emails on schedule.
+
+    The browser is started with the map loaded and the SMTP connection is
+    opened warmup seconds before each fire time, so the emails are sent
+    right on time.
+
+    Args:
+        jobs: The jobs to run.
+        email_from: Email sender's address.
+        smtp_server: The SMTP server used to send the emails, or an Outbox
+        to queue them.
+        screenshot_params: MapScreenshot's arguments.
+        warmup: Seconds to get ready before a fire time, default 60.
+        country_codes: Country codes(ISO 3166-1/ISO 3166-2) to skip holidays.
+        holidays: The holidays index, a default one is used if not specified.
+        metrics_file: Write the metrics to this file after each fire time.
+        gate: Skip the map when the traffic did not change, see
+        CongestionGate.
+        queue: Share the jobs with the daemons of other hosts, each job is
+        run by one of them, see JobQueue.
+        job_timeout: Maximum time in seconds to take a job's screenshot and
+        send its email, the browser is killed when it is exceeded.
+        max_lateness: Seconds after which a missed fire time, e.g. during a
+        suspend, is dropped instead of being run late, default 300.
+
+    """
+
+    _max_sleep: float = 60
+
+    def __init__(
+        self,
+        jobs: List[Job],
+        email_from: str,
+        smtp_server: SMTPServer,
+        screenshot_params: Dict[str, Any],
+        warmup: float = 60,
+        country_codes: List[str] = None,
+        holidays: HolidayIndex = None,
+        metrics_file: str = None,
+        gate: CongestionGate = None,
+        queue: JobQueue = None,
+        job_timeout: float = None,
+        max_lateness: float = 300,
+    ) -> None:
+        """Initialize a Daemon object with the given options."""
+        self.jobs: List[Job] = jobs
+        self.email_from: str = email_from
+        self.smtp_server: SMTPServer = smtp_server
+        self.screenshot: MapScreenshot = MapScreenshot(**screenshot_params)
+        self.warmup: datetime.timedelta = datetime.timedelta(seconds=warmup)
+        self.country_codes: List[str] = country_codes or []
+        self.holidays: HolidayIndex = holidays if holidays else HolidayIndex()
+        self.metrics_file: str = metrics_file
+        self.gate: CongestionGate = gate
+        self.queue: JobQueue = queue
+        self.job_timeout: float = job_timeout
+        self.max_lateness: datetime.timedelta = datetime.timedelta(
+            seconds=max_lateness
+        )
+        self._stop = threading.Event()
+
+    def stop(self) -> None:
+        """Stop the daemon, can be called from a signal handler."""
+        self._stop.set()
+
+    def _sleep_until(self, wake_time: datetime.datetime) -> bool:
+        """
+        Sleep until the given time.
+
+        Returns:
+            False if the daemon was stopped in the meantime, True otherwise.
+
+        """
+        while not self._stop.is_set():
+            remaining = (wake_time - datetime.datetime.now()).total_seconds()
+            if remaining <= 0:
+                return True
+            # Wake up regularly to follow system clock changes
+            self._stop.wait(min(remaining, self._max_sleep))
+        return False
+
+    def _next_jobs(
+        self, after: datetime.datetime
+    ) -> Tuple[datetime.datetime, List[Job]]:
+        """Get the next fire time after a time and the jobs due at this time."""
+        fire_times = [job.schedule.next_fire(after) for job in self.jobs]
+        fire_time = min(fire_times)
+        due = [job for job, time in zip(self.jobs, fire_times) if time == fire_time]
+        return fire_time, due
+
+    def _missed(self, fire_time: datetime.datetime) -> bool:
+        """Check if a fire time is too late to be run, log it if so."""
+        oldest = datetime.datetime.now() - self.max_lateness
+        if fire_time >= oldest:
+            return False
+        logging.getLogger(__name__).warning(
+            "Fire times from %s to %s dropped, more than %s late",
+            fire_time,
+            oldest,
+            self.max_lateness,
+        )
+        return True
+
+    def _warm_up(self, location: Location) -> None:
+        """Start the browser and the SMTP connection ahead of a fire time."""
+        # pylint: disable=import-outside-toplevel
+        from selenium.common.exceptions import WebDriverException
+
+        logger = logging.getLogger(__name__)
+        try:
+            self.screenshot.prepare(location)
+        except (DeadlineExceededError, TileFetchError, WebDriverException) as exc:
+            logger.error("Unable to start the browser(%s)", exc.msg)
+            self.screenshot.stop()
+        try:
+            self.smtp_server.connect()
+        except OSError as exc:
+            logger.error("Unable to connect to SMTP server(%s)", exc)
+
+    def _cool_down(self) -> None:
+        """Release the browser and the SMTP connection, prune the history."""
+        self.screenshot.stop()
+        if self.screenshot.history is not None:
+            self.screenshot.history.prune()
+        try:
+            self.smtp_server.close()
+        except OSError:
+            pass
+
+    def _run_job(self, job: Job, confirm: Callable[[], bool] = None) -> bool:
+        """
+        Take the job's screenshot and send its email, False on failure.
+
+        The email is not sent if confirm, when specified, returns False once
+        the screenshot is taken, e.g. the job's lease was lost.
+
+        """
+        # pylint: disable=import-outside-toplevel
+        from selenium.common.exceptions import WebDriverException
+
+        with deadline(
+            self.job_timeout,
+            lambda: self.screenshot.kill(JobTimeoutError(self.job_timeout)),
+        ) as expired:
+            try:
+                self.screenshot.take(job.location)
+            except (DeadlineExceededError, TileFetchError, WebDriverException) as exc:
+                logging.getLogger(__name__).error(
+                    "Unable to take the screenshot(%s)", exc.msg
+                )
+                self.screenshot.stop()
+                return False
+            if confirm is not None and not confirm():
+                logging.getLogger(__name__).warning(
+                    "Email for %s not sent, its job was taken over", job.location
+                )
+                return False
+            send_email(
+                self.email_from,
+                job.email_to,
+                job.location,
+                self.screenshot,
+                self.smtp_server,
+                gate=self.gate,
+            )
+        if expired.is_set():
+            # The browser was killed while the email was sent
+            self.screenshot.stop()
+        return True
+
+    def _run_shared(self, fire_time: datetime.datetime, jobs: List[Job]) -> None:
+        """Run the jobs not run by the other hosts' daemons."""
+        by_key = {job.key: job for job in jobs}
+        # The other hosts are waited for until the next warm-up
+        next_fire_time, _ = self._next_jobs(fire_time)
+        self.queue.process(
+            fire_time.isoformat(),
+            list(by_key),
+            lambda key, confirm: self._run_job(by_key[key], confirm),
+            (next_fire_time - self.warmup).timestamp(),
+            self._stop,
+        )
+
+    def _write_metrics(self) -> None:
+        """Write the metrics of the last fire time."""
+        try:
+            metrics.write_textfile(self.metrics_file)
+        except OSError as exc:
+            logging.getLogger(__name__).error("Unable to write metrics(%s)", exc)
+
+    def _is_holiday(self, job: Job, day: datetime.date) -> bool:
+        """Check if the job's recipient is on holiday."""
+        country_codes = (
+            self.country_codes if job.country_codes is None else job.country_codes
+        )
+        try:
+            return self.holidays.any_holiday(country_codes, day)
+        except InvalidCountryCodeError as exc:
+            logging.getLogger(__name__).error(exc.msg)
+            return False
+
+    def run(self) -> None:
+        """Run the jobs on schedule until the daemon is stopped."""
+        logger = logging.getLogger(__name__)
+        # The fire times are computed from the last one, so a fire time
+        # passed while the jobs were running is not skipped, unless it is
+        # too late, e.g. after a suspend or a system clock change
+        fire_time = datetime.datetime.now()
+        while not self._stop.is_set():
+            fire_time, jobs = self._next_jobs(fire_time)
+            if self._missed(fire_time):
+                fire_time = datetime.datetime.now() - self.max_lateness
+                continue
+            logger.info("Next run at %s for %s job(s)", fire_time, len(jobs))
+            if not self._sleep_until(fire_time - self.warmup):
+                break
+            jobs = [job for job in jobs if not self._is_holiday(job, fire_time)]
+            if jobs:
+                self._warm_up(jobs[0].location)
+            if not self._sleep_until(fire_time):
+                break
+            if self._missed(fire_time):
+                fire_time = datetime.datetime.now() - self.max_lateness
+                continue
+            if self.queue is None:
+                for job in jobs:
+                    self._run_job(job)
+            elif jobs:
+                self._run_shared(fire_time, jobs)
+            if jobs and self.metrics_file:
+                self._write_metrics()
+            next_fire_time, _ = self._next_jobs(fire_time)
+            if next_fire_time - datetime.datetime.now() > self.warmup:
+                self._cool_down()
+        self._cool_down()
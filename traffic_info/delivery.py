@@ -0,0 +1,241 @@
+"""Concurrent email delivery for traffic_info package."""
+from __future__ import annotations
+
+import logging
+import smtplib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from email.message import EmailMessage
+from typing import Callable, List, Sequence, Set, TYPE_CHECKING, Tuple
+
+from .core import (
+    Location,
+    Recipient,
+    SMTPServer,
+    Viewport,
+    render_email,
+    send_email,
+    send_emails,
+)
+
+if TYPE_CHECKING:
+    from .congestion import CongestionGate
+    from .imaging import ImageProcessor
+    from .outbox import Outbox
+
+
+class Delivery:
+    """
+    Delivery class, prepare the emails while their maps are captured.
+
+    The SMTP connection is opened and the emails are rendered in background
+    threads as soon as they are submitted, so the SMTP handshake, login and
+    the email template rendering overlap with the browser loading the map.
+    Each email is sent as soon as its maps are captured, whatever the order
+    the emails were submitted in, the maps are attached and it is sent over
+    the shared SMTP connection.
+
+    With a gate or a route, the email depends on the map so it is rendered
+    once the map is captured, only the SMTP connection is opened ahead. So
+    are the emails to several recipients, see send_emails().
+
+    Args:
+        email_from: Email sender's address.
+        smtp_server: The SMTP server used to send the emails, or an Outbox
+        to queue them.
+        template: The path to the email's Jinja2 template,
+        templates/email.j2 if not specified.
+        gate: Skip the map when the congestion did not change since the last
+        email, see CongestionGate.
+        max_workers: Maximum number of emails prepared at the same time,
+        default 4.
+        bcc: Send a single email to all the recipients of a submitted email,
+        see send_emails(), default False.
+        processor: The maps' processor, the emails are rendered with the
+        processed maps' sizes.
+
+    """
+
+    def __init__(
+        self,
+        email_from: str,
+        smtp_server: SMTPServer | Outbox,
+        template: str = None,
+        gate: CongestionGate = None,
+        max_workers: int = 4,
+        bcc: bool = False,
+        processor: ImageProcessor = None,
+    ) -> None:
+        """Initialize a Delivery object with the given options."""
+        self.email_from: str = email_from
+        self.smtp_server: SMTPServer | Outbox = smtp_server
+        self.template: str = template
+        self.gate: CongestionGate = gate
+        self.max_workers: int = max_workers
+        self.bcc: bool = bcc
+        self.processor: ImageProcessor = processor
+        self._executor: ThreadPoolExecutor = None
+        self._connected: Future = None
+        self._pending: Set[Future] = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "Delivery":
+        """Start opening the SMTP connection, see start()."""
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Wait for the submitted emails to be sent."""
+        self.close()
+
+    def start(self) -> None:
+        """Start the delivery threads and open the SMTP connection."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="delivery"
+            )
+            self._connected = self._executor.submit(self._connect)
+
+    def close(self) -> None:
+        """Wait for the submitted emails to be sent and stop the threads."""
+        if self._executor is not None:
+            # The emails whose maps are still being captured are not in the
+            # executor yet
+            with self._lock:
+                pending = list(self._pending)
+            wait(pending)
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _connect(self) -> None:
+        """Open the SMTP connection, it is tried again when sending."""
+        try:
+            self.smtp_server.connect()
+        except (OSError, smtplib.SMTPException) as exception:
+            logging.getLogger(__name__).warning(
+                "Unable to connect to SMTP server(%s)", exception
+            )
+
+    def submit(
+        self,
+        email_to: str | Sequence[str | Recipient],
+        location: Location,
+        viewports: Sequence[Viewport],
+        captures: Future,
+        confirm: Callable[[], bool] = None,
+    ) -> Future:
+        """
+        Prepare an email and send it once its maps are captured.
+
+        Args:
+            email_to: Email recipient's address, or several recipients.
+            location: The maps' location.
+            viewports: The maps being captured, the email is rendered ahead
+            only if their width and height are specified.
+            captures: A future of the maps' captures, e.g. from
+            ScreenshotPool.submit_viewports().
+            confirm: Called once the maps are captured, the email is not sent
+            if it returns False, e.g. the job's lease was lost.
+
+        Returns:
+            A future of True once the email was sent, or skipped, False if it
+            was not confirmed.
+
+        """
+        self.start()
+        prepared = None
+        sizes_known = all(view.width and view.height for view in viewports)
+        single = isinstance(email_to, str)
+        if single and self.gate is None and not location.route and sizes_known:
+            if self.processor is not None:
+                viewports = [
+                    Viewport(
+                        view.location, *self.processor.size(view.width, view.height)
+                    )
+                    for view in viewports
+                ]
+            prepared = self._executor.submit(
+                render_email,
+                self.email_from,
+                email_to,
+                location,
+                list(viewports),
+                self.template,
+            )
+        delivered: Future = Future()
+        delivered.set_running_or_notify_cancel()
+        with self._lock:
+            self._pending.add(delivered)
+
+        def forget(_):
+            with self._lock:
+                self._pending.discard(delivered)
+
+        def deliver(_):
+            # The email is submitted once its maps are captured, after its
+            # rendering, so it never waits in the executor for another email's
+            # maps, and a worker waiting for the rendering can't block it.
+            try:
+                sending = self._executor.submit(
+                    self._deliver, email_to, location, captures, prepared, confirm
+                )
+            except RuntimeError as exc:
+                # The executor was shut down, close() was not waited for
+                delivered.set_exception(exc)
+                return
+            sending.add_done_callback(lambda _: _chain(sending, delivered))
+
+        delivered.add_done_callback(forget)
+        captures.add_done_callback(deliver)
+        return delivered
+
+    def _deliver(
+        self,
+        email_to: str | Sequence[str | Recipient],
+        location: Location,
+        captures: Future,
+        prepared: Future,
+        confirm: Callable[[], bool] = None,
+    ) -> bool:
+        """Wait for an email's maps and send it."""
+        images = captures.result()
+        if confirm is not None and not confirm():
+            logging.getLogger(__name__).warning(
+                "Email for %s not sent, its job was taken over", location
+            )
+            return False
+        if not isinstance(email_to, str):
+            send_emails(
+                self.email_from,
+                email_to,
+                location,
+                images,
+                self.smtp_server,
+                self.template,
+                self.gate,
+                self.bcc,
+            )
+            return True
+        rendered: Tuple[EmailMessage, List[str]] = None
+        if prepared is not None:
+            rendered = prepared.result()
+        send_email(
+            self.email_from,
+            email_to,
+            location,
+            images,
+            self.smtp_server,
+            self.template,
+            self.gate,
+            rendered,
+        )
+        return True
+
+
+def _chain(source: Future, target: Future) -> None:
+    """Set a future's result, or exception, from another done future."""
+    exception = source.exception()
+    if exception is not None:
+        target.set_exception(exception)
+    else:
+        target.set_result(source.result())
@@ -36,3 +36,120 @@ class NotExecutableError(TrafficInfoError):
         """Class init."""
         super().__init__()
         self.msg = f"The file {path} is not executable."
+
+
+class InvalidCountryCodeError(TrafficInfoError):
+    """
+    Raised when the country code is not known by workalendar.
+
+    Attributes:
+        country_code: The country code.
+
+    """
+
+    def __init__(self, country_code):
+        """Class init."""
+        super().__init__()
+        self.msg = f"Invalid country code ({country_code})."
+
+
+class TileFetchError(TrafficInfoError):
+    """
+    Raised when a map tile can't be fetched.
+
+    Attributes:
+        url: The tile's URL.
+        reason: The error's reason.
+
+    """
+
+    def __init__(self, url, reason):
+        """Class init."""
+        super().__init__()
+        self.msg = f"Unable to fetch tile {url} ({reason})."
+
+
+class DeadlineExceededError(TrafficInfoError):
+    """
+    Base class for the phases which did not finish in time.
+
+    Attributes:
+        phase: The phase's name.
+        timeout: The phase's deadline in seconds.
+
+    """
+
+    def __init__(self, phase, timeout):
+        """Class init."""
+        super().__init__()
+        self.phase = phase
+        self.timeout = timeout
+        self.msg = f"The {phase} did not finish within {timeout}s."
+
+    def __str__(self):
+        """Get the error's message."""
+        return self.msg
+
+
+class DriverStartTimeoutError(DeadlineExceededError):
+    """Raised when the browser did not start in time."""
+
+    def __init__(self, timeout):
+        """Class init."""
+        super().__init__("browser start", timeout)
+
+
+class PageLoadTimeoutError(DeadlineExceededError):
+    """Raised when the map page did not load in time."""
+
+    def __init__(self, timeout):
+        """Class init."""
+        super().__init__("map page load", timeout)
+
+
+class ReadyTimeoutError(DeadlineExceededError):
+    """Raised when the wait for the map's readiness is stuck."""
+
+    def __init__(self, timeout):
+        """Class init."""
+        super().__init__("wait for the map's readiness", timeout)
+
+
+class ScreenshotTimeoutError(DeadlineExceededError):
+    """Raised when the screenshot was not taken in time."""
+
+    def __init__(self, timeout):
+        """Class init."""
+        super().__init__("screenshot", timeout)
+
+
+class SMTPConnectTimeoutError(DeadlineExceededError, TimeoutError):
+    """
+    Raised when the SMTP server did not answer in time while connecting.
+
+    It is a TimeoutError, so it is handled like the other connection errors.
+    """
+
+    def __init__(self, timeout):
+        """Class init."""
+        super().__init__("SMTP connection", timeout)
+
+
+class SMTPSendTimeoutError(DeadlineExceededError, TimeoutError):
+    """
+    Raised when the SMTP server did not answer in time while sending.
+
+    It is a TimeoutError, so it is handled like the other connection errors.
+    """
+
+    def __init__(self, timeout):
+        """Class init."""
+        super().__init__("SMTP send", timeout)
+
+
+class JobTimeoutError(DeadlineExceededError):
+    """Raised when a job did not finish within its budget."""
+
+    def __init__(self, timeout):
+        """Class init."""
+        super().__init__("job", timeout)
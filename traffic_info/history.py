@@ -0,0 +1,401 @@
+"""Screenshots history for traffic_info package."""
+from __future__ import annotations
+
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import mmap
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Sequence, Set, TYPE_CHECKING, Tuple
+
+if TYPE_CHECKING:
+    import sqlite3
+
+    from .core import Location
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    digest TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    location TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    weekday INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    image_format TEXT NOT NULL,
+    PRIMARY KEY (location, timestamp)
+);
+CREATE INDEX IF NOT EXISTS snapshots_weekday
+ON snapshots (location, weekday, timestamp);
+CREATE TABLE IF NOT EXISTS meta (generation INTEGER NOT NULL);
+INSERT INTO meta SELECT 0 WHERE NOT EXISTS (SELECT * FROM meta);
+"""
+
+
+@dataclass
+class Snapshot:
+    """
+    Snapshot class, a map recorded in the history.
+
+    Attributes:
+        location: The map's location as LATITUDE,LONGITUDE,ZOOM.
+        timestamp: When the map was captured, as returned by time.time().
+        digest: The SHA-256 hash of the map's image, see HistoryStore.read().
+        width: The map's width.
+        height: The map's height.
+        image_format: The image's format, e.g. "png".
+
+    """
+
+    location: str
+    timestamp: float
+    digest: str
+    width: int
+    height: int
+    image_format: str
+
+
+class HistoryStore:
+    """
+    HistoryStore class, keep every map captured for trend analysis.
+
+    The images are appended to a pack file once, identical frames are
+    stored once whatever the number of times they were captured. A SQLite
+    index maps the frames' hashes to their place in the pack, and the
+    snapshots, keyed by location and time, to their frame. Querying a
+    location's snapshots, e.g. on Mondays, only reads the index, and the
+    frames are read from the memory-mapped pack.
+
+    prune() removes the snapshots older than the retention, the frames no
+    longer used are removed from the pack when compacted.
+
+    It is thread-safe and several processes can share a history.
+
+    Args:
+        directory: The history's directory, created if needed.
+        retention: Number of days the snapshots are kept by prune(), they
+        are kept forever if not specified.
+
+    """
+
+    def __init__(self, directory: str, retention: float = None) -> None:
+        """Initialize a HistoryStore object with the given options."""
+        self.directory: str = directory
+        self.retention: float = retention
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._map: mmap.mmap = None
+        self._map_generation: int = None
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+
+    def __enter__(self) -> "HistoryStore":
+        """Use the history."""
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Unmap the pack file."""
+        self.close()
+
+    def close(self) -> None:
+        """Unmap the pack file, it is mapped again by the next read."""
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+                self._map_generation = None
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Open a connection to the index, committed when the context is left."""
+        import sqlite3  # pylint: disable=import-outside-toplevel
+
+        connection = sqlite3.connect(
+            os.path.join(self.directory, "index.sqlite"), timeout=30
+        )
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @contextlib.contextmanager
+    def _pack_lock(self) -> Iterator[None]:
+        """Lock the pack file, for the appends and compactions."""
+        lock_path = os.path.join(self.directory, "pack.lock")
+        with self._lock, open(lock_path, "a", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _pack_path(self, generation: int) -> str:
+        """Get the path of a pack file, a new one is written by each compaction."""
+        return os.path.join(self.directory, f"frames.{generation}.pack")
+
+    def add(
+        self,
+        location: Location | str,
+        data: bytes,
+        width: int,
+        height: int,
+        image_format: str = "png",
+        timestamp: float = None,
+    ) -> Snapshot:
+        """
+        Record a map.
+
+        Args:
+            location: The map's location.
+            data: The map's image.
+            width: The map's width.
+            height: The map's height.
+            image_format: The image's format, default "png".
+            timestamp: When the map was captured, now if not specified.
+
+        Returns:
+            The recorded snapshot.
+
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        snapshot = Snapshot(
+            str(location),
+            timestamp,
+            hashlib.sha256(data).hexdigest(),
+            width,
+            height,
+            image_format,
+        )
+        weekday = datetime.datetime.fromtimestamp(timestamp).weekday()
+        with self._pack_lock(), self._connect() as connection:
+            generation, known = connection.execute(
+                "SELECT generation, EXISTS (SELECT * FROM frames WHERE digest = ?) "
+                "FROM meta",
+                (snapshot.digest,),
+            ).fetchone()
+            if not known:
+                # The frame is written before it is indexed, so the index
+                # never points past the end of the pack
+                with open(self._pack_path(generation), "ab") as pack:
+                    offset = pack.seek(0, os.SEEK_END)
+                    pack.write(data)
+                connection.execute(
+                    "INSERT INTO frames VALUES (?, ?, ?)",
+                    (snapshot.digest, offset, len(data)),
+                )
+            connection.execute(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    snapshot.location,
+                    timestamp,
+                    weekday,
+                    snapshot.digest,
+                    width,
+                    height,
+                    image_format,
+                ),
+            )
+        return snapshot
+
+    def snapshots(
+        self,
+        location: Location | str,
+        start: float = None,
+        end: float = None,
+        weekday: int = None,
+    ) -> List[Snapshot]:
+        """
+        Get a location's snapshots.
+
+        Args:
+            location: The maps' location.
+            start: Only the snapshots taken at or after this time.
+            end: Only the snapshots taken before this time.
+            weekday: Only the snapshots taken on this day of the week, from 0
+            for Monday to 6 for Sunday.
+
+        Returns:
+            The snapshots by time.
+
+        """
+        conditions = ["location = ?"]
+        params = [str(location)]
+        if weekday is not None:
+            conditions.append("weekday = ?")
+            params.append(weekday)
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("timestamp < ?")
+            params.append(end)
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT location, timestamp, digest, width, height, image_format "
+                f"FROM snapshots WHERE {' AND '.join(conditions)} "
+                "ORDER BY timestamp",
+                params,
+            ).fetchall()
+        return [Snapshot(*row) for row in rows]
+
+    def read(self, digest: str) -> bytes:
+        """
+        Read a frame.
+
+        Args:
+            digest: The frame's hash, see Snapshot.
+
+        Returns:
+            The frame's image.
+
+        Raises:
+            KeyError: The frame is not in the history.
+
+        """
+        return self.read_many([digest])[0]
+
+    def read_many(self, digests: Sequence[str]) -> List[bytes]:
+        """
+        Read several frames, looked up in the index at once.
+
+        Args:
+            digests: The frames' hashes, see Snapshot.
+
+        Returns:
+            The frames' images, in the same order.
+
+        Raises:
+            KeyError: A frame is not in the history.
+
+        """
+        while True:
+            generation, frames = self._lookup(set(digests))
+            try:
+                with self._lock:
+                    for digest in digests:
+                        if digest not in frames:
+                            raise KeyError(digest)
+                    return [
+                        self._read(generation, *frames[digest]) for digest in digests
+                    ]
+            except FileNotFoundError:
+                # The pack was compacted since the frames were looked up
+                continue
+
+    def _lookup(self, digests: Set[str]) -> Tuple[int, Dict[str, Tuple[int, int]]]:
+        """Get the pack's generation and the frames' offsets and sizes."""
+        digests = list(digests)
+        frames = {}
+        with self._connect() as connection:
+            # A single read transaction, so all the frames are in the same pack
+            connection.execute("BEGIN")
+            generation = connection.execute("SELECT generation FROM meta").fetchone()[0]
+            # SQLite limits the number of parameters of a statement
+            for start in range(0, len(digests), 500):
+                chunk = digests[slice(start, start + 500)]
+                rows = connection.execute(
+                    "SELECT digest, offset, size FROM frames "
+                    f"WHERE digest IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                )
+                frames.update((digest, (offset, size)) for digest, offset, size in rows)
+        return generation, frames
+
+    def _read(self, generation: int, offset: int, size: int) -> bytes:
+        """Read bytes from a pack, map it again if it changed or grew, locked."""
+        stale = self._map_generation != generation
+        if not stale and len(self._map) < offset + size:
+            # Frames were appended since the pack was mapped
+            stale = True
+        if stale:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+                self._map_generation = None
+            with open(self._pack_path(generation), "rb") as pack:
+                self._map = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map_generation = generation
+        return self._map[slice(offset, offset + size)]
+
+    def prune(self, retention: float = None, min_garbage: float = 0.25) -> int:
+        """
+        Remove the old snapshots and compact the pack.
+
+        Args:
+            retention: Number of days the snapshots are kept, the history's
+            retention if not specified.
+            min_garbage: Compact the pack only if this share of it is unused,
+            default 0.25.
+
+        Returns:
+            The number of snapshots removed.
+
+        """
+        retention = self.retention if retention is None else retention
+        removed = 0
+        if retention is not None:
+            with self._connect() as connection:
+                removed = connection.execute(
+                    "DELETE FROM snapshots WHERE timestamp < ?",
+                    (time.time() - retention * 86400,),
+                ).rowcount
+        self.compact(min_garbage)
+        return removed
+
+    def compact(self, min_garbage: float = 0) -> int:
+        """
+        Remove the frames no longer used by any snapshot from the pack.
+
+        The frames used are copied to a new pack file, which replaces the
+        current one once indexed, so the history can be read meanwhile.
+
+        Args:
+            min_garbage: Compact the pack only if this share of it is unused,
+            default 0.
+
+        Returns:
+            The number of bytes freed.
+
+        """
+        with self._pack_lock(), self._connect() as connection:
+            connection.execute(
+                "DELETE FROM frames "
+                "WHERE digest NOT IN (SELECT DISTINCT digest FROM snapshots)"
+            )
+            generation = connection.execute("SELECT generation FROM meta").fetchone()[0]
+            frames = connection.execute(
+                "SELECT digest, offset, size FROM frames ORDER BY offset"
+            ).fetchall()
+            old_path = self._pack_path(generation)
+            try:
+                total = os.path.getsize(old_path)
+            except FileNotFoundError:
+                return 0
+            garbage = total - sum(size for _, _, size in frames)
+            if not garbage or garbage < min_garbage * total:
+                return 0
+            new_path = self._pack_path(generation + 1)
+            offsets = []
+            with open(old_path, "rb") as old_pack, open(new_path, "wb") as new_pack:
+                for digest, offset, size in frames:
+                    old_pack.seek(offset)
+                    offsets.append((new_pack.tell(), digest))
+                    new_pack.write(old_pack.read(size))
+                new_pack.flush()
+                os.fsync(new_pack.fileno())
+            connection.executemany(
+                "UPDATE frames SET offset = ? WHERE digest = ?", offsets
+            )
+            connection.execute("UPDATE meta SET generation = ?", (generation + 1,))
+        os.remove(old_path)
+        return garbage
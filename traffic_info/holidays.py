@@ -0,0 +1,138 @@
+"""Holidays index for traffic_info package."""
+import datetime
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Dict, FrozenSet, Iterable, Tuple
+
+from .exceptions import InvalidCountryCodeError
+
+
+def get_default_cache_dir() -> str:
+    """
+    Get the default cache directory.
+
+    Returns:
+        $XDG_CACHE_HOME/traffic_info or ~/.cache/traffic_info.
+
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "traffic_info")
+
+
+class HolidayIndex:
+    """
+    HolidayIndex class, a precomputed table of holidays.
+
+    The holidays of a country for a year are computed once with workalendar
+    and stored on disk, the next lookups only read this table. A new table
+    is built when the year changes.
+
+    Args:
+        cache_dir: The directory where the tables are stored,
+        see get_default_cache_dir() if not specified.
+
+    """
+
+    def __init__(self, cache_dir: str = None) -> None:
+        """Initialize a HolidayIndex object with the given options."""
+        self.cache_dir: str = cache_dir if cache_dir else get_default_cache_dir()
+        self._tables: Dict[Tuple[str, int], FrozenSet[int]] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, country_code: str, year: int) -> str:
+        """Get the path of a holidays table."""
+        return os.path.join(self.cache_dir, f"holidays-{country_code}-{year}.json")
+
+    @staticmethod
+    def _build(country_code: str, year: int) -> FrozenSet[int]:
+        """Compute the holidays of a country for a year with workalendar."""
+        # pylint: disable=import-outside-toplevel
+        from workalendar.registry import registry
+
+        calendar_class = registry.get(country_code)
+        if not calendar_class:
+            raise InvalidCountryCodeError(country_code)
+        return frozenset(day.toordinal() for day in calendar_class().holidays_set(year))
+
+    def _load(self, country_code: str, year: int) -> FrozenSet[int]:
+        """Load a holidays table from disk, build it if needed."""
+        path = self._path(country_code, year)
+        try:
+            with open(path, mode="r", encoding="utf-8") as table_file:
+                return frozenset(
+                    datetime.date.fromisoformat(day).toordinal()
+                    for day in json.load(table_file)
+                )
+        except (OSError, ValueError):
+            pass
+
+        table = self._build(country_code, year)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            file_descriptor, tmp_path = tempfile.mkstemp(
+                dir=self.cache_dir, suffix=".tmp"
+            )
+            with os.fdopen(file_descriptor, mode="w", encoding="utf-8") as tmp_file:
+                json.dump(
+                    sorted(datetime.date.fromordinal(day).isoformat() for day in table),
+                    tmp_file,
+                )
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            logging.getLogger(__name__).warning(
+                "Unable to save holidays table(%s)", exc
+            )
+        return table
+
+    def holidays(self, country_code: str, year: int) -> FrozenSet[int]:
+        """
+        Get the holidays of a country for a year.
+
+        Args:
+            country_code: Country code(ISO 3166-1/ISO 3166-2).
+            year: The year.
+
+        Returns:
+            The holidays as date ordinals.
+
+        """
+        key = (country_code.upper(), year)
+        table = self._tables.get(key)
+        if table is None:
+            with self._lock:
+                table = self._tables.get(key)
+                if table is None:
+                    table = self._load(*key)
+                    self._tables[key] = table
+        return table
+
+    def is_holiday(self, country_code: str, day: datetime.date) -> bool:
+        """
+        Check if a day is a holiday.
+
+        Args:
+            country_code: Country code(ISO 3166-1/ISO 3166-2).
+            day: The day to check.
+
+        Returns:
+            True if the day is a holiday in this country, False otherwise.
+
+        """
+        return day.toordinal() in self.holidays(country_code, day.year)
+
+    def any_holiday(self, country_codes: Iterable[str], day: datetime.date) -> bool:
+        """
+        Check if a day is a holiday in at least one of the given countries.
+
+        Args:
+            country_codes: Country codes(ISO 3166-1/ISO 3166-2).
+            day: The day to check.
+
+        Returns:
+            True if the day is a holiday in one of these countries.
+
+        """
+        return any(self.is_holiday(code, day) for code in country_codes)
@@ -0,0 +1,147 @@
+"""Screenshots post-processing for traffic_info package."""
+from __future__ import annotations
+
+import io
+from typing import Dict, Tuple
+
+FORMATS: Dict[str, str] = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+EXTENSIONS: Dict[str, str] = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+
+
+class ImageProcessor:
+    """
+    ImageProcessor class, make the screenshots lighter before sending them.
+
+    Screenshots are cropped, resized to the wanted pixel density, then saved
+    as an optimized PNG, a palette PNG, a JPEG or a WebP image. Sizes are in
+    CSS pixels, the screenshot's size in the page, so the same options work
+    whatever the browser's device scale factor.
+
+    It requires Pillow, install it with the images extra:
+    pip install traffic_info[images].
+
+    Args:
+        image_format: The output format, "png", "jpeg" or "webp",
+        default "png".
+        quality: JPEG and WebP quality from 1 to 100, default 80.
+        colors: Reduce PNG images to a palette of this many colors, at most
+        256. Maps have few colors so 64 is usually enough, by default the
+        image is only losslessly optimized.
+        crop: Pixels removed from the left, top, right and bottom edges,
+        e.g. to remove the map's controls.
+        scale: Output pixels per CSS pixel, e.g. 2 for retina screens from a
+        screenshot taken with a device scale factor of 2, or 1 to downscale
+        it, default 1.
+
+    """
+
+    def __init__(
+        self,
+        image_format: str = "png",
+        quality: int = 80,
+        colors: int = None,
+        crop: Tuple[int, int, int, int] = None,
+        scale: float = 1,
+    ) -> None:
+        """Initialize an ImageProcessor object with the given options."""
+        if image_format not in FORMATS:
+            raise ValueError(f"Invalid image format: {image_format}")
+        if colors is not None and not 2 <= colors <= 256:
+            raise ValueError(f"Invalid number of colors: {colors}")
+        self.image_format: str = image_format
+        self.quality: int = quality
+        self.colors: int = colors
+        self.crop: Tuple[int, int, int, int] = crop or (0, 0, 0, 0)
+        self.scale: float = scale
+
+    @property
+    def extension(self) -> str:
+        """The file extension of the output format."""
+        return EXTENSIONS[self.image_format]
+
+    def size(self, width: int, height: int) -> Tuple[int, int]:
+        """
+        Get the size of a processed screenshot in CSS pixels.
+
+        Args:
+            width: The screenshot's width.
+            height: The screenshot's height.
+
+        Returns:
+            The width and height once cropped.
+
+        """
+        left, top, right, bottom = self.crop
+        return width - left - right, height - top - bottom
+
+    def origin(self, width: int, height: int) -> Tuple[float, float]:
+        """
+        Get the pixel coordinates of the map's center on a processed screenshot.
+
+        Args:
+            width: The screenshot's width.
+            height: The screenshot's height.
+
+        Returns:
+            The x and y coordinates in output pixels.
+
+        """
+        left, top, _, _ = self.crop
+        return (width / 2 - left) * self.scale, (height / 2 - top) * self.scale
+
+    def process(self, image: bytes, width: int, height: int) -> bytes:
+        """
+        Process a screenshot.
+
+        Args:
+            image: The screenshot, e.g. a PNG image.
+            width: The screenshot's width in CSS pixels.
+            height: The screenshot's height in CSS pixels.
+
+        Returns:
+            The processed image, the screenshot itself if it is neither
+            cropped nor resized and already in the output format, unless the
+            processed image is smaller.
+
+        """
+        # pylint: disable=import-outside-toplevel
+        from PIL import Image
+
+        with Image.open(io.BytesIO(image)) as decoded:
+            unchanged = decoded.format == FORMATS[self.image_format]
+            picture = decoded.convert("RGB")
+        density = picture.width / width
+        left, top, right, bottom = self.crop
+        if any(self.crop):
+            unchanged = False
+            picture = picture.crop(
+                (
+                    round(left * density),
+                    round(top * density),
+                    picture.width - round(right * density),
+                    picture.height - round(bottom * density),
+                )
+            )
+        cropped_width, cropped_height = self.size(width, height)
+        target = (round(cropped_width * self.scale), round(cropped_height * self.scale))
+        if picture.size != target:
+            unchanged = False
+            picture = picture.resize(target, Image.Resampling.LANCZOS)
+
+        output = io.BytesIO()
+        if self.image_format != "png":
+            picture.save(
+                output, FORMATS[self.image_format], quality=self.quality, method=4
+            )
+        else:
+            if self.colors is not None:
+                picture = picture.quantize(
+                    self.colors,
+                    method=Image.Quantize.FASTOCTREE,
+                    dither=Image.Dither.NONE,
+                )
+            picture.save(output, "PNG", optimize=True)
+        if unchanged and output.tell() >= len(image):
+            # Re-encoding the screenshot would only make it heavier
+            return image
+        return output.getvalue()
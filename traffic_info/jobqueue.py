@@ -0,0 +1,307 @@
+"""Jobs sharing between hosts for traffic_info package."""
+from __future__ import annotations
+
+import contextlib
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable, Iterator, List, Sequence, Set, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import sqlite3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    window_key TEXT NOT NULL,
+    job TEXT NOT NULL,
+    worker TEXT NOT NULL,
+    lease_until REAL NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (window_key, job)
+)
+"""
+
+# A job is claimed if it was never claimed in this window, or if the lease of
+# the worker which claimed it expired before the job was done.
+_CLAIM = """
+INSERT INTO runs (window_key, job, worker, lease_until) VALUES (?, ?, ?, ?)
+ON CONFLICT (window_key, job) DO UPDATE
+SET worker = excluded.worker, lease_until = excluded.lease_until
+WHERE runs.done = 0 AND runs.lease_until < ?
+"""
+
+
+class JobQueue:
+    """
+    JobQueue class, share the jobs between several hosts.
+
+    The jobs of a schedule window are listed in a SQLite database on shared
+    storage. Each worker claims the jobs one at a time with a lease it
+    renews while the job runs, so the faster workers run more jobs and each
+    job runs once per window. When a worker dies, its lease expires and
+    another worker runs the job.
+
+    The database must be on a filesystem where SQLite's locks work, e.g.
+    NFS with locking enabled, and the hosts' clocks must be synchronized.
+
+    Args:
+        path: The database's path, created if needed.
+        lease_time: Seconds a worker keeps a job without renewing its lease,
+        default 120.
+        poll_interval: Seconds between two checks of the jobs run by other
+        workers, default 5.
+        retention: Days the runs are kept in the database, default 7.
+        worker: The worker's name, HOSTNAME:PID if not specified.
+
+    """
+
+    def __init__(
+        self,
+        path: str,
+        lease_time: float = 120,
+        poll_interval: float = 5,
+        retention: float = 7,
+        worker: str = None,
+    ) -> None:
+        """Initialize a JobQueue object with the given options."""
+        self.path: str = path
+        self.lease_time: float = lease_time
+        self.poll_interval: float = poll_interval
+        self.retention: float = retention
+        self.worker: str = worker or f"{socket.gethostname()}:{os.getpid()}"
+        with self._connect() as connection:
+            connection.execute(_SCHEMA)
+        self.prune()
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Open a connection to the database, each statement is committed."""
+        import sqlite3  # pylint: disable=import-outside-toplevel
+
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def prune(self) -> None:
+        """Remove the runs older than the retention."""
+        before = time.time() - self.retention * 86400
+        with self._connect() as connection:
+            connection.execute("DELETE FROM runs WHERE lease_until < ?", (before,))
+
+    def claim(self, window: str, job: str) -> bool:
+        """
+        Claim a job.
+
+        Args:
+            window: The schedule window, e.g. the fire time.
+            job: The job's key.
+
+        Returns:
+            True if the job was claimed, False if it is done or another
+            worker's lease on it is still valid.
+
+        """
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                _CLAIM, (window, job, self.worker, now + self.lease_time, now)
+            )
+            return cursor.rowcount == 1
+
+    def renew(self, window: str, job: str) -> bool:
+        """
+        Renew the lease on a claimed job.
+
+        Args:
+            window: The schedule window.
+            job: The job's key.
+
+        Returns:
+            False if the lease was lost, e.g. it expired and another worker
+            claimed the job, True otherwise.
+
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE runs SET lease_until = ? "
+                "WHERE window_key = ? AND job = ? AND worker = ? AND done = 0",
+                (time.time() + self.lease_time, window, job, self.worker),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, window: str, job: str) -> bool:
+        """
+        Mark a job claimed by this worker as done.
+
+        Args:
+            window: The schedule window.
+            job: The job's key.
+
+        Returns:
+            False if the job was claimed by another worker meanwhile, True
+            otherwise.
+
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE runs SET done = 1, lease_until = ? "
+                "WHERE window_key = ? AND job = ? AND worker = ?",
+                (time.time(), window, job, self.worker),
+            )
+            return cursor.rowcount == 1
+
+    def release(self, window: str, job: str) -> None:
+        """
+        Release a claimed job, for another worker to run it.
+
+        Args:
+            window: The schedule window.
+            job: The job's key.
+
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "DELETE FROM runs "
+                "WHERE window_key = ? AND job = ? AND worker = ? AND done = 0",
+                (window, job, self.worker),
+            )
+
+    def pending(self, window: str, jobs: Sequence[str]) -> List[str]:
+        """
+        Get the jobs not done yet.
+
+        Args:
+            window: The schedule window.
+            jobs: The jobs' keys.
+
+        Returns:
+            The keys of the jobs not done.
+
+        """
+        with self._connect() as connection:
+            done = {
+                job
+                for job, in connection.execute(
+                    "SELECT job FROM runs WHERE window_key = ? AND done = 1",
+                    (window,),
+                )
+            }
+        return [job for job in jobs if job not in done]
+
+    def _run_by_others(self, window: str, jobs: Sequence[str]) -> bool:
+        """Check if some jobs are claimed by other workers."""
+        with self._connect() as connection:
+            claimed = {
+                job
+                for job, in connection.execute(
+                    "SELECT job FROM runs "
+                    "WHERE window_key = ? AND worker != ? AND done = 0",
+                    (window, self.worker),
+                )
+            }
+        return any(job in claimed for job in jobs)
+
+    @contextlib.contextmanager
+    def _leased(self, window: str, job: str) -> Iterator[Callable[[], bool]]:
+        """Renew the lease on a job until the context is left."""
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease_time / 3):
+                if not self.renew(window, job):
+                    logging.getLogger(__name__).warning("Lease on job %s lost", job)
+                    lost.set()
+                    return
+
+        def confirm() -> bool:
+            # Renewed, the lease is held for lease_time seconds from now on
+            if lost.is_set() or not self.renew(window, job):
+                lost.set()
+                return False
+            return True
+
+        thread = threading.Thread(target=renew, name="lease", daemon=True)
+        thread.start()
+        try:
+            yield confirm
+        finally:
+            stop.set()
+            thread.join()
+
+    def process(
+        self,
+        window: str,
+        jobs: Sequence[str],
+        run: Callable[[str, Callable[[], bool]], bool],
+        deadline: float = None,
+        stop: threading.Event = None,
+    ) -> List[str]:
+        """
+        Run the jobs of a window not run by another worker.
+
+        The jobs are claimed one at a time. Once there is nothing left to
+        claim, the worker waits for the jobs run by the other workers, and
+        runs those whose lease expired. A job which failed is released for
+        the other workers, this worker does not retry it.
+
+        It is thread-safe, several threads of a worker can process the same
+        window.
+
+        Args:
+            window: The schedule window, e.g. the fire time.
+            jobs: The jobs' keys.
+            run: Run a job given its key and a callable confirming the lease
+            is still held, to be called right before the job's side effects,
+            e.g. sending an email. Return False if it failed or the lease was
+            lost.
+            deadline: Stop waiting for the other workers at this time, as
+            returned by time.time().
+            stop: Stop waiting for the other workers when this event is set.
+
+        Returns:
+            The keys of the jobs run by this worker.
+
+        """
+        logger = logging.getLogger(__name__)
+        done: List[str] = []
+        failed: Set[str] = set()
+        while True:
+            pending = [job for job in self.pending(window, jobs) if job not in failed]
+            if not pending:
+                break
+            claimed = next((job for job in pending if self.claim(window, job)), None)
+            if claimed is None:
+                # The jobs left are run by other workers, or by other threads
+                # of this worker which don't need to be waited for
+                if not self._run_by_others(window, pending):
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    logger.warning(
+                        "%s job(s) not done in window %s", len(pending), window
+                    )
+                    break
+                if stop is None:
+                    time.sleep(self.poll_interval)
+                elif stop.wait(self.poll_interval):
+                    break
+                continue
+            with self._leased(window, claimed) as confirm:
+                try:
+                    success = run(claimed, confirm)
+                except BaseException:
+                    self.release(window, claimed)
+                    raise
+            if success:
+                if self.complete(window, claimed):
+                    done.append(claimed)
+                else:
+                    logger.warning("Job %s was taken over by another worker", claimed)
+            else:
+                self.release(window, claimed)
+                failed.add(claimed)
+        return done
@@ -0,0 +1,160 @@
+"""Timing instrumentation for traffic_info package."""
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Iterable, Iterator, Set, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_HELP = {
+    "phase_duration_seconds": "Duration of each phase of the last run.",
+    "screenshot_bytes": "Size of the last screenshot.",
+    "image_bytes": "Size of the last screenshot once processed.",
+    "email_bytes": "Size of the last email.",
+    "outbox_queued_emails": "Number of emails in the outbox.",
+    "outbox_dead_letters": "Number of emails which could not be sent.",
+    "congestion_score": "Congestion score of the last screenshot.",
+    "load_time_seconds": "Time to load and draw the last map.",
+    "network_bytes": "Bytes downloaded to draw the last map.",
+    "serve_latency_seconds": "Time to answer the last map request.",
+    "last_run_timestamp_seconds": "Time of the last metrics update.",
+}
+
+
+def _escape(label: str) -> str:
+    """Escape a label value for Prometheus text format."""
+    return label.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Metrics class, record the duration of each phase and the data sizes.
+
+    Each measure is logged as a JSON line by the traffic_info.metrics logger,
+    write_textfile() exports the last values for Prometheus node_exporter's
+    textfile collector.
+
+    Args:
+        enabled: Record the measures, default False.
+        dropped_labels: Labels left out of the last values, e.g. the location
+        when the clients choose it, so their number stays bounded. They are
+        still logged.
+
+    """
+
+    def __init__(
+        self, enabled: bool = False, dropped_labels: Iterable[str] = ()
+    ) -> None:
+        """Initialize a Metrics object."""
+        self.enabled: bool = enabled
+        self.dropped_labels: Set[str] = set(dropped_labels)
+        self._values: Dict[Tuple[str, Labels], float] = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    def record(self, name: str, value: float, **labels: str) -> None:
+        """
+        Record a measure.
+
+        Args:
+            name: The measure's name.
+            value: The measure's value.
+            labels: The measure's labels, e.g. the location.
+
+        """
+        if not self.enabled:
+            return
+        kept = {
+            label: text
+            for label, text in labels.items()
+            if label not in self.dropped_labels
+        }
+        key = (name, tuple(sorted(kept.items())))
+        with self._lock:
+            self._values[key] = value
+        self._logger.info(json.dumps({"metric": name, "value": value, **labels}))
+
+    @contextlib.contextmanager
+    def phase(self, name: str, **labels: str) -> Iterator[None]:
+        """
+        Measure the duration of a phase.
+
+        Args:
+            name: The phase's name.
+            labels: The phase's labels, e.g. the location.
+
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(
+                "phase_duration_seconds",
+                time.perf_counter() - start,
+                phase=name,
+                **labels,
+            )
+
+    def values(self) -> Dict[Tuple[str, Labels], float]:
+        """
+        Get the last value of each measure.
+
+        Returns:
+            The values by measure's name and labels.
+
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def to_prometheus(self) -> str:
+        """
+        Format the last values in Prometheus text format.
+
+        Returns:
+            The metrics in Prometheus text format.
+
+        """
+        values = self.values()
+        values[("last_run_timestamp_seconds", ())] = time.time()
+        lines = []
+        for name in sorted({name for name, _ in values}):
+            metric = f"traffic_info_{name}"
+            lines.append(f"# HELP {metric} {_HELP.get(name, name)}")
+            lines.append(f"# TYPE {metric} gauge")
+            for (other, labels), value in sorted(values.items()):
+                if other != name:
+                    continue
+                label_text = ",".join(
+                    f'{key}="{_escape(label)}"' for key, label in labels
+                )
+                if label_text:
+                    label_text = f"{{{label_text}}}"
+                lines.append(f"{metric}{label_text} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        """
+        Write the metrics for Prometheus node_exporter's textfile collector.
+
+        The file is replaced atomically so it is never read half written.
+
+        Args:
+            path: The path of the .prom file.
+
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(file_descriptor, mode="w", encoding="utf-8") as tmp_file:
+            tmp_file.write(self.to_prometheus())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics()
@@ -0,0 +1,473 @@
+"""Durable outbox for traffic_info package."""
+from __future__ import annotations
+
+import copy
+import fcntl
+import json
+import logging
+import os
+import smtplib
+import tempfile
+import threading
+import time
+import uuid
+from email.message import EmailMessage
+from typing import Dict, List, Sequence, Tuple
+
+from .core import SMTPServer, envelope
+from .metrics import metrics
+
+
+def _is_permanent(exception: Exception) -> bool:
+    """Check if a SMTP error won't go away by retrying."""
+    if isinstance(exception, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in exception.recipients.values())
+    if isinstance(exception, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+        return exception.smtp_code >= 500
+    return isinstance(exception, smtplib.SMTPNotSupportedError)
+
+
+class Outbox:
+    """
+    Outbox class, a durable on-disk spool of emails.
+
+    send_message() and sendmail() write the serialized email to the outbox
+    and return at once, so an Outbox can replace the SMTPServer given to
+    send_email() for the jobs not to wait for the SMTP server. The emails are sent by an
+    OutboxSender, those which could not be sent stay in the outbox and are
+    retried with an exponential backoff, so none is lost when the SMTP
+    server is down or the process restarts. The emails refused by the SMTP
+    server, or which failed max_attempts times, are moved to the dead
+    letters.
+
+    Several threads and processes can send the emails of the same outbox,
+    each email is sent by only one of them.
+
+    Args:
+        directory: The outbox's directory, created if needed.
+        max_attempts: Maximum number of attempts to send an email,
+        default 10.
+        backoff: Seconds to wait before retrying an email, doubled after
+        each attempt, default 30.
+        max_backoff: Maximum seconds to wait before retrying an email,
+        default 3600.
+
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_attempts: int = 10,
+        backoff: float = 30,
+        max_backoff: float = 3600,
+    ) -> None:
+        """Initialize an Outbox object with the given options."""
+        self.directory: str = directory
+        self.max_attempts: int = max_attempts
+        self.backoff: float = backoff
+        self.max_backoff: float = max_backoff
+        self._queue: str = os.path.join(directory, "queue")
+        self._dead: str = os.path.join(directory, "dead")
+        os.makedirs(self._queue, exist_ok=True)
+        os.makedirs(self._dead, exist_ok=True)
+        self._version: int = 0
+        self._changed = threading.Condition()
+
+    def connect(self) -> None:
+        """Do nothing, the outbox needs no connection, see SMTPServer."""
+
+    def close(self) -> None:
+        """Do nothing, the outbox needs no connection, see SMTPServer."""
+
+    def _path(self, not_before: float, attempts: int, message_id: str) -> str:
+        """Get the path of a queued email, the names sort by due time."""
+        name = f"{int(not_before * 1000):015d}-{attempts:03d}-{message_id}.eml"
+        return os.path.join(self._queue, name)
+
+    @staticmethod
+    def _parse(path: str) -> Tuple[float, int, str]:
+        """Get the due time, attempts and id of a queued email from its path."""
+        not_before, attempts, message_id = os.path.basename(path)[:-4].split("-", 2)
+        return int(not_before) / 1000, int(attempts), message_id
+
+    def send_message(self, email: EmailMessage, to_addrs: Sequence[str] = None) -> str:
+        """
+        Queue an email message.
+
+        Args:
+            email: The email message to send.
+            to_addrs: The envelope's recipients, the email's To, Cc and Bcc
+            addresses if not specified.
+
+        Returns:
+            The queued email's id.
+
+        """
+        return self.put(*envelope(email, to_addrs))
+
+    def put(
+        self,
+        from_addr: str,
+        to_addrs: Sequence[str],
+        message: bytes,
+        mail_options: Sequence[str] = (),
+    ) -> str:
+        """
+        Queue a serialized email.
+
+        The envelope is written on the file's first line, the email follows.
+        The file is synced before it is moved to the queue, so it is either
+        fully queued or not at all.
+
+        Args:
+            from_addr: The envelope's sender.
+            to_addrs: The envelope's recipients.
+            message: The email message, see envelope().
+            mail_options: The MAIL command's options.
+
+        Returns:
+            The queued email's id.
+
+        """
+        message_id = uuid.uuid4().hex
+        header = {"from": from_addr, "to": list(to_addrs), "options": mail_options}
+        with metrics.phase("outbox_put"):
+            file_descriptor, tmp_path = tempfile.mkstemp(
+                dir=self.directory, suffix=".tmp"
+            )
+            with os.fdopen(file_descriptor, "wb") as tmp_file:
+                tmp_file.write(json.dumps(header).encode() + b"\n")
+                tmp_file.write(message)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self._path(time.time(), 0, message_id))
+        self.notify()
+        return message_id
+
+    def sendmail(
+        self,
+        from_addr: str,
+        to_addrs: Sequence[str],
+        message: bytes,
+        mail_options: Sequence[str] = (),
+    ) -> Dict[str, Tuple[int, bytes]]:
+        """
+        Queue a serialized email, in place of the SMTP server's sendmail.
+
+        Args:
+            from_addr: The envelope's sender.
+            to_addrs: The envelope's recipients.
+            message: The email message, see envelope().
+            mail_options: The MAIL command's options.
+
+        Returns:
+            No refused recipients, they are only known once the email is sent.
+
+        """
+        self.put(from_addr, to_addrs, message, mail_options)
+        return {}
+
+    @property
+    def version(self) -> int:
+        """The number of notify() calls, to wait for the next one."""
+        return self._version
+
+    def notify(self) -> None:
+        """Wake up the threads waiting for new emails."""
+        with self._changed:
+            self._version += 1
+            self._changed.notify_all()
+
+    def wait(self, version: int, timeout: float = None) -> bool:
+        """
+        Wait for new emails queued by this process.
+
+        Args:
+            version: The version read before looking for emails to send.
+            timeout: Maximum time to wait in seconds.
+
+        Returns:
+            True if the outbox changed since the version, False on timeout.
+
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: self._version != version, timeout)
+
+    def queued(self) -> List[str]:
+        """
+        Get the queued emails by due time.
+
+        Returns:
+            The queued emails' paths.
+
+        """
+        return sorted(
+            entry.path
+            for entry in os.scandir(self._queue)
+            if entry.name.endswith(".eml")
+        )
+
+    def dead_letters(self) -> List[str]:
+        """
+        Get the emails which could not be sent.
+
+        Returns:
+            The dead letters' paths.
+
+        """
+        return sorted(
+            entry.path
+            for entry in os.scandir(self._dead)
+            if entry.name.endswith(".eml")
+        )
+
+    def due(self) -> List[str]:
+        """
+        Get the queued emails to send now.
+
+        Returns:
+            The emails' paths by due time.
+
+        """
+        now = time.time()
+        paths = self.queued()
+        for index, path in enumerate(paths):
+            if self._parse(path)[0] > now:
+                return paths[:index]
+        return paths
+
+    def requeue(self) -> int:
+        """
+        Queue the dead letters again, with a new number of attempts.
+
+        Returns:
+            The number of emails queued.
+
+        """
+        paths = self.dead_letters()
+        for path in paths:
+            message_id = os.path.basename(path)[:-4]
+            os.replace(path, self._path(time.time(), 0, message_id))
+        if paths:
+            self.notify()
+        return len(paths)
+
+    def deliver(self, path: str, smtp_server: SMTPServer) -> bool:
+        """
+        Try to send a queued email.
+
+        The email is locked while it is sent, it is skipped if another
+        thread or process is sending it or already sent it. It is removed
+        once sent, retried later or moved to the dead letters on errors.
+
+        Args:
+            path: The queued email's path, see due().
+            smtp_server: The SMTP server used to send the email.
+
+        Returns:
+            True if the email was sent, False otherwise.
+
+        """
+        try:
+            queued_file = open(path, "rb")  # pylint: disable=consider-using-with
+        except FileNotFoundError:
+            return False
+        with queued_file:
+            try:
+                fcntl.flock(queued_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            # The email was sent or moved since it was listed
+            try:
+                if os.stat(path).st_ino != os.fstat(queued_file.fileno()).st_ino:
+                    return False
+            except FileNotFoundError:
+                return False
+            header = json.loads(queued_file.readline())
+            message = queued_file.read()
+            try:
+                refused = smtp_server.sendmail(
+                    header["from"], header["to"], message, header["options"]
+                )
+            except (OSError, smtplib.SMTPException) as exception:
+                self._failed(path, exception)
+                return False
+            os.remove(path)
+        if refused:
+            logging.getLogger(__name__).warning(
+                "Email %s refused for %s", self._parse(path)[2], ", ".join(refused)
+            )
+        return True
+
+    def _failed(self, path: str, exception: Exception) -> None:
+        """Retry an email later, or move it to the dead letters."""
+        logger = logging.getLogger(__name__)
+        _, attempts, message_id = self._parse(path)
+        attempts += 1
+        if attempts >= self.max_attempts or _is_permanent(exception):
+            os.replace(path, os.path.join(self._dead, f"{message_id}.eml"))
+            logger.error(
+                "Unable to send email %s after %s attempt(s), moved to the dead "
+                "letters(%s)",
+                message_id,
+                attempts,
+                exception,
+            )
+            return
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        os.replace(path, self._path(time.time() + delay, attempts, message_id))
+        logger.warning(
+            "Unable to send email %s, retrying in %s seconds(%s)",
+            message_id,
+            delay,
+            exception,
+        )
+
+    def send_due(self, smtp_server: SMTPServer, stop: threading.Event = None) -> int:
+        """
+        Send the emails due now.
+
+        Args:
+            smtp_server: The SMTP server used to send the emails.
+            stop: Stop sending when this event is set.
+
+        Returns:
+            The number of emails sent.
+
+        Raises:
+            OSError, smtplib.SMTPException: The connection to the SMTP server
+            failed, the emails stay queued.
+
+        """
+        sent = 0
+        for path in self.due():
+            if stop is not None and stop.is_set():
+                break
+            smtp_server.connect()
+            with metrics.phase("outbox_send"):
+                if self.deliver(path, smtp_server):
+                    sent += 1
+        if metrics.enabled:
+            metrics.record("outbox_queued_emails", len(self.queued()))
+            metrics.record("outbox_dead_letters", len(self.dead_letters()))
+        return sent
+
+
+class OutboxSender:
+    """
+    OutboxSender class, send an outbox's emails in background threads.
+
+    Each thread has its own connection to the SMTP server, so at most
+    max_connections connections are opened to it. The threads send the
+    emails due, then wait for new ones or for the next retry. When the
+    SMTP server can't be reached, they try again after a delay doubled
+    after each failure, up to the outbox's max_backoff.
+
+    Use it as a context manager, the emails due are sent before leaving it.
+
+    Args:
+        outbox: The outbox to send the emails of.
+        smtp_server: The SMTP server used to send the emails, each thread
+        uses a copy of it.
+        max_connections: Maximum number of connections to the SMTP server,
+        default 2.
+        poll_interval: Seconds between two checks for emails to retry or
+        queued by other processes, default 5.
+
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        smtp_server: SMTPServer,
+        max_connections: int = 2,
+        poll_interval: float = 5,
+    ) -> None:
+        """Initialize an OutboxSender object with the given options."""
+        self.outbox: Outbox = outbox
+        self.smtp_server: SMTPServer = smtp_server
+        self.max_connections: int = max_connections
+        self.poll_interval: float = poll_interval
+        self._threads: List[threading.Thread] = []
+        self._closing = threading.Event()
+        self._stop = threading.Event()
+
+    def __enter__(self) -> "OutboxSender":
+        """Start sending the emails, see start()."""
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Send the emails due and stop."""
+        self.close()
+
+    def start(self) -> None:
+        """Start the sending threads."""
+        if self._threads:
+            return
+        self._closing.clear()
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"outbox-{index}", daemon=True)
+            for index in range(self.max_connections)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def close(self) -> None:
+        """Send the emails due, then stop the threads."""
+        self._closing.set()
+        self._join()
+
+    def stop(self) -> None:
+        """Stop the threads once their current emails are sent."""
+        self._stop.set()
+        self._closing.set()
+        self._join()
+
+    def _join(self) -> None:
+        """Wake up the threads and wait for them."""
+        self.outbox.notify()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self) -> None:
+        """Send the emails until the sender is closed."""
+        logger = logging.getLogger(__name__)
+        smtp_server = copy.copy(self.smtp_server)
+        delay = self.poll_interval
+        try:
+            while not self._stop.is_set():
+                version = self.outbox.version
+                try:
+                    sent = self.outbox.send_due(smtp_server, self._stop)
+                except (OSError, smtplib.SMTPException) as exception:
+                    smtp_server.close()
+                    if self._closing.is_set():
+                        logger.error(
+                            "Unable to connect to SMTP server, the emails stay "
+                            "in the outbox(%s)",
+                            exception,
+                        )
+                        break
+                    logger.error(
+                        "Unable to connect to SMTP server, retrying in %s "
+                        "seconds(%s)",
+                        delay,
+                        exception,
+                    )
+                    self._closing.wait(delay)
+                    delay = min(delay * 2, self.outbox.max_backoff)
+                    continue
+                delay = self.poll_interval
+                if sent:
+                    continue
+                if self._closing.is_set():
+                    break
+                if not self.outbox.wait(version, self.poll_interval):
+                    # Idle, don't keep the connection open until the server
+                    # drops it
+                    smtp_server.close()
+        finally:
+            smtp_server.close()
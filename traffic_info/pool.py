@@ -0,0 +1,275 @@
+"""Parallel screenshots for traffic_info package."""
+import contextlib
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Sequence
+
+from .core import Capture, Location, MapScreenshot, Viewport
+from .exceptions import DeadlineExceededError, JobTimeoutError, TileFetchError
+from .utils import get_available_memory
+
+
+def _completed(futures: Dict[Future, Location]) -> Iterator[Any]:
+    """Get the futures' results in completion order, log and skip the failures."""
+    # pylint: disable=import-outside-toplevel
+    from selenium.common.exceptions import WebDriverException
+
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except JobTimeoutError:
+            raise
+        except (DeadlineExceededError, TileFetchError, WebDriverException) as exc:
+            logging.getLogger(__name__).error(
+                "Unable to take the screenshot of %s(%s)", futures[future], exc.msg
+            )
+            continue
+        yield result
+
+
+class ScreenshotPool:
+    """
+    ScreenshotPool class, take screenshots with a pool of browsers.
+
+    Each worker thread owns its own MapScreenshot browser session, captures are
+    yielded as soon as they are taken so they can be sent while the other
+    locations are still being rendered.
+
+    Args:
+        max_workers: Maximum number of browsers running at the same time,
+        default 2.
+        browser_memory: Estimated memory used by one browser in MiB,
+        default 300.
+        memory_reserve: Memory in MiB to always keep available, a new
+        screenshot waits while less memory is available, default 256.
+        screenshot_params: MapScreenshot's arguments used for each browser.
+
+    """
+
+    _admission_poll: float = 0.5
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        browser_memory: int = 300,
+        memory_reserve: int = 256,
+        **screenshot_params: Any,
+    ) -> None:
+        """Initialize a ScreenshotPool object with the given options."""
+        self.max_workers: int = max_workers
+        self.browser_memory: int = browser_memory
+        self.memory_reserve: int = memory_reserve
+        self.screenshot_params: Dict[str, Any] = screenshot_params
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._screenshots: List[MapScreenshot] = []
+        self._running: int = 0
+        self._count = itertools.count()
+        self._executor: ThreadPoolExecutor = None
+        self._started_workers: int = 0
+
+    def __enter__(self) -> "ScreenshotPool":
+        """Start the pool's workers."""
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Stop the pool's workers and their browsers."""
+        self.close()
+
+    @property
+    def workers(self) -> int:
+        """Number of workers allowed by max_workers and the available memory."""
+        available = get_available_memory()
+        if available is None:
+            return self.max_workers
+        allowed = (available - self.memory_reserve) // self.browser_memory
+        return max(1, min(self.max_workers, allowed))
+
+    def start(self) -> None:
+        """Start the pool's workers."""
+        if self._executor is None:
+            workers = self.workers
+            if workers < self.max_workers:
+                logging.getLogger(__name__).warning(
+                    "Not enough memory for %s browsers, using %s",
+                    self.max_workers,
+                    workers,
+                )
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="screenshot"
+            )
+            self._started_workers = workers
+
+    def close(self) -> None:
+        """Stop the pool's workers and their browsers."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        with self._lock:
+            for screenshot in self._screenshots:
+                screenshot.stop()
+
+    def kill(self, error: Callable[[], DeadlineExceededError] = None) -> None:
+        """
+        Kill all the pool's browsers, e.g. when a job's budget is exceeded.
+
+        Args:
+            error: Create the error raised instead of each browser's current
+            call's error, e.g. functools.partial(JobTimeoutError, 60).
+
+        """
+        with self._lock:
+            screenshots = list(self._screenshots)
+        for screenshot in screenshots:
+            screenshot.kill(None if error is None else error())
+
+    def prepare(self, location: Location = None) -> None:
+        """
+        Start all the pool's browsers ahead of the first screenshots.
+
+        Args:
+            location: Load this location's map in each browser.
+
+        """
+        self.start()
+        # The workers wait for each other, so each one starts its own browser
+        workers = self._started_workers
+        barrier = threading.Barrier(workers)
+
+        def start_browser():
+            barrier.wait()
+            screenshot = self._screenshot()
+            if location is not None:
+                screenshot.prepare(location)
+
+        futures = [self._executor.submit(start_browser) for _ in range(workers)]
+        for future in futures:
+            future.result()
+
+    def _admit(self) -> None:
+        """Wait until there is enough memory available to take a screenshot."""
+        while True:
+            with self._lock:
+                available = get_available_memory()
+                # Always let one screenshot run so the pool can't stall
+                enough_memory = available is None or available >= self.memory_reserve
+                if enough_memory or self._running == 0:
+                    self._running += 1
+                    return
+            time.sleep(self._admission_poll)
+
+    def _screenshot(self) -> MapScreenshot:
+        """Get the current worker's browser session, start it if needed."""
+        screenshot = getattr(self._local, "screenshot", None)
+        if screenshot is None:
+            screenshot = MapScreenshot(**self.screenshot_params)
+            with self._lock:
+                self._screenshots.append(screenshot)
+            self._local.screenshot = screenshot
+        # The browser is started again after a failure
+        screenshot.start()
+        return screenshot
+
+    @contextlib.contextmanager
+    def _running_screenshot(self) -> Iterator[MapScreenshot]:
+        """Get the current worker's browser session, stop it on failure."""
+        self._admit()
+        try:
+            screenshot = self._screenshot()
+            try:
+                yield screenshot
+            except Exception:
+                # The browser may be broken, the next screenshot starts a new one
+                screenshot.stop()
+                raise
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def _take(self, index: int, location: Location) -> Capture:
+        """Take a screenshot in the current worker's browser."""
+        with self._running_screenshot() as screenshot:
+            path = screenshot.take(location, f"map_{index}.png")
+            return Capture(
+                location,
+                path,
+                *screenshot.image_size,
+                screenshot.data,
+                screenshot.image_format,
+                screenshot.origin,
+            )
+
+    def _take_viewports(
+        self, index: int, viewports: Sequence[Viewport]
+    ) -> List[Capture]:
+        """Capture viewports from one page load in the current worker's browser."""
+        with self._running_screenshot() as screenshot:
+            return screenshot.take_viewports(viewports, f"map_{index}")
+
+    def map(self, locations: Iterable[Location]) -> Iterator[Capture]:
+        """
+        Take a screenshot of each location.
+
+        A location whose screenshot failed is logged and skipped, the others
+        are still taken.
+
+        Args:
+            locations: The locations of the maps' center points.
+
+        Returns:
+            An iterator over the captures in completion order.
+
+        Raises:
+            JobTimeoutError: The pool was killed by a job's deadline.
+
+        """
+        self.start()
+        futures = {
+            self._executor.submit(self._take, index, location): location
+            for index, location in enumerate(locations)
+        }
+        return _completed(futures)
+
+    def map_viewports(
+        self, viewports: Iterable[Sequence[Viewport]]
+    ) -> Iterator[List[Capture]]:
+        """
+        Capture groups of viewports, each group from a single page load.
+
+        A group whose capture failed is logged and skipped, the others are
+        still captured.
+
+        Args:
+            viewports: The groups of viewports, e.g. several zoom levels of a
+            location.
+
+        Returns:
+            An iterator over the captures of each group in completion order.
+
+        Raises:
+            JobTimeoutError: The pool was killed by a job's deadline.
+
+        """
+        futures = {
+            self.submit_viewports(group): group[0].location for group in viewports
+        }
+        return _completed(futures)
+
+    def submit_viewports(self, viewports: Sequence[Viewport]) -> Future:
+        """
+        Schedule the capture of viewports from a single page load.
+
+        Args:
+            viewports: The maps to capture, e.g. several zoom levels of a
+            location.
+
+        Returns:
+            A future of the captures, in the same order as viewports.
+
+        """
+        self.start()
+        return self._executor.submit(self._take_viewports, next(self._count), viewports)
@@ -0,0 +1,79 @@
+"""
+Import profiler of the --startup-profile option.
+
+It only imports the standard library, the traffic-info command loads it before
+importing the package so that the package's own imports are measured.
+"""
+import builtins
+import sys
+import threading
+import time
+from typing import Dict
+
+
+class ImportProfiler:
+    """
+    ImportProfiler class, measure the time spent importing modules.
+
+    Use it as a context manager, the time spent importing each top-level
+    package for the first time, without the other packages it imports, is
+    added to the timings attribute. The imports of all the threads are
+    measured.
+    """
+
+    def __init__(self) -> None:
+        """Initialize an ImportProfiler object."""
+        self.timings: Dict[str, float] = {}
+        self._import = None
+        self._lock = threading.Lock()
+        # The time spent in the nested imports of each import of the thread
+        self._local = threading.local()
+
+    def __enter__(self) -> "ImportProfiler":
+        """Start measuring imports."""
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Stop measuring imports."""
+        builtins.__import__ = self._import
+
+    def _timed_import(
+        self, name, globals=None, locals=None, fromlist=(), level=0
+    ):  # pylint: disable=redefined-builtin
+        """Import a module like __import__ and measure the time it takes."""
+        if level or name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+        nested = self._local.__dict__.setdefault("nested", [])
+        nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            # The other packages imported are not counted in the importer's
+            own = elapsed - nested.pop()
+            if nested:
+                nested[-1] += elapsed
+            package = name.partition(".")[0]
+            with self._lock:
+                self.timings[package] = self.timings.get(package, 0) + own
+
+    def report(self) -> str:
+        """
+        Get a report of the import timings.
+
+        Returns:
+            The import timings, slowest first.
+
+        """
+        lines = [
+            f"{elapsed * 1000:10.1f} ms  {package}"
+            for package, elapsed in sorted(
+                self.timings.items(), key=lambda item: item[1], reverse=True
+            )
+        ]
+        total = sum(self.timings.values())
+        lines.append(f"{total * 1000:10.1f} ms  total")
+        return "\n".join(lines)
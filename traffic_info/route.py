@@ -0,0 +1,202 @@
+"""Route traffic conditions for traffic_info package."""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import List, Sequence, TYPE_CHECKING, Tuple
+
+from .congestion import Congestion, LEVELS, classify
+from .tiles import project
+
+if TYPE_CHECKING:
+    import numpy
+
+    from .core import Location
+
+Point = Tuple[float, float]
+
+EARTH_RADIUS = 6371008.8
+
+
+@dataclass
+class RouteSegment:
+    """
+    RouteSegment class, the traffic conditions between two route points.
+
+    Attributes:
+        start: The segment's first point as (latitude, longitude).
+        end: The segment's last point as (latitude, longitude).
+        distance: The segment's length in meters.
+        congestion: The traffic conditions along the segment.
+        coverage: Share of the segment where the traffic is known.
+
+    """
+
+    start: Point
+    end: Point
+    distance: float
+    congestion: Congestion
+    coverage: float
+
+    @property
+    def condition(self) -> str:
+        """The segment's most frequent traffic level, "unknown" without data."""
+        if not self.coverage:
+            return "unknown"
+        return max(LEVELS, key=lambda level: self.congestion.levels[level])
+
+
+def to_pixels(
+    location: Location,
+    route: Sequence[Point],
+    origin: Tuple[float, float],
+    scale: float = 1,
+) -> numpy.ndarray:
+    """
+    Project route points to pixel coordinates of a map.
+
+    Args:
+        location: The location of the map's center point.
+        route: The route's points as (latitude, longitude).
+        origin: The location's pixel coordinates on the map.
+        scale: The map's pixels per CSS pixel, default 1.
+
+    Returns:
+        The points' x and y coordinates on the map, as an N x 2 array.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    import numpy
+
+    center = project(location.latitude, location.longitude, location.zoom)
+    points = numpy.array(
+        [project(latitude, longitude, location.zoom) for latitude, longitude in route]
+    )
+    return (points - center) * scale + origin
+
+
+def distances(route: Sequence[Point]) -> numpy.ndarray:
+    """
+    Compute the great-circle length of each route segment.
+
+    Args:
+        route: The route's points as (latitude, longitude).
+
+    Returns:
+        The segments' lengths in meters.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    import numpy
+
+    latitudes, longitudes = numpy.radians(numpy.asarray(route, dtype=float)).T
+    latitude_term = numpy.sin(numpy.diff(latitudes) / 2) ** 2
+    longitude_term = numpy.sin(numpy.diff(longitudes) / 2) ** 2
+    longitude_term *= numpy.cos(latitudes[:-1]) * numpy.cos(latitudes[1:])
+    half_chord = latitude_term + longitude_term
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(half_chord))
+
+
+def sample_route(
+    pixels: numpy.ndarray,
+    location: Location,
+    route: Sequence[Point],
+    corridor: int = 3,
+    step: float = 2,
+    tolerance: int = 40,
+    max_segments: int = 10,
+    origin: Tuple[float, float] = None,
+    scale: float = 1,
+) -> List[RouteSegment]:
+    """
+    Sample the traffic conditions along a route on a map screenshot.
+
+    The route is sampled every step pixels, at each sample the worst
+    traffic level found across the corridor is kept. Samples outside the
+    map are ignored. When the route has more than max_segments legs,
+    consecutive legs are merged into segments of about the same length.
+
+    Args:
+        pixels: The screenshot's RGB pixels, see congestion.decode().
+        location: The location of the map's center point.
+        route: The route's points as (latitude, longitude).
+        corridor: Half width of the sampled corridor in pixels, default 3.
+        step: Distance between samples in pixels, default 2.
+        tolerance: Maximum distance to a traffic color, default 40.
+        max_segments: Maximum number of segments, default 10.
+        origin: The location's pixel coordinates on the screenshot, its
+        center if not specified, e.g. for a cropped screenshot.
+        scale: The screenshot's pixels per CSS pixel, e.g. 2 for a retina
+        screenshot, default 1.
+
+    Returns:
+        The traffic conditions of each segment.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    import numpy
+
+    if len(route) < 2:
+        return []
+    height, width = pixels.shape[:2]
+    if origin is None:
+        origin = (width / 2, height / 2)
+    points = to_pixels(location, route, origin, scale)
+    starts = points[:-1]
+    vectors = numpy.diff(points, axis=0)
+    lengths = numpy.hypot(vectors[:, 0], vectors[:, 1])
+    segment_count = len(lengths)
+
+    # Sample positions along all the segments at once
+    counts = numpy.maximum(numpy.ceil(lengths / step), 1).astype(int)
+    segments = numpy.repeat(numpy.arange(segment_count), counts)
+    first_samples = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    ratios = (numpy.arange(len(segments)) - first_samples + 0.5) / counts[segments]
+    samples = starts[segments] + vectors[segments] * ratios[:, None]
+
+    # Spread each sample across the corridor, perpendicular to its segment
+    normals = numpy.stack([-vectors[:, 1], vectors[:, 0]], axis=1)
+    normals /= numpy.maximum(lengths, 1e-9)[:, None]
+    spread = numpy.arange(-corridor, corridor + 1)
+    corridor_points = (
+        samples[:, None, :] + normals[segments][:, None, :] * spread[None, :, None]
+    )
+    columns = numpy.rint(corridor_points[..., 0]).astype(int)
+    rows = numpy.rint(corridor_points[..., 1]).astype(int)
+    inside = (columns >= 0) & (columns < width) & (rows >= 0) & (rows < height)
+    classes = classify(
+        pixels[numpy.clip(rows, 0, height - 1), numpy.clip(columns, 0, width - 1)],
+        tolerance,
+    )
+    classes[~inside] = 0
+    sample_levels = classes.max(axis=1)
+
+    # Merge the legs in groups of about the same length
+    leg_lengths = distances(route)
+    total_length = leg_lengths.sum()
+    if segment_count <= max_segments or not total_length:
+        groups = numpy.arange(segment_count)
+    else:
+        leg_starts = numpy.cumsum(leg_lengths) - leg_lengths
+        buckets = (leg_starts / total_length * max_segments).astype(int)
+        groups = numpy.unique(buckets, return_inverse=True)[1]
+    group_count = groups[-1] + 1
+    sample_groups = groups[segments]
+    level_counts = numpy.bincount(
+        sample_groups * (len(LEVELS) + 1) + sample_levels,
+        minlength=group_count * (len(LEVELS) + 1),
+    ).reshape(group_count, len(LEVELS) + 1)
+    sample_counts = numpy.bincount(sample_groups, minlength=group_count)
+    group_lengths = numpy.bincount(groups, leg_lengths, minlength=group_count)
+    boundaries = numpy.flatnonzero(numpy.diff(groups)) + 1
+    first_points = numpy.concatenate([[0], boundaries])
+    last_points = numpy.concatenate([boundaries, [segment_count]])
+    return [
+        RouteSegment(
+            tuple(route[first_points[group]]),
+            tuple(route[last_points[group]]),
+            float(group_lengths[group]),
+            Congestion.from_counts(level_counts[group, 1:]),
+            float(level_counts[group, 1:].sum() / sample_counts[group]),
+        )
+        for group in range(group_count)
+    ]
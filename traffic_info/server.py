@@ -0,0 +1,295 @@
+"""HTTP maps server for traffic_info package."""
+from __future__ import annotations
+
+import collections
+import hashlib
+import http.server
+import json
+import logging
+import statistics
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Tuple
+
+from .core import DEFAULT_HEIGHT, DEFAULT_WIDTH, Location, Viewport
+from .metrics import metrics
+from .pool import ScreenshotPool
+
+MapKey = Tuple[float, float, int, int, int]
+
+
+@dataclass
+class MapImage:
+    """
+    MapImage class, a map served over HTTP.
+
+    Attributes:
+        data: The map's image.
+        content_type: The image's MIME type.
+        etag: The image's entity tag, a quoted hash of the image.
+        created: When the map was captured, as returned by time.time().
+
+    """
+
+    data: bytes
+    content_type: str
+    etag: str
+    created: float
+
+
+class _MapHandler(http.server.BaseHTTPRequestHandler):
+    """Serve /map and /stats."""
+
+    protocol_version = "HTTP/1.1"
+    server: MapServer
+
+    def do_GET(self) -> None:  # noqa: N802
+        """Send a map or the server's statistics."""
+        start = time.perf_counter()
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/map":
+            self._send_map(urllib.parse.parse_qs(url.query))
+            self.server.record(time.perf_counter() - start)
+        elif url.path == "/stats":
+            body = json.dumps(self.server.stats()).encode()
+            self._send(200, body, {"Content-Type": "application/json"})
+        else:
+            self._send(404, b"Not found\n")
+
+    def _send(
+        self, status: int, body: bytes = b"", headers: Dict[str, str] = None
+    ) -> None:
+        """Send a response."""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if "Content-Type" not in (headers or {}):
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_map(self, query: Dict[str, Any]) -> None:
+        """Send the map of the query's parameters."""
+        try:
+            location, width, height = self.server.parse_query(query)
+        except ValueError as exc:
+            self._send(400, f"{exc}\n".encode())
+            return
+        try:
+            image = self.server.get_map(location, width, height)
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.getLogger(__name__).error(
+                "Unable to capture the map of %s(%s)", location, exc
+            )
+            self._send(502, b"Unable to capture the map\n")
+            return
+        max_age = max(0, int(image.created + self.server.max_age - time.time()))
+        headers = {
+            "Content-Type": image.content_type,
+            "Cache-Control": f"public, max-age={max_age}",
+            "ETag": image.etag,
+        }
+        if image.etag in self.headers.get("If-None-Match", ""):
+            self._send(304, headers=headers)
+            return
+        self._send(200, image.data, headers)
+
+    def log_message(self, *args) -> None:
+        """Log requests at debug level."""
+        logging.getLogger(__name__).debug(*args)
+
+
+class MapServer(http.server.ThreadingHTTPServer):
+    """
+    MapServer class, serve the current traffic maps over HTTP.
+
+    GET /map?lat=LATITUDE&lng=LONGITUDE&zoom=ZOOM&w=WIDTH&h=HEIGHT returns
+    the map's image, zoom, w and h are optional. The maps are captured by a
+    pool of browsers kept warm between requests. Concurrent requests for the
+    same map share a single capture, and a map is served from memory for
+    max_age seconds, with Cache-Control and ETag headers for the clients'
+    caches.
+
+    GET /stats returns the number of requests, captures and cache hits, the
+    throughput and the latency of the last requests as JSON.
+
+    Use it as a context manager, serve_forever() serves the requests.
+
+    Args:
+        pool: The pool of browsers capturing the maps.
+        address: The address and port to listen on, default localhost:8080.
+        max_age: Seconds a map is served before capturing it again,
+        default 60.
+        max_entries: Maximum number of maps kept in memory, default 256.
+        max_size: Maximum width and height of a map, default 2048.
+
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        pool: ScreenshotPool,
+        address: Tuple[str, int] = ("127.0.0.1", 8080),
+        max_age: float = 60,
+        max_entries: int = 256,
+        max_size: int = 2048,
+    ) -> None:
+        """Initialize a MapServer object listening on the given address."""
+        super().__init__(address, _MapHandler)
+        self.pool: ScreenshotPool = pool
+        self.max_age: float = max_age
+        self.max_entries: int = max_entries
+        self.max_size: int = max_size
+        self.width: int = pool.screenshot_params.get("width", DEFAULT_WIDTH)
+        self.height: int = pool.screenshot_params.get("height", DEFAULT_HEIGHT)
+        self._maps: collections.OrderedDict[MapKey, MapImage] = (
+            collections.OrderedDict()
+        )
+        self._pending: Dict[MapKey, Future] = {}
+        self._lock = threading.Lock()
+        self._started: float = time.monotonic()
+        self._counters: Dict[str, int] = dict.fromkeys(
+            ["requests", "captures", "hits", "coalesced"], 0
+        )
+        self._latencies: Deque[float] = collections.deque(maxlen=1000)
+
+    def parse_query(self, query: Dict[str, Any]) -> Tuple[Location, int, int]:
+        """
+        Get a map's location and size from a /map query.
+
+        Args:
+            query: The query's parameters, see urllib.parse.parse_qs().
+
+        Returns:
+            The map's location, width and height.
+
+        Raises:
+            ValueError: A parameter is missing or invalid.
+
+        """
+
+        def get(name, cast, default=None):
+            values = query.get(name)
+            if not values:
+                if default is None:
+                    raise ValueError(f"missing parameter {name}")
+                return default
+            try:
+                return cast(values[0])
+            except ValueError:
+                raise ValueError(f"invalid parameter {name}") from None
+
+        latitude = get("lat", float)
+        longitude = get("lng", float)
+        zoom = get("zoom", int, 16)
+        width = get("w", int, self.width)
+        height = get("h", int, self.height)
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError("invalid coordinates")
+        if not 0 <= zoom <= 22:
+            raise ValueError("invalid zoom level")
+        if not (0 < width <= self.max_size and 0 < height <= self.max_size):
+            raise ValueError(f"the size must be at most {self.max_size}")
+        return Location(latitude, longitude, zoom), width, height
+
+    def get_map(self, location: Location, width: int, height: int) -> MapImage:
+        """
+        Get a fresh map, capture it if needed.
+
+        Args:
+            location: The location of the map's center point.
+            width: The map's width.
+            height: The map's height.
+
+        Returns:
+            The map.
+
+        """
+        key = (location.latitude, location.longitude, location.zoom, width, height)
+        with self._lock:
+            self._counters["requests"] += 1
+            image = self._maps.get(key)
+            if image is not None and time.time() - image.created < self.max_age:
+                self._maps.move_to_end(key)
+                self._counters["hits"] += 1
+                return image
+            result = self._pending.get(key)
+            capture = result is None
+            if capture:
+                self._counters["captures"] += 1
+                result = self._pending[key] = Future()
+            else:
+                self._counters["coalesced"] += 1
+        if capture:
+            # The callback runs at once if the capture is already done, so
+            # it is added once the lock is released
+            captures = self.pool.submit_viewports([Viewport(location, width, height)])
+            captures.add_done_callback(
+                lambda captures: self._store(key, captures, result)
+            )
+        return result.result()
+
+    def _store(self, key: MapKey, captures: Future, result: Future) -> None:
+        """Keep a captured map and give it to the requests waiting for it."""
+        try:
+            capture = captures.result()[0]
+            data = capture.data
+            if data is None:
+                with open(capture.path, "rb") as image_file:
+                    data = image_file.read()
+        except BaseException as exc:  # pylint: disable=broad-except
+            with self._lock:
+                del self._pending[key]
+            result.set_exception(exc)
+            return
+        image = MapImage(
+            data,
+            f"image/{capture.image_format}",
+            f'"{hashlib.sha256(data).hexdigest()[:32]}"',
+            time.time(),
+        )
+        with self._lock:
+            self._maps[key] = image
+            self._maps.move_to_end(key)
+            while len(self._maps) > self.max_entries:
+                self._maps.popitem(last=False)
+            del self._pending[key]
+        result.set_result(image)
+
+    def record(self, latency: float) -> None:
+        """
+        Record a /map request's latency.
+
+        Args:
+            latency: The time to answer the request in seconds.
+
+        """
+        with self._lock:
+            self._latencies.append(latency)
+        metrics.record("serve_latency_seconds", latency)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Get the server's statistics.
+
+        Returns:
+            The number of requests, captures, cache hits and coalesced
+            requests, the requests per second and the median and 95th
+            percentile latency of the last 1000 requests in milliseconds.
+
+        """
+        with self._lock:
+            stats: Dict[str, float] = dict(self._counters)
+            latencies = sorted(self._latencies)
+        stats["throughput"] = stats["requests"] / (time.monotonic() - self._started)
+        if latencies:
+            stats["latency_median"] = statistics.median(latencies) * 1000
+            index = min(len(latencies) - 1, int(len(latencies) * 0.95))
+            stats["latency_p95"] = latencies[index] * 1000
+        return stats
@@ -0,0 +1,254 @@
+"""Browserless map rendering for traffic_info package."""
+from __future__ import annotations
+
+import io
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence, TYPE_CHECKING, Tuple
+
+from .exceptions import TileFetchError
+
+if TYPE_CHECKING:
+    import numpy
+
+    import urllib3
+
+    from .core import Location
+
+Tile = Tuple[int, int, int]
+
+
+def project(
+    latitude: float, longitude: float, zoom: int, tile_size: int = 256
+) -> Tuple[float, float]:
+    """
+    Project a point to web mercator pixel coordinates.
+
+    Args:
+        latitude: The point's latitude.
+        longitude: The point's longitude.
+        zoom: The zoom level.
+        tile_size: The tiles' size in pixels, default 256.
+
+    Returns:
+        The point's x and y coordinates in pixels of the whole world map.
+
+    """
+    world_size = tile_size * 2**zoom
+    latitude = max(-85.0511287798, min(85.0511287798, latitude))
+    sin_latitude = math.sin(math.radians(latitude))
+    x = (longitude + 180) / 360 * world_size
+    y = (
+        0.5 - math.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)
+    ) * world_size
+    return x, y
+
+
+class TileRenderer:
+    """
+    TileRenderer class, render maps from XYZ tiles without a browser.
+
+    The tiles covering the viewport are fetched concurrently over pooled
+    HTTP connections, then each layer is alpha-composited on top of the
+    previous ones and cropped to the viewport.
+
+    It is thread-safe, a single TileRenderer can be shared by several
+    MapScreenshot objects. It requires numpy and Pillow, install them with
+    the tiles extra: pip install traffic_info[tiles].
+
+    Args:
+        url_templates: The layers' XYZ tile URL templates from bottom to top,
+        e.g. "https://tile.example.com/{z}/{x}/{y}.png".
+        tile_size: The tiles' size in pixels, default 256.
+        max_connections: Maximum number of concurrent tile requests,
+        default 8.
+        timeout: Tile requests timeout in seconds, default 10.
+        background: The color of the areas not covered by any tile.
+
+    """
+
+    def __init__(
+        self,
+        url_templates: Sequence[str],
+        tile_size: int = 256,
+        max_connections: int = 8,
+        timeout: float = 10,
+        background: Tuple[int, int, int] = (232, 234, 237),
+    ) -> None:
+        """Initialize a TileRenderer object with the given options."""
+        self.url_templates: List[str] = list(url_templates)
+        self.tile_size: int = tile_size
+        self.max_connections: int = max_connections
+        self.timeout: float = timeout
+        self.background: Tuple[int, int, int] = background
+        self._http: urllib3.PoolManager = None
+        self._executor: ThreadPoolExecutor = None
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "TileRenderer":
+        """Open the HTTP connections pool, see start()."""
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Close the HTTP connections pool."""
+        self.close()
+
+    def start(self) -> None:
+        """Open the HTTP connections pool and the fetching threads."""
+        # pylint: disable=import-outside-toplevel
+        import urllib3
+
+        with self._lock:
+            if self._http is not None:
+                return
+            self._http = urllib3.PoolManager(
+                maxsize=self.max_connections,
+                block=True,
+                timeout=self.timeout,
+                retries=urllib3.Retry(
+                    total=2,
+                    backoff_factor=0.2,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                ),
+            )
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_connections, thread_name_prefix="tiles"
+            )
+
+    def close(self) -> None:
+        """Close the HTTP connections pool and the fetching threads."""
+        with self._lock:
+            if self._http is None:
+                return
+            self._executor.shutdown()
+            self._http.clear()
+            self._http = None
+            self._executor = None
+
+    def tiles(
+        self, location: Location, width: int, height: int
+    ) -> Tuple[List[Tile], int, Tuple[int, int]]:
+        """
+        Get the tiles covering a viewport.
+
+        Args:
+            location: The location of the map's center point.
+            width: The viewport's width.
+            height: The viewport's height.
+
+        Returns:
+            The (x, y, zoom) tiles row by row, the number of columns and the
+            offset in pixels of the viewport in the first tile.
+
+        """
+        center_x, center_y = project(
+            location.latitude, location.longitude, location.zoom, self.tile_size
+        )
+        left = round(center_x - width / 2)
+        top = round(center_y - height / 2)
+        first_x, offset_x = divmod(left, self.tile_size)
+        first_y, offset_y = divmod(top, self.tile_size)
+        columns = -(-(offset_x + width) // self.tile_size)
+        rows = -(-(offset_y + height) // self.tile_size)
+        tiles = [
+            (first_x + column, first_y + row, location.zoom)
+            for row in range(rows)
+            for column in range(columns)
+        ]
+        return tiles, columns, (offset_x, offset_y)
+
+    def _fetch(self, url_template: str, tile: Tile) -> numpy.ndarray:
+        """Fetch and decode a tile, None if it is outside the map or missing."""
+        # pylint: disable=import-outside-toplevel
+        import numpy
+        from PIL import Image
+        from urllib3.exceptions import HTTPError
+
+        x, y, zoom = tile
+        count = 2**zoom
+        if not 0 <= y < count:
+            return None
+        url = url_template.format(x=x % count, y=y, z=zoom)
+        try:
+            response = self._http.request("GET", url)
+        except HTTPError as exc:
+            raise TileFetchError(url, exc) from exc
+        if response.status in (204, 404):
+            return None
+        if response.status != 200:
+            raise TileFetchError(url, f"HTTP {response.status}")
+
+        with Image.open(io.BytesIO(response.data)) as image:
+            image = image.convert("RGBA")
+            if image.size != (self.tile_size, self.tile_size):
+                image = image.resize((self.tile_size, self.tile_size))
+            return numpy.asarray(image)
+
+    def _mosaic(self, images: List[numpy.ndarray], columns: int) -> numpy.ndarray:
+        """Assemble a layer's tiles in a RGBA array, None if they are all missing."""
+        # pylint: disable=import-outside-toplevel
+        import numpy
+
+        if all(image is None for image in images):
+            return None
+        rows = len(images) // columns
+        size = self.tile_size
+        mosaic = numpy.zeros((rows * size, columns * size, 4), dtype=numpy.uint8)
+        for index, image in enumerate(images):
+            if image is None:
+                continue
+            row, column = divmod(index, columns)
+            rows_slice = slice(row * size, (row + 1) * size)
+            columns_slice = slice(column * size, (column + 1) * size)
+            mosaic[rows_slice, columns_slice] = image
+        return mosaic
+
+    def render(self, location: Location, width: int, height: int) -> bytes:
+        """
+        Render a map.
+
+        Args:
+            location: The location of the map's center point.
+            width: The map's width.
+            height: The map's height.
+
+        Returns:
+            The map as a PNG image of width x height pixels.
+
+        """
+        # pylint: disable=import-outside-toplevel
+        import numpy
+        from PIL import Image
+
+        self.start()
+        tiles, columns, (offset_x, offset_y) = self.tiles(location, width, height)
+        canvas = numpy.empty((height, width, 3), dtype=numpy.uint16)
+        canvas[:] = self.background
+        viewport = (
+            slice(offset_y, offset_y + height),
+            slice(offset_x, offset_x + width),
+        )
+        # All the layers are fetched at once, then composited from the bottom
+        layers = [
+            [self._executor.submit(self._fetch, url_template, tile) for tile in tiles]
+            for url_template in self.url_templates
+        ]
+        for futures in layers:
+            mosaic = self._mosaic([future.result() for future in futures], columns)
+            if mosaic is None:
+                continue
+            layer = mosaic[viewport]
+            alpha = layer[..., 3:].astype(numpy.uint16)
+            if alpha.min() == 255:
+                canvas[:] = layer[..., :3]
+                continue
+            canvas *= 255 - alpha
+            canvas += layer[..., :3] * alpha
+            canvas += 127
+            canvas //= 255
+
+        output = io.BytesIO()
+        Image.fromarray(canvas.astype(numpy.uint8), "RGB").save(output, "PNG")
+        return output.getvalue()
@@ -1,11 +1,24 @@
 """Utils for traffic_info package."""
+import contextlib
+import os.path
 import shutil
-from typing import Any, Dict
+import signal
+import threading
+from typing import Any, Callable, Dict, Iterator, List, TYPE_CHECKING
 
-import jinja2
+from .metrics import metrics
+
+if TYPE_CHECKING:
+    import jinja2
 
 Context = Dict[str, Any]
 
+TEMPLATE_CACHE_SIZE = 50
+
+_environments: Dict[str, "jinja2.Environment"] = {}
+_environments_lock = threading.Lock()
+_bytecode_cache: "jinja2.BytecodeCache" = None
+
 
 def get_chromedriver_path() -> str:
     """
@@ -19,6 +32,56 @@ def get_chromedriver_path() -> str:
     return chromedriver_path
 
 
+def set_template_bytecode_cache(directory: str = None) -> None:
+    """
+    Store the compiled templates on disk to speed up the next runs.
+
+    Args:
+        directory: The bytecode cache's directory, None to disable it.
+
+    """
+    global _bytecode_cache  # pylint: disable=global-statement
+    import jinja2  # pylint: disable=import-outside-toplevel, redefined-outer-name
+
+    with _environments_lock:
+        if directory is None:
+            _bytecode_cache = None
+        else:
+            os.makedirs(directory, exist_ok=True)
+            _bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+        _environments.clear()
+
+
+def get_template(template: str) -> "jinja2.Template":
+    """
+    Get a compiled Jinja2 template.
+
+    Templates are compiled once and kept in a LRU cache, they are compiled
+    again when the template file is modified.
+
+    Args:
+        template: The path to the Jinja2 template.
+
+    Returns:
+        The compiled template.
+
+    """
+    import jinja2  # pylint: disable=import-outside-toplevel, redefined-outer-name
+
+    directory, name = os.path.split(os.path.abspath(template))
+    with _environments_lock:
+        environment = _environments.get(directory)
+        if environment is None:
+            environment = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(directory),
+                cache_size=TEMPLATE_CACHE_SIZE,
+                auto_reload=True,
+                bytecode_cache=_bytecode_cache,
+            )
+            _environments[directory] = environment
+    return environment.get_template(name)
+
+
 def render_template(template: str, context: Context, output: str = None) -> str:
     """
     Render a Jinja2 template.
@@ -32,12 +95,97 @@ def render_template(template: str, context: Context, output: str = None) -> str:
         The rendered template if output is None or the path to the rendered file.
 
     """
-    with open(template, mode="r", encoding="utf-8") as template_file:
-        jinja_template = jinja2.Template(template_file.read())
-
-    render = jinja_template.render(context)
+    with metrics.phase("render_template", template=os.path.basename(template)):
+        render = get_template(template).render(context)
     if output is None:
         return render
     with open(output, mode="w", encoding="utf-8") as render_file:
         render_file.write(render)
     return output
+
+
+def get_available_memory() -> int:
+    """
+    Get the memory available for new processes.
+
+    Returns:
+        The available memory in MiB, None if it can't be determined.
+
+    """
+    try:
+        with open("/proc/meminfo", mode="r", encoding="utf-8") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+@contextlib.contextmanager
+def deadline(
+    timeout: float, on_expiry: Callable[[], None]
+) -> Iterator[threading.Event]:
+    """
+    Call a function if the context is not left in time.
+
+    Args:
+        timeout: Number of seconds before on_expiry is called, no deadline if
+        None or 0.
+        on_expiry: The function called from another thread, e.g. to kill a
+        hung process.
+
+    Yields:
+        An event set once the deadline expired, on_expiry has returned when
+        the context is left.
+
+    """
+    expired = threading.Event()
+    if not timeout:
+        yield expired
+        return
+
+    def expire():
+        expired.set()
+        on_expiry()
+
+    timer = threading.Timer(timeout, expire)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield expired
+    finally:
+        timer.cancel()
+        timer.join()
+
+
+def kill_process_tree(pid: int) -> None:
+    """
+    Kill a process and its descendants, e.g. chromedriver and its browser.
+
+    The descendants are found in /proc, only the process is killed if it is
+    not available.
+
+    Args:
+        pid: The process' ID.
+
+    """
+    children: Dict[int, List[int]] = {}
+    with contextlib.suppress(OSError):
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat", mode="r", encoding="utf-8") as stat:
+                    # The command's name is in parentheses and may contain spaces
+                    parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+    # The whole tree is listed first, the orphans are reparented once killed
+    tree = [pid]
+    for process in tree:
+        tree.extend(children.get(process, []))
+    for process in tree:
+        with contextlib.suppress(OSError):
+            os.kill(process, signal.SIGKILL)